@@ -0,0 +1,188 @@
+import gzip
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app.config import Config
+from app.metrics import api_request_duration, api_request_failures, endpoint
+
+
+class ConnectionStats:
+    """Thread-safe counters for connections made to the API server.
+
+    Attributes:
+        requests (int): The number of requests sent
+        opened (int): The number of new connections opened
+    """
+    requests: int
+    opened: int
+
+    def __init__(self):
+        self.requests = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def add_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def add_connection(self) -> None:
+        with self._lock:
+            self.opened += 1
+
+    def as_dict(self) -> Dict[str, int]:
+        """Return the counters, including the number of requests that reused a connection.
+
+        Returns:
+            Dict[str, int]: The `requests`, `opened`, and `reused` counters.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "opened": self.opened,
+                "reused": max(0, self.requests - self.opened),
+            }
+
+
+stats = ConnectionStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.add_connection()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.add_connection()
+        return super()._new_conn()
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class ApiSession:
+    """A pooled, keep-alive HTTP session shared by every call to the API server.
+
+    Each thread gets its own `requests.Session`, but all of them share a
+    single connection pool so connections are reused across threads.
+
+    Attributes:
+        base_url (str): The URL of the API server
+        timeouts (Dict[str, float]): Request timeouts in seconds keyed by path prefix
+        default_timeout (float): The timeout for paths that match no prefix in `timeouts`
+        adapter (HTTPAdapter): The connection pool shared by every session
+    """
+    base_url: str
+    timeouts: Dict[str, float]
+    default_timeout: float
+    adapter: HTTPAdapter
+
+    def __init__(self, base_url: str, pool_size: int = 4, timeouts: Optional[Dict[str, float]] = None, default_timeout: float = 3):
+        """Initializes the shared connection pool.
+
+        Args:
+            base_url (str): The URL of the API server
+            pool_size (int, optional): The number of connections to keep alive. Defaults to 4.
+            timeouts (Dict[str, float], optional): Request timeouts keyed by path prefix. Defaults to None.
+            default_timeout (float, optional): The timeout for any other path. Defaults to 3.
+        """
+        self.base_url = base_url
+        self.timeouts = timeouts if timeouts else dict()
+        self.default_timeout = default_timeout
+        self.adapter = _CountingAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """The session for the current thread, mounted on the shared connection pool.
+
+        Returns:
+            requests.Session: The session.
+        """
+        if not (session := getattr(self._local, "session", None)):
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self._local.session = session
+        return session
+
+    def get_timeout(self, rest_path: str) -> float:
+        """Return the timeout of the longest path prefix matching the path.
+
+        Args:
+            rest_path (str): The path to use (e.g. `/queue/poll`)
+
+        Returns:
+            float: The timeout in seconds.
+        """
+        matches = [i for i in self.timeouts if rest_path.startswith(i)]
+        if not matches:
+            return self.default_timeout
+        return self.timeouts[max(matches, key=len)]
+
+    def request(self, method: str, rest_path: str, compress: Optional[bool] = None, **kwargs) -> requests.Response:
+        """Send a request to the API server.
+
+        Args:
+            method (str): The method to use (e.g. `GET`, `POST`)
+            rest_path (str): The path to use (e.g. `/queue`)
+            compress (bool, optional): Gzip the JSON request body. Defaults to `Config.API_GZIP_REQUESTS`.
+
+        Raises:
+            requests.RequestException: When the request fails.
+
+        Returns:
+            requests.Response: The resulting response from the request.
+        """
+        kwargs.setdefault("timeout", self.get_timeout(rest_path))
+        if compress is None:
+            compress = Config.API_GZIP_REQUESTS
+        if compress and kwargs.get("json") is not None:
+            body = json.dumps(kwargs.pop("json")).encode()
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers["Content-Type"] = "application/json"
+            if len(body) >= Config.API_GZIP_MIN_SIZE:
+                body = gzip.compress(body)
+                headers["Content-Encoding"] = "gzip"
+            kwargs["data"], kwargs["headers"] = body, headers
+
+        stats.add_request()
+        labels = {"method": method, "endpoint": endpoint(rest_path)}
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, self.base_url + rest_path, **kwargs)
+        except requests.RequestException as e:
+            api_request_failures.inc(**labels, reason=type(e).__name__)
+            raise
+        finally:
+            api_request_duration.observe(time.perf_counter() - start, **labels)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the connection counters for the API server.
+
+        Returns:
+            Dict[str, int]: The `requests`, `opened`, and `reused` counters.
+        """
+        return stats.as_dict()
+
+
+api = ApiSession(
+    base_url=Config.API_URL,
+    pool_size=Config.API_POOL_SIZE,
+    timeouts=Config.API_TIMEOUTS,
+    default_timeout=Config.API_DEFAULT_TIMEOUT,
+)
@@ -3,6 +3,7 @@ from pathlib import Path
 import platform
 import tomllib
 import uuid
+from typing import Dict, List
 from zoneinfo import ZoneInfo
 
 from box import Box
@@ -11,6 +12,56 @@ with open("pyproject.toml", 'rb') as f:
     pyproject = Box(tomllib.load(f))
 
 
+def env_bool(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment.
+
+    Args:
+        name (str): The name of the environment variable
+        default (bool, optional): The value to use when the variable is not set. Defaults to False.
+
+    Returns:
+        bool: `True` for `1`, `true`, `yes`, and `on` (case-insensitive), otherwise `False`
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_mapping(name: str, default: Dict[str, float]) -> Dict[str, float]:
+    """Read a `key=number,key=number` mapping from the environment on top of defaults.
+
+    Args:
+        name (str): The name of the environment variable
+        default (Dict[str, float]): The default mapping
+
+    Returns:
+        Dict[str, float]: The default mapping updated with the values from the environment
+    """
+    mapping = dict(default)
+    for item in os.environ.get(name, "").split(","):
+        key, sep, value = item.partition("=")
+        if sep and key.strip():
+            mapping[key.strip()] = float(value)
+    return mapping
+
+
+def env_list(name: str, default: List[str]) -> List[str]:
+    """Read a comma-separated list from the environment.
+
+    Args:
+        name (str): The name of the environment variable
+        default (List[str]): The value to use when the variable is not set
+
+    Returns:
+        List[str]: The non-empty items of the list
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return list(default)
+    return [i.strip() for i in value.split(",") if i.strip()]
+
+
 class Config:
     API_URL = os.environ.get("API_URL", "http://localhost:5000")
     API_TIMEZONE = ZoneInfo(os.environ.get("API_TIMEZONE", "UTC"))
@@ -18,7 +69,78 @@ class Config:
     HOSTNAME = os.environ.get("HOSTNAME_OVERRIDE", platform.node())
     HOST_UUID = os.environ.get("HOST_UUID", str(uuid.uuid4()))
     HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", "5"))
+    # Idle workers are only seen alive through keepalives, so this defaults to the heartbeat interval;
+    # raise it only as far as the API server's worker liveness timeout allows
+    HEARTBEAT_KEEPALIVE = float(
+        os.environ.get("HEARTBEAT_KEEPALIVE", str(HEARTBEAT_INTERVAL)))
+    HEARTBEAT_DELTAS = env_bool("HEARTBEAT_DELTAS")
     QUEUE_POLL_INTERVAL = int(os.environ.get("QUEUE_POLL_INTERVAL", "10"))
     NETWORK_RETRY_INTERVAL = int(
         os.environ.get("NETWORK_RETRY_INTERVAL", "20"))
     MODULES = pyproject.tool.client.modules.enabled
+    MAX_CONCURRENT_JOBS = max(1, int(
+        os.environ.get("MAX_CONCURRENT_JOBS", "1")))
+    MAX_CONCURRENT_TASKS = max(0, int(
+        os.environ.get("MAX_CONCURRENT_TASKS", "0")))
+    API_POOL_SIZE = int(os.environ.get(
+        "API_POOL_SIZE", str(MAX_CONCURRENT_JOBS + 4)))
+    API_TIMEOUTS = env_mapping("API_TIMEOUTS", {
+        "/workers": 2,
+        "/queue": 3,
+        "/data": 5,
+        "/jobs": 10,
+    })
+    API_DEFAULT_TIMEOUT = float(os.environ.get("API_DEFAULT_TIMEOUT", "3"))
+    API_GZIP_REQUESTS = env_bool("API_GZIP_REQUESTS")
+    API_GZIP_MIN_SIZE = int(os.environ.get("API_GZIP_MIN_SIZE", "1024"))
+    RUNTIME = os.environ.get("RUNTIME", "threads").lower()
+    TASK_TIMEOUT = float(os.environ.get("TASK_TIMEOUT", "0"))
+    QUEUE_POLL_MIN_INTERVAL = float(
+        os.environ.get("QUEUE_POLL_MIN_INTERVAL", "1"))
+    QUEUE_POLL_MAX_INTERVAL = float(
+        os.environ.get("QUEUE_POLL_MAX_INTERVAL", str(QUEUE_POLL_INTERVAL * 6)))
+    QUEUE_STATUS_CACHE_TTL = float(
+        os.environ.get("QUEUE_STATUS_CACHE_TTL", "30"))
+    PREFETCH_JOBS = env_bool("PREFETCH_JOBS")
+    OPTION_SET_CACHE_TTL = float(
+        os.environ.get("OPTION_SET_CACHE_TTL", "300"))
+    OPTION_SET_CACHE_DIR = os.environ.get("OPTION_SET_CACHE_DIR", "")
+    MODULE_PLUGINS = env_bool("MODULE_PLUGINS", True)
+    MODULE_WARMUP = env_bool("MODULE_WARMUP")
+    CLEANUP_WORKERS = max(1, int(os.environ.get("CLEANUP_WORKERS", "4")))
+    CLEANUP_DEVICE_PARALLELISM = max(1, int(
+        os.environ.get("CLEANUP_DEVICE_PARALLELISM", "2")))
+    CLEANUP_BANDWIDTH_LIMIT = float(
+        os.environ.get("CLEANUP_BANDWIDTH_LIMIT", "0"))
+    PROBE_CACHE_SIZE = max(1, int(os.environ.get("PROBE_CACHE_SIZE", "256")))
+    PROBE_CACHE_PATH = os.environ.get("PROBE_CACHE_PATH", "")
+    MKVMERGE_IDENTIFY_WORKERS = max(1, int(
+        os.environ.get("MKVMERGE_IDENTIFY_WORKERS", "8")))
+    CPU_PINNING = env_bool("CPU_PINNING")
+    FFMPEG_SEGMENTS = env_bool("FFMPEG_SEGMENTS")
+    FFMPEG_SEGMENT_WORKERS = max(1, int(
+        os.environ.get("FFMPEG_SEGMENT_WORKERS", "4")))
+    FFMPEG_SEGMENT_MIN_LENGTH = float(
+        os.environ.get("FFMPEG_SEGMENT_MIN_LENGTH", "30"))
+    FFMPEG_SEGMENT_MIN_DURATION = float(
+        os.environ.get("FFMPEG_SEGMENT_MIN_DURATION", "600"))
+    FFMPEG_CHECKPOINTS = env_bool("FFMPEG_CHECKPOINTS")
+    FFMPEG_CHECKPOINT_INTERVAL = max(1.0, float(
+        os.environ.get("FFMPEG_CHECKPOINT_INTERVAL", "300")))
+    FFMPEG_MAX_RETRIES = max(0, int(
+        os.environ.get("FFMPEG_MAX_RETRIES", "3")))
+    STAGING_DIR = os.environ.get("STAGING_DIR", "")
+    STAGING_CAPACITY = float(os.environ.get("STAGING_CAPACITY", "50"))
+    STAGING_ROOTS = env_list("STAGING_ROOTS", ["/mnt"])
+    STAGING_MODULES = env_list(
+        "STAGING_MODULES", ["ffmpeg", "handbrake", "mkvmerge", "mkvextract"])
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+    METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "0.0.0.0")
+    JOB_SPANS = env_bool("JOB_SPANS", True)
+    TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+    ENCODE_CACHE_DIR = os.environ.get("ENCODE_CACHE_DIR", "")
+    ENCODE_CACHE_CAPACITY = float(
+        os.environ.get("ENCODE_CACHE_CAPACITY", "100"))
+    CHECKSUM_ALGORITHM = os.environ.get("CHECKSUM_ALGORITHM", "")
+    CHECKSUM_VERIFY = env_bool("CHECKSUM_VERIFY")
+    CHECKSUM_OUTPUTS = env_bool("CHECKSUM_OUTPUTS")
@@ -0,0 +1,232 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from loguru import logger
+
+from app.config import Config
+
+SYSFS_CPU = Path("/sys/devices/system/cpu")
+SYSFS_NODE = Path("/sys/devices/system/node")
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Parse a kernel CPU list (e.g. `0-3,8,10-11`).
+
+    Args:
+        text (str): The CPU list
+
+    Returns:
+        List[int]: The CPUs in the list.
+    """
+    cpus = list()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    """Format CPUs as a kernel CPU list (e.g. `0-3,8`).
+
+    Args:
+        cpus (List[int]): The CPUs
+
+    Returns:
+        str: The CPU list.
+    """
+    ranges = list()
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def _read(path: Path) -> Optional[str]:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+class CpuTopology:
+    """The CPUs available to the worker, grouped by NUMA node.
+
+    Only CPUs in the worker's own affinity mask (e.g. limited by a container)
+    are included.  Within a node, CPUs are ordered by package and core so that
+    SMT siblings end up next to each other.
+
+    Attributes:
+        nodes (Dict[int, List[int]]): The available CPUs keyed by NUMA node
+    """
+    nodes: Dict[int, List[int]]
+
+    def __init__(self, nodes: Dict[int, List[int]]):
+        self.nodes = nodes
+
+    @classmethod
+    def discover(cls) -> "CpuTopology":
+        """Read the CPU topology from `/sys`, falling back to a single node.
+
+        Returns:
+            CpuTopology: The topology of the CPUs available to the worker.
+        """
+        allowed = os.sched_getaffinity(0)
+        nodes = dict()
+        for path in sorted(SYSFS_NODE.glob("node[0-9]*")):
+            if (cpulist := _read(path / "cpulist")) is None:
+                continue
+            if cpus := [i for i in parse_cpu_list(cpulist) if i in allowed]:
+                nodes[int(path.name[4:])] = cpus
+        if not nodes:
+            nodes = {0: sorted(allowed)}
+
+        def core(cpu: int) -> tuple:
+            topology = SYSFS_CPU / f"cpu{cpu}" / "topology"
+            return (
+                int(_read(topology / "physical_package_id") or 0),
+                int(_read(topology / "core_id") or cpu),
+                cpu,
+            )
+
+        return cls({k: sorted(v, key=core) for k, v in nodes.items()})
+
+    @property
+    def cpus(self) -> List[int]:
+        """Every available CPU.
+
+        Returns:
+            List[int]: The CPUs.
+        """
+        return [cpu for cpus in self.nodes.values() for cpu in cpus]
+
+
+class CpuAllocator:
+    """Assigns each job slot a fixed set of CPUs and pins encoder processes to it.
+
+    With at least as many NUMA nodes as job slots, each slot gets whole nodes.
+    Otherwise slots are spread over the nodes and share each node's CPUs
+    evenly, so no slot spans two nodes.
+
+    Attributes:
+        topology (CpuTopology): The CPUs available to the worker
+        enabled (bool): Whether encoder processes are pinned to their slot's CPUs
+        slots (Dict[int, List[int]]): The CPUs assigned to each job slot
+    """
+    topology: CpuTopology
+    enabled: bool
+    slots: Dict[int, List[int]]
+
+    def __init__(self, topology: CpuTopology, slots: int = 1, enabled: bool = False):
+        self.topology = topology
+        self.enabled = enabled
+        self.slots = self.allocate(topology, max(1, slots))
+
+    @staticmethod
+    def allocate(topology: CpuTopology, slots: int) -> Dict[int, List[int]]:
+        """Split the available CPUs between job slots.
+
+        Args:
+            topology (CpuTopology): The CPUs available to the worker
+            slots (int): The number of job slots
+
+        Returns:
+            Dict[int, List[int]]: The CPUs assigned to each job slot.
+        """
+        nodes = list(topology.nodes.values())
+        if slots <= len(nodes):
+            return {
+                i: sorted(cpu for cpus in nodes[i::slots] for cpu in cpus)
+                for i in range(slots)
+            }
+
+        allocation = dict()
+        for node, cpus in enumerate(nodes):
+            members = list(range(node, slots, len(nodes)))
+            share, extra = divmod(len(cpus), len(members))
+            start = 0
+            for position, slot in enumerate(members):
+                if size := share + (position < extra):
+                    allocation[slot] = sorted(cpus[start:start + size])
+                    start += size
+                else:
+                    allocation[slot] = [cpus[position % len(cpus)]]
+        return dict(sorted(allocation.items()))
+
+    def cpus(self, slot: int) -> List[int]:
+        """Return the CPUs assigned to a job slot.
+
+        Args:
+            slot (int): The index of the job slot
+
+        Returns:
+            List[int]: The assigned CPUs, or every available CPU if pinning is disabled.
+        """
+        if not self.enabled:
+            return self.topology.cpus
+        return self.slots.get(slot, self.topology.cpus)
+
+    def threads(self, slot: int) -> int:
+        """Return the number of encoder threads matching a job slot's CPUs.
+
+        Args:
+            slot (int): The index of the job slot
+
+        Returns:
+            int: The number of threads.
+        """
+        return len(self.cpus(slot))
+
+    @contextmanager
+    def pinned(self, slot: int) -> Iterator[None]:
+        """Pin the calling thread to a job slot's CPUs while it starts processes.
+
+        A new process inherits the affinity of the thread that started it, so
+        it (and every thread it starts) runs on the slot's CPUs from the first
+        instruction.  Afterwards the thread gets every available CPU back, so
+        overlapping uses on one thread (e.g. the event loop) always end unpinned.
+        Failures are logged and otherwise ignored.
+
+        Args:
+            slot (int): The index of the job slot
+        """
+        if not self.enabled:
+            yield
+            return
+        try:
+            os.sched_setaffinity(0, self.cpus(slot))
+        except OSError as e:
+            logger.debug(f"Could not set the CPU affinity for job slot {slot}: {e}")
+        try:
+            yield
+        finally:
+            try:
+                os.sched_setaffinity(0, self.topology.cpus)
+            except OSError as e:
+                logger.debug(f"Could not restore the CPU affinity: {e}")
+
+    def stats(self) -> dict:
+        """Return the CPU topology and the CPUs assigned to each job slot.
+
+        Returns:
+            dict: Whether `pinning` is enabled, the CPUs of every NUMA node, and the CPUs and thread count of every job slot.
+        """
+        return {
+            "pinning": self.enabled,
+            "nodes": {str(k): format_cpu_list(v) for k, v in self.topology.nodes.items()},
+            "slots": {
+                str(i): {
+                    "cpus": format_cpu_list(self.cpus(i)),
+                    "threads": self.threads(i),
+                } for i in self.slots
+            },
+        }
+
+
+cpus = CpuAllocator(
+    CpuTopology.discover(), slots=Config.MAX_CONCURRENT_JOBS, enabled=Config.CPU_PINNING)
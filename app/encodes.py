@@ -0,0 +1,215 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from loguru import logger
+
+from app.config import Config
+from app.fileops import TransferResult, link_file
+
+PathLike = Union[str, Path]
+
+# Blocks hashed from every source file for its fingerprint (spread evenly, first and last included)
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 1024 * 1024
+
+
+class EncodeCache:
+    """A content-addressed store of encode outputs, so that a requeued encode is not run again.
+
+    Outputs are keyed by a fingerprint of the sources (size, modification time,
+    and a hash of sampled blocks) and the fully resolved command, with the
+    source and output paths replaced by placeholders so that the same encode
+    from different (e.g. staged) paths still matches.  Outputs are stored in
+    `root/objects` as reflinks or hardlinks when the filesystem allows it and
+    indexed in a sqlite database; the least recently used outputs are evicted
+    once they take up more than `capacity` bytes.
+
+    Since a hardlinked output shares its inode with the cached copy, the size
+    and modification time of every entry are checked before it is used, and
+    entries that changed are discarded.
+
+    Attributes:
+        root (Path, optional): The cache directory, otherwise None (caching disabled).
+        capacity (int): The maximum number of bytes of cached outputs
+        counters (Dict[str, int]): The `hits`, `misses`, `stores`, and `evictions` counters
+    """
+    root: Optional[Path]
+    capacity: int
+    counters: Dict[str, int]
+
+    def __init__(self, root: Optional[str] = None, capacity: int = 100 * 1024 ** 3):
+        self.root = Path(root) if root else None
+        self.capacity = capacity
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the encode cache is enabled.
+
+        Returns:
+            bool: `True` if a cache directory is configured, otherwise `False`
+        """
+        return self.root is not None
+
+    @staticmethod
+    def fingerprint(path: PathLike) -> Optional[str]:
+        """Return a fast fingerprint of a file from its size, modification time, and sampled blocks.
+
+        Args:
+            path (PathLike): The file
+
+        Returns:
+            Optional[str]: The fingerprint, or None if the file cannot be read.
+        """
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                stat = Path(path).stat()
+                digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+                if stat.st_size <= SAMPLE_COUNT * SAMPLE_SIZE:
+                    while chunk := f.read(SAMPLE_SIZE):
+                        digest.update(chunk)
+                else:
+                    step = (stat.st_size - SAMPLE_SIZE) / (SAMPLE_COUNT - 1)
+                    for i in range(SAMPLE_COUNT):
+                        f.seek(int(i * step))
+                        digest.update(f.read(SAMPLE_SIZE))
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def key(self, kind: str, sources: Iterable[PathLike], command: Union[str, List[str]], output: PathLike) -> Optional[str]:
+        """Return the cache key of an encode.
+
+        Args:
+            kind (str): The kind of encode (e.g. `ffmpeg`)
+            sources (Iterable[PathLike]): The source files
+            command (Union[str, List[str]]): The fully resolved command
+            output (PathLike): The output file
+
+        Returns:
+            Optional[str]: The key, or None if a source cannot be read.
+        """
+        sources = [str(i) for i in sources]
+        fingerprints = [self.fingerprint(i) for i in sources]
+        if None in fingerprints:
+            return None
+        command = " ".join(str(i) for i in command) if isinstance(command, list) else command
+        placeholders = [(i, f"{{source{idx}}}") for idx, i in enumerate(sources)] + [(str(output), "{output}" + Path(output).suffix)]
+        # The output keeps its extension, as it picks the container when the command does not
+        # Longest paths first so a path that contains another is replaced whole
+        for path, placeholder in sorted(placeholders, key=lambda i: -len(i[0])):
+            command = command.replace(path, placeholder)
+        return hashlib.sha256(json.dumps([kind, fingerprints, command]).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / "objects" / key
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._db is None:
+            try:
+                (self.root / "objects").mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(self.root / "index.sqlite", check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS encodes "
+                    "(key TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, used_at REAL)")
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not open encode cache '{self.root}': {e}")
+                self.root = None
+                return None
+        return self._db
+
+    def _discard(self, db: sqlite3.Connection, key: str) -> None:
+        db.execute("DELETE FROM encodes WHERE key = ?", (key,))
+        self._path(key).unlink(missing_ok=True)
+
+    def restore(self, key: str, output: Path) -> Optional[TransferResult]:
+        """Materialize a cached output at the output path.
+
+        Args:
+            key (str): The cache key of the encode
+            output (Path): The output file of the encode
+
+        Returns:
+            Optional[TransferResult]: How the output was materialized, or None if the encode is not cached.
+        """
+        with self._lock:
+            if not (db := self._connect()):
+                return None
+            try:
+                row = db.execute(
+                    "SELECT size, mtime_ns FROM encodes WHERE key = ?", (key,)).fetchone()
+                try:
+                    stat = self._path(key).stat() if row else None
+                except FileNotFoundError:
+                    stat = None
+                if row and (not stat or (stat.st_size, stat.st_mtime_ns) != tuple(row)):
+                    logger.warning(f"Cached output {key} is missing or changed since it was stored, discarding it.")
+                    self._discard(db, key)
+                    row = None
+                if row:
+                    db.execute("UPDATE encodes SET used_at = ? WHERE key = ?", (time.time(), key))
+                db.commit()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not read encode cache: {e}")
+                row = None
+            self.counters["hits" if row else "misses"] += 1
+        if not row:
+            return None
+        try:
+            output.parent.mkdir(parents=True, exist_ok=True)
+            return link_file(self._path(key), output)
+        except OSError as e:
+            logger.warning(f"Could not restore cached output to '{output}': {e}")
+            return None
+
+    def store(self, key: str, output: Path) -> None:
+        """Add the output of a finished encode to the cache, evicting the least recently used outputs if needed.
+
+        Args:
+            key (str): The cache key of the encode
+            output (Path): The output file of the encode
+        """
+        with self._lock:
+            if not (db := self._connect()):
+                return
+            try:
+                if output.stat().st_size > self.capacity:
+                    return
+                result = link_file(output, self._path(key))
+                stat = self._path(key).stat()
+                db.execute("INSERT OR REPLACE INTO encodes VALUES (?, ?, ?, ?)",
+                           (key, stat.st_size, stat.st_mtime_ns, time.time()))
+                used = 0
+                for old_key, size in db.execute(
+                        "SELECT key, size FROM encodes ORDER BY used_at DESC").fetchall():
+                    used += size
+                    if used > self.capacity:
+                        self._discard(db, old_key)
+                        self.counters["evictions"] += 1
+                db.commit()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not store output '{output}' in the encode cache: {e}")
+                return
+            self.counters["stores"] += 1
+        logger.debug(f"Stored '{output}' in the encode cache ({result})")
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache counters.
+
+        Returns:
+            Dict[str, int]: The `hits`, `misses`, `stores`, and `evictions` counters.
+        """
+        with self._lock:
+            return dict(self.counters)
+
+
+encodes = EncodeCache(
+    Config.ENCODE_CACHE_DIR, capacity=int(Config.ENCODE_CACHE_CAPACITY * 1024 ** 3))
@@ -29,6 +29,13 @@ class CleanupError(Error):
     def __init__(self, message):
         self.message = message
 
+class StagingError(Error):
+    """Could not stage files to or from the scratch space."""
+
+    def __init__(self, message):
+        self.message = message
+
+
 class NetworkError(Error):
     """Could not connect to the network resource"""
     
@@ -0,0 +1,120 @@
+import threading
+from typing import Callable, List, Optional, Union
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.heartbeat import Heartbeat, HeartbeatSlot
+from app.jobs import run_job
+from app.prefetch import Prefetcher
+
+
+class JobSlot:
+    """A single job slot on the worker that runs one job at a time.
+
+    Attributes:
+        index (int): The index of the job slot on the worker
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
+        thread (threading.Thread, optional): The thread running the current job, otherwise None.
+        prefetcher (Prefetcher, optional): Prefetches the next job while a job finishes, otherwise None.
+    """
+    index: int
+    heartbeat: HeartbeatSlot
+    thread: Optional[threading.Thread]
+    prefetcher: Optional[Prefetcher]
+
+    def __init__(self, index: int, heartbeat: HeartbeatSlot):
+        self.index = index
+        self.heartbeat = heartbeat
+        self.thread = None
+        self.prefetcher = Prefetcher(index) if Config.PREFETCH_JOBS else None
+
+
+class SlotExecutor:
+    """Runs up to a fixed number of jobs in parallel, one per job slot.
+
+    Attributes:
+        slots (List[JobSlot]): Every job slot on the worker
+        free (List[JobSlot]): The job slots that are not running a job
+        on_finished (Callable[[], None], optional): Called every time a job finishes, otherwise None.
+    """
+    slots: List[JobSlot]
+    free: List[JobSlot]
+    on_finished: Optional[Callable[[], None]]
+
+    def __init__(self, heartbeat: Heartbeat, on_finished: Optional[Callable[[], None]] = None):
+        """Initializes one job slot per heartbeat slot.
+
+        Args:
+            heartbeat (Heartbeat): The heartbeat used to report status for every job slot.
+            on_finished (Callable[[], None], optional): Called every time a job finishes. Defaults to None.
+        """
+        self.slots = [JobSlot(i.index, i) for i in heartbeat.slots]
+        self.free = list(self.slots)
+        self.on_finished = on_finished
+        self._condition = threading.Condition()
+
+    def wait(self) -> None:
+        """Block until at least one job slot is free.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.free)
+
+    def acquire(self) -> JobSlot:
+        """Wait for a job slot to become free and reserve it.
+
+        Returns:
+            JobSlot: The reserved job slot.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.free)
+            return self.free.pop(0)
+
+    def release(self, slot: JobSlot) -> None:
+        """Return a reserved job slot to the pool of free slots.
+
+        Args:
+            slot (JobSlot): The job slot to release.
+        """
+        with self._condition:
+            slot.thread = None
+            self.free.append(slot)
+            self.free.sort(key=lambda i: i.index)
+            self._condition.notify()
+
+    def submit(self, slot: JobSlot, data: Union[dict, Box]) -> None:
+        """Run a job in the background on a reserved job slot.
+
+        Args:
+            slot (JobSlot): The job slot reserved with `acquire`.
+            data (Union[dict, Box]): The job data pulled off of the queue.
+        """
+        slot.thread = threading.Thread(
+            target=self._run, args=(slot, data), daemon=True)
+        slot.thread.start()
+
+    def shutdown(self) -> None:
+        """Stop prefetching on every job slot, dropping any prefetched job that has not been started.
+        """
+        for slot in self.slots:
+            if slot.prefetcher:
+                slot.prefetcher.release()
+
+    def _run(self, slot: JobSlot, data: Union[dict, Box]) -> None:
+        try:
+            modules, staged = None, None
+            while data:
+                run_job(data, slot.heartbeat, modules=modules,
+                        prefetcher=slot.prefetcher, staged=staged)
+                if not slot.prefetcher or not (prefetched := slot.prefetcher.take()):
+                    break
+                data, modules, staged = prefetched.data, prefetched.modules, prefetched.staged
+        except Exception as e:
+            logger.exception(
+                f"Unhandled error in job slot {slot.index}: {e}")
+            slot.heartbeat.set_idle()
+        finally:
+            self.release(slot)
+            if self.on_finished:
+                self.on_finished()
@@ -0,0 +1,442 @@
+import errno
+import fcntl
+import functools
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+# ioctl request to clone a file's extents (btrfs, XFS with reflink, etc.)
+FICLONE = 0x40049409
+
+# errno values meaning "this copy strategy is not available here, try the next one"
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Bytes hashed (and written) per step when computing checksums
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Called with the number of bytes copied since the last call
+Callback = Optional[Callable[[int], None]]
+
+
+class Throttle:
+    """A token bucket limiting the combined rate of every transfer sharing it.
+
+    Attributes:
+        rate (float): The maximum number of bytes per second
+    """
+    rate: float
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        """Wait until `size` bytes may be transferred.
+
+        Args:
+            size (int): The number of bytes about to be transferred
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(
+                self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= size
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class TransferResult:
+    """The outcome of a file copy or move.
+
+    Attributes:
+        source (Path): The source path
+        destination (Path): The destination path
+        strategy (str): How the data was transferred (`rename`, `hardlink`, `reflink`, `copy_file_range`, `sendfile`, `buffered`)
+        size (int): The number of bytes transferred
+        seconds (float): The time the transfer took
+        checksum (str, optional): The checksum of the file as `<algorithm>:<hex digest>`, if one was requested.
+    """
+    source: Path
+    destination: Path
+    strategy: str
+    size: int
+    seconds: float
+    checksum: Optional[str]
+
+    def __init__(self, source: Path, destination: Path, strategy: str, size: int, seconds: float, checksum: Optional[str] = None):
+        self.source = source
+        self.destination = destination
+        self.strategy = strategy
+        self.size = size
+        self.seconds = seconds
+        self.checksum = checksum
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """The transfer rate in MiB/s, or None if no data was copied (e.g. a rename).
+
+        Returns:
+            Optional[float]: The transfer rate.
+        """
+        if self.strategy in ("rename", "hardlink") or self.seconds <= 0:
+            return None
+        return self.size / self.seconds / 1024 / 1024
+
+    def as_dict(self) -> dict:
+        throughput = self.throughput
+        data = {
+            "source": str(self.source),
+            "destination": str(self.destination),
+            "strategy": self.strategy,
+            "size": self.size,
+            "seconds": round(self.seconds, 3),
+            "throughput": round(throughput, 2) if throughput else None,
+        }
+        if self.checksum:
+            data["checksum"] = self.checksum
+        return data
+
+    def __str__(self) -> str:
+        throughput = self.throughput
+        rate = f"{throughput:.1f} MiB/s" if throughput else "instant"
+        return f"{self.strategy}, {self.size} bytes, {rate}"
+
+
+class ChecksumMismatch(OSError):
+    """The data read back from a written file does not match what was written."""
+
+
+def checksum_supported(algorithm: str) -> bool:
+    """Check whether a checksum algorithm can be used (e.g. `sha256`, `md5`, `blake2b`).
+
+    Args:
+        algorithm (str): The `hashlib` algorithm name
+
+    Returns:
+        bool: `True` if the algorithm is available, otherwise `False`
+    """
+    return algorithm in hashlib.algorithms_available and not algorithm.startswith("shake")
+
+
+def hash_file(path: Path, algorithm: str, uncached: bool = False) -> str:
+    """Compute the checksum of a file, reading it through a memory map.
+
+    Args:
+        path (Path): The file
+        algorithm (str): The `hashlib` algorithm name (e.g. `sha256`)
+        uncached (bool, optional): Whether to flush the file and drop it from the page cache first, so the data is read back from storage. Defaults to False.
+
+    Raises:
+        OSError: The file could not be read.
+
+    Returns:
+        str: The checksum as `<algorithm>:<hex digest>`.
+    """
+    digest = hashlib.new(algorithm)
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if uncached:
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+    return f"{algorithm}:{digest.hexdigest()}"
+
+
+def resolve_destination(source: Path, destination: Path) -> Path:
+    """Return the destination file path, placing the file inside the destination if it is a directory.
+
+    Args:
+        source (Path): The source file
+        destination (Path): The destination file or directory
+
+    Returns:
+        Path: The destination file path.
+    """
+    if destination.is_dir():
+        return destination / source.name
+    return destination
+
+
+def same_filesystem(source: Path, destination: Path) -> bool:
+    """Check whether a file can be renamed to the destination (same device).
+
+    Args:
+        source (Path): The source file
+        destination (Path): The destination file path
+
+    Returns:
+        bool: `True` if both are on the same device, otherwise `False`
+    """
+    try:
+        return source.stat().st_dev == destination.parent.stat().st_dev
+    except OSError:
+        return False
+
+
+def _reflink(src_fd: int, dest_fd: int, size: int, chunk_size: int, callback: Callback) -> bool:
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+    if callback:
+        callback(size)
+    return True
+
+
+def _copy_file_range(src_fd: int, dest_fd: int, size: int, chunk_size: int, callback: Callback) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            copied = os.copy_file_range(src_fd, dest_fd, min(chunk_size, size - offset))
+        except OSError as e:
+            if offset == 0 and e.errno in UNSUPPORTED:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0:
+                return False
+            raise OSError(f"The source file ended after {offset} of {size} bytes")
+        offset += copied
+        if callback:
+            callback(copied)
+    return True
+
+
+def _sendfile(src_fd: int, dest_fd: int, size: int, chunk_size: int, callback: Callback) -> bool:
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(dest_fd, src_fd, offset, min(chunk_size, size - offset))
+        except OSError as e:
+            if offset == 0 and e.errno in UNSUPPORTED:
+                return False
+            raise
+        if sent == 0:
+            if offset == 0:
+                return False
+            raise OSError(f"The source file ended after {offset} of {size} bytes")
+        offset += sent
+        if callback:
+            callback(sent)
+    return True
+
+
+def _hashed(src_fd: int, dest_fd: int, size: int, chunk_size: int, callback: Callback, digest) -> bool:
+    if not size:
+        return True
+    with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as mapped:
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+        step = min(chunk_size, HASH_CHUNK_SIZE)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, step):
+                with view[offset:offset + step] as chunk:
+                    digest.update(chunk)
+                    written = 0
+                    while written < len(chunk):
+                        written += os.write(dest_fd, chunk[written:])
+                if callback:
+                    callback(written)
+    return True
+
+
+def _buffered(src_fd: int, dest_fd: int, size: int, chunk_size: int, callback: Callback) -> bool:
+    while chunk := os.read(src_fd, min(chunk_size, 8 * 1024 * 1024)):
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dest_fd, view):]
+        if callback:
+            callback(len(chunk))
+    return True
+
+
+def _temp_path(destination: Path) -> Path:
+    # Next to the destination (same filesystem) so it can be renamed into place
+    return destination.with_name(f".{destination.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+STRATEGIES = [
+    ("reflink", _reflink),
+    ("copy_file_range", _copy_file_range),
+    ("sendfile", _sendfile),
+    ("buffered", _buffered),
+]
+
+
+def copy_file(source: Path, destination: Path, callback: Callback = None, throttle: Optional[Throttle] = None, checksum: Optional[str] = None, verify: bool = False) -> TransferResult:
+    """Copy a file with its metadata (like `shutil.copy2`) using the fastest strategy available.
+
+    A reflink clone is tried first, then `copy_file_range`, then `sendfile`,
+    and finally a plain buffered copy.  Reflinks are never throttled since
+    they move no data.
+
+    With a checksum algorithm, data that has to be copied is read through a
+    memory map and hashed on its way to the destination instead of using the
+    in-kernel copies, so the destination never has to be read back.  A
+    reflink clone is hashed from the source (same filesystem) afterwards.
+
+    The file is copied to a temporary file next to the destination that
+    replaces it once the copy (and its verification) succeeded, so a failed
+    copy leaves an existing destination untouched.
+
+    Args:
+        source (Path): The source file
+        destination (Path): The destination file or directory
+        callback (Callable[[int], None], optional): Called with the number of bytes copied after every chunk. Defaults to None.
+        throttle (Throttle, optional): Limits the transfer rate. Defaults to None.
+        checksum (str, optional): The `hashlib` algorithm to compute the checksum of the file with. Defaults to None.
+        verify (bool, optional): Whether to read the destination back from storage and compare checksums. Defaults to False.
+
+    Raises:
+        ChecksumMismatch: The destination does not match the source (`verify` only).
+        OSError: The file could not be copied (or the source and destination are the same file).
+
+    Returns:
+        TransferResult: The strategy used, the size, and the time taken.
+    """
+    destination = resolve_destination(source, destination)
+    chunk_size, copy_callback = CHUNK_SIZE, callback
+    if throttle:
+        chunk_size = max(1024 * 1024, min(CHUNK_SIZE, int(throttle.rate / 4)))
+
+        def copy_callback(size: int) -> None:
+            throttle.consume(size)
+            if callback:
+                callback(size)
+
+    strategies = STRATEGIES
+    if checksum:
+        digest = hashlib.new(checksum)
+        strategies = [STRATEGIES[0], ("mmap", functools.partial(_hashed, digest=digest))]
+
+    if destination.exists() and os.path.samefile(source, destination):
+        raise OSError(errno.EINVAL, "Source and destination are the same file", str(destination))
+
+    start = time.monotonic()
+    temp_path = _temp_path(destination)
+    try:
+        with source.open("rb") as src, temp_path.open("wb") as dest:
+            size = os.fstat(src.fileno()).st_size
+            for strategy, func in strategies:
+                if func(src.fileno(), dest.fileno(), size, chunk_size,
+                        callback if strategy == "reflink" else copy_callback):
+                    break
+        shutil.copystat(source, temp_path)
+        if checksum:
+            checksum = f"{checksum}:{digest.hexdigest()}" if strategy == "mmap" else hash_file(source, checksum)
+            if verify and hash_file(temp_path, checksum.split(":")[0], uncached=True) != checksum:
+                raise ChecksumMismatch(errno.EIO, "Checksum mismatch after copy", str(destination))
+        os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return TransferResult(source, destination, strategy, size, time.monotonic() - start, checksum)
+
+
+def link_file(source: Path, destination: Path) -> TransferResult:
+    """Make a file available at another path, sharing its data instead of copying it when possible.
+
+    A reflink clone is tried first (the files stay independent), then a
+    hardlink (the files are the same inode), and finally a full copy.  An
+    existing destination is replaced.
+
+    Args:
+        source (Path): The source file
+        destination (Path): The destination file
+
+    Raises:
+        OSError: The file could not be linked or copied.
+
+    Returns:
+        TransferResult: The strategy used (`reflink`, `hardlink`, or a copy strategy), the size, and the time taken.
+    """
+    start = time.monotonic()
+    if destination.exists() and os.path.samefile(source, destination):
+        return TransferResult(source, destination, "hardlink", source.stat().st_size, 0)
+    temp_path = _temp_path(destination)
+    try:
+        with source.open("rb") as src, temp_path.open("wb") as dest:
+            size = os.fstat(src.fileno()).st_size
+            strategy = "reflink" if _reflink(src.fileno(), dest.fileno(), size, CHUNK_SIZE, None) else None
+        if strategy:
+            shutil.copystat(source, temp_path)
+        else:
+            temp_path.unlink()
+            try:
+                os.link(source, temp_path)
+                strategy = "hardlink"
+            except OSError as e:
+                if e.errno not in UNSUPPORTED | {errno.EMLINK}:
+                    raise
+                strategy = copy_file(source, temp_path).strategy
+        os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return TransferResult(source, destination, strategy, size, time.monotonic() - start)
+
+
+def move_file(source: Path, destination: Path, callback: Callback = None, throttle: Optional[Throttle] = None, checksum: Optional[str] = None, verify: bool = False) -> TransferResult:
+    """Move a file, using an atomic rename when the destination is on the same filesystem.
+
+    Directories can only be moved by renaming (and are not checksummed).  When
+    the file has to be copied, the source is only removed after the copy (and
+    its verification) succeeded.
+
+    Args:
+        source (Path): The source file
+        destination (Path): The destination file or directory
+        callback (Callable[[int], None], optional): Called with the number of bytes moved. Defaults to None.
+        throttle (Throttle, optional): Limits the transfer rate when the file has to be copied. Defaults to None.
+        checksum (str, optional): The `hashlib` algorithm to compute the checksum of the file with. Defaults to None.
+        verify (bool, optional): Whether to read a copied destination back from storage and compare checksums. Defaults to False.
+
+    Raises:
+        ChecksumMismatch: The copied destination does not match the source (`verify` only).
+        OSError: The file could not be moved.
+
+    Returns:
+        TransferResult: The strategy used, the size, and the time taken.
+    """
+    destination = resolve_destination(source, destination)
+    if same_filesystem(source, destination):
+        start = time.monotonic()
+        size = source.stat().st_size
+        try:
+            os.rename(source, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        else:
+            if callback:
+                callback(size)
+            if checksum and destination.is_file():
+                checksum = hash_file(destination, checksum)
+            else:
+                checksum = None
+            return TransferResult(source, destination, "rename", size, time.monotonic() - start, checksum)
+
+    result = copy_file(source, destination, callback=callback, throttle=throttle,
+                       checksum=checksum, verify=verify)
+    source.unlink()
+    return result
@@ -0,0 +1,71 @@
+from typing import List, Set, Union
+
+from box import Box
+
+from app.exceptions import ValidationError
+from app.streams import JobStreams
+
+
+class TaskGraph:
+    """The order in which the tasks of a job run.
+
+    By default every task depends on the task before it, so the tasks run one
+    at a time in list order.  A task can instead list the (zero-based) indexes
+    of the earlier tasks it needs with `depends_on` next to its `module` and
+    `data`, e.g. `[]` to start with the job or `[0, 1, 2]` to wait for the
+    first three tasks.  Tasks that stream to each other are scheduled as one
+    group that waits for the dependencies of all of its tasks.
+
+    Attributes:
+        groups (List[List[int]]): The indexes of the tasks of the job, grouped by the tasks that start together
+        dependencies (List[Set[int]]): The indexes of the groups each group waits for
+    """
+    groups: List[List[int]]
+    dependencies: List[Set[int]]
+
+    def __init__(self, data: Union[dict, Box], streams: JobStreams):
+        """Find the dependencies between the tasks of a job.
+
+        Args:
+            data (Union[dict, Box]): The job data
+            streams (JobStreams): The streams between the tasks of the job
+
+        Raises:
+            ValidationError: A task depends on a task that is not before it.
+        """
+        data = Box(data)
+        self.groups = streams.groups
+        group_of = {idx: group for group, tasks in enumerate(self.groups) for idx in tasks}
+        self.dependencies = [set() for _ in self.groups]
+        for idx, task in enumerate(data.tasks):
+            depends_on = task.get("depends_on", [idx - 1] if idx else [])
+            if not isinstance(depends_on, list) or not all(
+                    isinstance(i, int) and not isinstance(i, bool) and 0 <= i < idx for i in depends_on):
+                raise ValidationError(
+                    f"Task {idx + 1} can only depend on the indexes of earlier tasks: {depends_on}")
+            self.dependencies[group_of[idx]] |= {group_of[i] for i in depends_on} - {group_of[idx]}
+
+    @property
+    def concurrent(self) -> bool:
+        """Whether several tasks of the job can run at once.
+
+        Returns:
+            bool: `True` if tasks stream to each other or do not all wait for the task before them, otherwise `False`
+        """
+        return any(len(i) > 1 for i in self.groups) or any(
+            group - 1 not in dependencies for group, dependencies in enumerate(self.dependencies) if group)
+
+    def ready(self, done: Set[int], started: Set[int]) -> List[int]:
+        """Return the groups that can start.
+
+        Args:
+            done (Set[int]): The indexes of the groups that finished
+            started (Set[int]): The indexes of the groups that were started
+
+        Returns:
+            List[int]: The indexes of the groups whose dependencies finished, in job order.
+        """
+        return [
+            group for group, dependencies in enumerate(self.dependencies)
+            if group not in started and dependencies <= done
+        ]
@@ -1,104 +1,410 @@
+import asyncio
 import logging
 import threading
 import time
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
-import requests
 import urllib3
 from box import Box
 from loguru import logger
 
+from app.api import api
 from app.config import Config
 
 
-class Heartbeat:
-    """The heartbeat class used to communicate status back to the central API server.
+class HeartbeatSlot:
+    """The status of a single job slot on the worker.
+
+    Status updates are published by swapping in a new, fully-built message, so
+    the heartbeat sender never sees a half-updated status.
 
     Attributes:
-        endpoint (str): The URL to used to send updates to the API server
-        interval (int): The number of seconds between sending updates back to the API server
+        index (int): The index of the job slot on the worker
         job_id (str, optional): If processing a job, the `job_id` in progress, otherwise None.
         job_title (str, optional): If processing a job, the `job_title` in progress, otherwise None.
-        thread (threading.Thread): The thread used to send updates to the API server in the background.
+        message (dict): The current status data for the job slot.  Never modified once published.
+        on_change (Callable[[bool], None], optional): Called after every update with whether the status changed.
     """
-    interval: int
-    endpoint: str
+    index: int
     job_id: Optional[str]
     job_title: Optional[str]
-    thread: threading.Thread
-    start_time: Optional[datetime]
+    message: dict
+    on_change: Optional[Callable[[bool], None]]
 
-    def __init__(self, interval: int = 10):
-        """Initializes the instance based on the provided interval.
+    def __init__(self, index: int = 0, on_change: Optional[Callable[[bool], None]] = None):
+        """Initializes the job slot status.
 
         Args:
-            interval (int, optional): The number of seconds between sending updates back to the API server. Defaults to 10.
+            index (int, optional): The index of the job slot on the worker. Defaults to 0.
+            on_change (Callable[[bool], None], optional): Called after every update with whether the status changed. Defaults to None.
         """
-        self.interval = interval
-        self.endpoint = Config.API_URL + '/workers/' + Config.HOST_UUID
+        self.index = index
         self.job_id = None
         self.job_title = None
-        self.start_time = None
+        self.message = dict()
+        self.on_change = on_change
+        self._tasks = dict()
+        self._tasks_lock = threading.Lock()
         self.set_idle()
-        self.thread = threading.Thread(target=self.send_heartbeat)
-        self.thread.daemon = True
 
-    def start(self) -> None:
-        """Start the background thread to send updates to the API server.
+    @property
+    def busy(self) -> bool:
+        """Whether the job slot is currently processing a job.
+
+        Returns:
+            bool: `True` if a job is in progress, otherwise `False`
         """
-        self.start_time = datetime.now(tz=Config.API_TIMEZONE)
-        self.thread.start()
+        return self.message.get("status") == "in_progress"
 
     def set_data(self, data: dict) -> None:
-        """Update the heartbeat status data sent to the API server.
+        """Update the status data for the job slot.
+
+        The data is copied (two levels deep), so the caller can keep updating
+        its own status object afterwards.
 
         Args:
             data (dict): The data to include in the status message
         """
-        data = Box(data)
-        data.hostname = Config.HOSTNAME
-        data.version = Config.VERSION
-        data.online_at = str(self.start_time)
+        message = {
+            k: dict(v) if isinstance(v, dict) else v for k, v in data.items()
+        }
         if self.job_id:
-            data.job_id = self.job_id
+            message["job_id"] = self.job_id
         if self.job_title:
-            data.job_title = self.job_title
-        self.message = data
+            message["job_title"] = self.job_title
+        previous, self.message = self.message, message
+        if self.on_change:
+            self.on_change(previous.get("status") != message.get("status"))
+
+    def task(self, idx: int) -> "TaskHeartbeat":
+        """Return the status of a task that runs alongside other tasks of the job.
+
+        Args:
+            idx (int): The index of the task in the job
+
+        Returns:
+            TaskHeartbeat: The task status.
+        """
+        return TaskHeartbeat(self, idx)
+
+    def set_task_data(self, idx: int, data: Optional[dict]) -> None:
+        """Update the status of one of several tasks running at once in the job slot.
+
+        The job slot status is the status of the first running task, with the
+        `progress` averaged over the running tasks that report one, and the
+        status of every running task listed under `tasks`.
+
+        Args:
+            idx (int): The index of the task in the job
+            data (dict, optional): The status data of the task, or None once the task finished.
+        """
+        with self._tasks_lock:
+            if data is None:
+                self._tasks.pop(idx, None)
+            else:
+                self._tasks[idx] = {
+                    k: dict(v) if isinstance(v, dict) else v for k, v in data.items()
+                }
+            if not self._tasks:
+                return
+            tasks = [self._tasks[i] | {"index": i} for i in sorted(self._tasks)]
+            message = dict(self._tasks[min(self._tasks)])
+            progress = [i["progress"] for i in tasks if i.get("progress") is not None]
+            if progress:
+                message["progress"] = round(sum(progress) / len(progress), 2)
+            message["tasks"] = tasks
+            self.set_data(message)
 
     def set_idle(self) -> None:
-        """Update the heartbeat status to idle.
+        """Update the job slot status to idle.
         """
+        with self._tasks_lock:
+            self._tasks = dict()
         self.job_id = None
         self.job_title = None
         self.set_data({"status": "idle"})
 
     def set_startup(self) -> None:
-        """Update the heartbeat status to startup.
+        """Update the job slot status to startup.
         """
         self.job_id = None
         self.job_title = None
         self.set_data({"status": "startup"})
 
     def set_in_progress(self, data: dict) -> None:
-        """Update the heartbeat status to in progress using the provided data.
+        """Update the job slot status to in progress using the provided data.
 
         Args:
             data (dict): The data to send to the central API server.
         """
         status = {"status": "in_progress"}
         data = data | status
+        with self._tasks_lock:
+            self._tasks = dict()
         self.set_data(data)
 
+
+class TaskHeartbeat:
+    """The status of one task of a job that runs alongside other tasks in the same job slot.
+
+    Task modules use it in place of the job slot; their updates are merged
+    into the job slot status by `HeartbeatSlot.set_task_data`.
+
+    Attributes:
+        slot (HeartbeatSlot): The job slot the task runs in
+        task_index (int): The index of the task in the job
+    """
+    slot: HeartbeatSlot
+    task_index: int
+
+    def __init__(self, slot: HeartbeatSlot, task_index: int):
+        self.slot = slot
+        self.task_index = task_index
+
+    @property
+    def index(self) -> int:
+        """The index of the job slot on the worker.
+
+        Returns:
+            int: The index.
+        """
+        return self.slot.index
+
+    @property
+    def message(self) -> dict:
+        """The current status data for the job slot.
+
+        Returns:
+            dict: The status data.
+        """
+        return self.slot.message
+
+    def set_data(self, data: dict) -> None:
+        """Update the status data of the task.
+
+        Args:
+            data (dict): The data to include in the status message
+        """
+        self.slot.set_task_data(self.task_index, data)
+
+    def clear(self) -> None:
+        """Remove the task from the job slot status once it finished.
+        """
+        self.slot.set_task_data(self.task_index, None)
+
+
+class Heartbeat:
+    """The heartbeat class used to communicate status back to the central API server.
+
+    Updates are coalesced instead of sent on a fixed schedule.  A status change
+    (e.g. idle to in progress) is sent right away, other updates (e.g. progress)
+    at most once every `interval` seconds, and when nothing changes the full
+    message is resent every `keepalive` seconds.  If `deltas` is enabled,
+    progress-only updates only send the fields that changed.
+
+    Attributes:
+        endpoint (str): The API path used to send updates to the API server
+        interval (int): The minimum number of seconds between progress updates sent to the API server
+        keepalive (float): The number of seconds between sending unchanged status messages
+        deltas (bool): Whether to send only the changed fields of progress-only updates (`PATCH`)
+        slots (List[HeartbeatSlot]): The status of every job slot on the worker.
+        stats (Dict[str, Callable[[], dict]]): Functions returning worker statistics to include in the status message.
+        thread (threading.Thread): The thread used to send updates to the API server in the background.
+    """
+    interval: int
+    keepalive: float
+    deltas: bool
+    endpoint: str
+    slots: List[HeartbeatSlot]
+    stats: Dict[str, Callable[[], dict]]
+    thread: threading.Thread
+    start_time: Optional[datetime]
+
+    def __init__(self, interval: int = 10, slots: int = 1, keepalive: Optional[float] = None, deltas: bool = False):
+        """Initializes the instance based on the provided interval.
+
+        Args:
+            interval (int, optional): The minimum number of seconds between progress updates. Defaults to 10.
+            slots (int, optional): The number of job slots to report on. Defaults to 1.
+            keepalive (float, optional): The number of seconds between sending unchanged status messages. Defaults to `interval`.
+            deltas (bool, optional): Whether to send only the changed fields of progress-only updates. Defaults to False.
+        """
+        self.interval = interval
+        self.keepalive = keepalive if keepalive is not None else interval
+        self.deltas = deltas
+        self.endpoint = '/workers/' + Config.HOST_UUID
+        self.start_time = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._loop = None
+        self._async_wake = None
+        self._changed = False
+        self._transition = True
+        self._last_sent = None
+        self._last_message = None
+        self.slots = [HeartbeatSlot(i, self.notify) for i in range(max(1, slots))]
+        self.stats = dict()
+        self.thread = threading.Thread(target=self.send_heartbeat)
+        self.thread.daemon = True
+
+    def start(self) -> None:
+        """Start the background thread to send updates to the API server.
+        """
+        self.start_time = datetime.now(tz=Config.API_TIMEZONE)
+        self.thread.start()
+
+    def slot(self, index: int = 0) -> HeartbeatSlot:
+        """Return the status object for a given job slot.
+
+        Args:
+            index (int, optional): The index of the job slot. Defaults to 0.
+
+        Returns:
+            HeartbeatSlot: The job slot status.
+        """
+        return self.slots[index]
+
+    def add_stats(self, name: str, func: Callable[[], dict]) -> None:
+        """Include worker statistics in every status message under `stats`.
+
+        Args:
+            name (str): The key to report the statistics under
+            func (Callable[[], dict]): A function returning the current statistics
+        """
+        self.stats[name] = func
+
+    @property
+    def message(self) -> Box:
+        """Build the status message sent to the API server.
+
+        With a single job slot the message is the status of that slot.  With
+        multiple job slots, the top-level status mirrors the first busy slot
+        and every slot is listed under `slots`.
+
+        Returns:
+            Box: The status message.
+        """
+        messages = [i.message for i in self.slots]
+        busy = [i for i in messages if i.get("status") == "in_progress"]
+        data = Box((busy[0] if busy else messages[0]))
+        if len(self.slots) > 1:
+            data.slots = [
+                Box(message, slot=i) for i, message in enumerate(messages)
+            ]
+        data.hostname = Config.HOSTNAME
+        data.version = Config.VERSION
+        data.online_at = str(self.start_time)
+        if self.stats:
+            data.stats = {k: v() for k, v in self.stats.items()}
+        return data
+
+    def set_data(self, data: dict) -> None:
+        """Update the status data of the first job slot.
+
+        Args:
+            data (dict): The data to include in the status message
+        """
+        self.slots[0].set_data(data)
+
+    def set_idle(self) -> None:
+        """Update the status of every job slot to idle.
+        """
+        for slot in self.slots:
+            slot.set_idle()
+
+    def set_startup(self) -> None:
+        """Update the status of every job slot to startup.
+        """
+        for slot in self.slots:
+            slot.set_startup()
+
+    def set_in_progress(self, data: dict) -> None:
+        """Update the status of the first job slot to in progress using the provided data.
+
+        Args:
+            data (dict): The data to send to the central API server.
+        """
+        self.slots[0].set_in_progress(data)
+
+    def notify(self, transition: bool = False) -> None:
+        """Wake the sender after a job slot status update.
+
+        Args:
+            transition (bool, optional): Whether the status changed (e.g. idle to in progress), which is sent right away. Defaults to False.
+        """
+        with self._lock:
+            self._changed = True
+            self._transition = self._transition or transition
+        self._wake.set()
+        if self._loop:
+            try:
+                self._loop.call_soon_threadsafe(self._async_wake.set)
+            except RuntimeError:
+                pass
+
+    def next_update(self) -> Tuple[Optional[str], float]:
+        """Decide whether a message is due.
+
+        Returns:
+            Tuple[Optional[str], float]: The kind of message to send now (`full` or `update`, None if nothing is due) and otherwise the number of seconds until one is.
+        """
+        with self._lock:
+            if self._transition or self._last_sent is None:
+                return "full", 0
+            since = time.monotonic() - self._last_sent
+            if self._changed:
+                if since >= self.interval:
+                    return "update", 0
+                return None, self.interval - since
+            if since >= self.keepalive:
+                return "full", 0
+            return None, self.keepalive - since
+
+    def send_message(self, kind: str = "full") -> bool:
+        """Send the current status message to the API server once.
+
+        Args:
+            kind (str, optional): `full` to send the whole message, or `update` to send only the changed fields when `deltas` is enabled. Defaults to `full`.
+
+        Returns:
+            bool: `True` if the message was sent, otherwise `False`
+        """
+        with self._lock:
+            self._changed = False
+            self._transition = False
+        message = self.message
+        method, payload = "POST", message
+        if kind == "update" and self.deltas and self._last_message:
+            method = "PATCH"
+            payload = {
+                k: v for k, v in message.items()
+                if k != "stats" and self._last_message.get(k) != v
+            }
+        logger.debug(f"Sending status message: {payload}")
+        try:
+            api.request(method, self.endpoint, json=payload)
+        except Exception:
+            with self._lock:
+                self._transition = True
+            return False
+        with self._lock:
+            self._last_sent = time.monotonic()
+        self._last_message = message
+        return True
+
     def send_heartbeat(self) -> None:
         """Send the heartbeat to the API server.
         """
         connect_issue = False
         while True:
-            logger.debug(f"Sending status message: {self.message}")
-            try:
-                requests.post(self.endpoint, json=self.message, timeout=2)
-            except Exception:
+            self._wake.clear()
+            kind, wait = self.next_update()
+            if not kind:
+                self._wake.wait(wait)
+                continue
+
+            if not self.send_message(kind):
                 if not connect_issue:
                     logger.warning("Failed to send heartbeat to API server!")
                 connect_issue = True
@@ -106,7 +412,39 @@ class Heartbeat:
                 continue
 
             connect_issue = False
-            time.sleep(self.interval)
+
+    async def run_async(self) -> None:
+        """Send the heartbeat to the API server from the event loop until cancelled.
+        """
+        self.start_time = datetime.now(tz=Config.API_TIMEZONE)
+        self._async_wake = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        connect_issue = False
+        try:
+            while True:
+                self._async_wake.clear()
+                kind, wait = self.next_update()
+                if not kind:
+                    try:
+                        await asyncio.wait_for(self._async_wake.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if not await asyncio.to_thread(self.send_message, kind):
+                    if not connect_issue:
+                        logger.warning("Failed to send heartbeat to API server!")
+                    connect_issue = True
+                    await asyncio.sleep(10)
+                    continue
+
+                connect_issue = False
+        finally:
+            self._loop = None
 
 
-heartbeat = Heartbeat()
+heartbeat = Heartbeat(
+    slots=Config.MAX_CONCURRENT_JOBS,
+    keepalive=Config.HEARTBEAT_KEEPALIVE,
+    deltas=Config.HEARTBEAT_DELTAS,
+)
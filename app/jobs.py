@@ -0,0 +1,635 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import (FIRST_COMPLETED, FIRST_EXCEPTION,
+                                ThreadPoolExecutor, wait)
+from datetime import datetime
+from typing import Collection, List, Optional, Tuple, Union
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.cpus import cpus
+from app.exceptions import (CleanupError, InitializationError, NetworkError,
+                            RunError, StagingError, ValidationError)
+from app.graph import TaskGraph
+from app.heartbeat import HeartbeatSlot, TaskHeartbeat
+from app.metrics import (encode_fps, encode_speed, job_duration, jobs_finished,
+                         module_duration)
+from app.prefetch import Prefetcher
+from app.spans import JobTrace, span, tracer
+from app.staging import StagedJob, scratch, stage_job
+from app.streams import JobStreams
+from app.tasks import complete_job, validate_modules
+
+
+class Job:
+    """A job pulled off of the queue along with its run information.
+
+    Attributes:
+        data (Box): The job data pulled off of the queue
+        heartbeat (HeartbeatSlot): The job slot the job is running in
+        modules (List[BaseModule], optional): The validated task modules, otherwise None.
+        results (Box): The job run information sent to the API server on completion
+        start_time (datetime, optional): The time the job was started
+        current_task (int, optional): The index of the task currently running, otherwise None.
+        staged (StagedJob, optional): The job files staged to scratch space, otherwise None.
+        trace (JobTrace, optional): The timing spans of the job, otherwise None.
+        streams (JobStreams, optional): The streams between the tasks of the job, otherwise None.
+        graph (TaskGraph, optional): The dependencies between the tasks of the job, otherwise None.
+    """
+    data: Box
+    heartbeat: HeartbeatSlot
+    modules: Optional[List[object]]
+    results: Box
+    start_time: Optional[datetime]
+    current_task: Optional[int]
+    staged: Optional[StagedJob]
+    trace: Optional[JobTrace]
+    streams: Optional[JobStreams]
+    graph: Optional[TaskGraph]
+
+    def __init__(self, data: Union[dict, Box], heartbeat: HeartbeatSlot):
+        self.data = Box(data)
+        self.heartbeat = heartbeat
+        self.modules = None
+        self.results = Box()
+        self.start_time = None
+        self.current_task = None
+        self.staged = None
+        self.trace = None
+        self.streams = None
+        self.graph = None
+        self._write_back = threading.Lock()
+
+    def start(self) -> None:
+        """Mark the job as started on the heartbeat and initialize the run information.
+        """
+        logger.info(
+            f"Starting job: {self.data.job_id} [slot {self.heartbeat.index}]")
+        logger.info(f"Job title: {self.data.job_title}")
+        self.heartbeat.job_id = self.data.job_id
+        self.heartbeat.job_title = self.data.job_title
+        self.heartbeat.set_in_progress({})
+        self.trace = tracer.get(self.data.job_id)
+        self.trace.activate()
+
+        self.start_time = datetime.now(tz=Config.API_TIMEZONE)
+        self.results.start_time = str(self.start_time)
+        self.results.worker = Config.HOSTNAME
+        self.results.worker_id = Config.HOST_UUID
+        self.results.version = Config.VERSION
+        self.results.slot = self.heartbeat.index
+
+    def load(self, modules: Optional[List[object]] = None, staged: Optional[StagedJob] = None) -> bool:
+        """Stage the job files if enabled, load all job modules, and validate the task data for the modules.
+
+        Args:
+            modules (List[BaseModule], optional): Modules that were already loaded and validated (e.g. prefetched). Defaults to None.
+            staged (StagedJob, optional): Job files that were already staged (e.g. prefetched), only used along with `modules`. Defaults to None.
+
+        Returns:
+            bool: `True` if every module loaded and validated, otherwise `False`
+        """
+        self.staged = staged
+        if self.staged and not modules:
+            # The job was staged ahead of time, likely before the running job
+            # wrote back its inputs (so they were mapped as outputs), stage it again
+            logger.info("Prefetched job failed validation, staging its files again.")
+            self.staged.release()
+            self.staged = None
+        if not self.staged and scratch.enabled:
+            try:
+                with span("stage"):
+                    self.staged = stage_job(self.data)
+            except StagingError as e:
+                self.results.message = f"Could not stage job files: {e.message}"
+                logger.warning(self.results.message)
+                logger.warning(f"Aborting job: {self.data.job_id}")
+                return False
+
+        if modules:
+            logger.info("Using prefetched task modules, skipping validation.")
+            for module in modules:
+                module.heartbeat = self.heartbeat
+            self.modules = modules
+            self.plan()
+            tasks = [i.module for i in self.data.tasks]
+            logger.info(f"Found tasks in job: {' >> '.join(tasks)}")
+            return True
+
+        logger.info("Validating all task modules and data.")
+        try:
+            self.modules = validate_modules(
+                self.staged.data if self.staged else self.data, heartbeat=self.heartbeat)
+        except InitializationError as e:
+            self.results.message = e.message
+            logger.warning(e.message)
+        except ValidationError as e:
+            self.results.message = f"Could not validate task data: {e.message}"
+            logger.warning(f"Could not validate task data: {e.message}")
+        except:
+            self.results.message = f"Encountered unknown error initializing/validating tasks!"
+            logger.warning(
+                f"Encountered unknown error initializing/validating tasks!")
+
+        if not self.modules:
+            logger.warning(f"Aborting job: {self.data.job_id}")
+            return False
+
+        self.plan()
+        tasks = [i.module for i in self.data.tasks]
+        logger.info(f"Found tasks in job: {' >> '.join(tasks)}")
+        return True
+
+    def plan(self) -> None:
+        """Find the streams and dependencies between the validated tasks of the job.
+
+        If several tasks can run at once, every module reports its status
+        separately and the job slot status merges them.
+        """
+        data = self.staged.data if self.staged else self.data
+        self.streams = JobStreams(data)
+        self.graph = TaskGraph(data, self.streams)
+        if self.graph.concurrent:
+            for idx, module in enumerate(self.modules):
+                module.heartbeat = self.heartbeat.task(idx)
+
+    def start_task(self, idx: int) -> None:
+        """Record the start of a task.
+
+        Args:
+            idx (int): The index of the task in the job
+        """
+        self.current_task = idx
+        task_name = self.data.tasks[idx].module
+        logger.info(
+            f"Starting task: {task_name} [{idx + 1} of {len(self.data.tasks)}]")
+        self.results.module = task_name
+
+    def fail_task(self, idx: int, error: Union[RunError, CleanupError]) -> None:
+        """Record the failure of a task.
+
+        Args:
+            idx (int): The index of the task in the job
+            error (Union[RunError, CleanupError]): The error raised by the module
+        """
+        task_name = self.data.tasks[idx].module
+        action = "cleanup" if isinstance(error, CleanupError) else "run"
+        # With tasks running at once, the first failure is the one reported
+        if "message" not in self.results:
+            self.results.message = f"Failed to {action} task: {error.message}"
+            self.results.module = task_name
+        logger.warning(f"Failed to {action} task: {error.message}")
+        logger.warning(f"Aborting job: {self.data.job_id} -> {task_name}")
+        self.clear_task(idx)
+        if self.modules[idx].start_time:
+            logger.warning(f"Module runtime: {self.modules[idx].get_duration()}")
+            self.observe_task(idx, "failed")
+
+    def write_back(self, idx: Optional[int] = None) -> None:
+        """Write the staged outputs back to their original paths before a task that does not use the scratch space.
+
+        Args:
+            idx (int, optional): The index of the task about to run, or None at the end of the job. Defaults to None.
+
+        Raises:
+            RunError: The outputs could not be written back.
+        """
+        if not self.staged or (idx is not None and self.staged.covers(idx)):
+            return
+        try:
+            with self._write_back, span("write_back"):
+                written = self.staged.write_back()
+        except StagingError as e:
+            raise RunError(e.message)
+        if written:
+            logger.info(f"Wrote {written} bytes of staged outputs back.")
+
+    def complete_task(self, idx: int) -> None:
+        """Record the successful completion of a task.
+
+        Args:
+            idx (int): The index of the task in the job
+        """
+        logger.info(f"Module runtime: {self.modules[idx].get_duration()}")
+        self.clear_task(idx)
+        self.observe_task(idx, "completed")
+
+    def clear_task(self, idx: int) -> None:
+        """Remove a finished task from the job slot status, if it reports its status separately.
+
+        Args:
+            idx (int): The index of the task in the job
+        """
+        if isinstance(self.modules[idx].heartbeat, TaskHeartbeat):
+            self.modules[idx].heartbeat.clear()
+
+    def run_task(self, idx: int) -> None:
+        """Run a task and clean up after it.
+
+        Args:
+            idx (int): The index of the task in the job
+
+        Raises:
+            RunError: The task failed to run.
+            CleanupError: The task failed to clean up.
+        """
+        task_name = self.data.tasks[idx].module
+        with span("run", module=task_name, task=idx):
+            self.modules[idx].run()
+        with span("cleanup", module=task_name, task=idx):
+            self.modules[idx].cleanup()
+
+    async def run_task_async(self, idx: int, timeout: Optional[float] = None) -> None:
+        """Run a task and clean up after it on the event loop.
+
+        Args:
+            idx (int): The index of the task in the job
+            timeout (float, optional): The maximum number of seconds the task may run. Defaults to None.
+
+        Raises:
+            RunError: The task failed to run or timed out.
+            CleanupError: The task failed to clean up.
+        """
+        task_name = self.data.tasks[idx].module
+        try:
+            with span("run", module=task_name, task=idx):
+                await asyncio.wait_for(self.modules[idx].run_async(), timeout)
+        except asyncio.TimeoutError:
+            raise RunError(f"Task timed out after {timeout} seconds")
+        with span("cleanup", module=task_name, task=idx):
+            await self.modules[idx].cleanup_async()
+
+    def stop_tasks(self, group: List[int]) -> None:
+        """Stop the running tasks of a group and unblock any task waiting on one of its streams.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+        """
+        for idx in group:
+            self.modules[idx].stop()
+        self.streams.abort(group)
+
+    @staticmethod
+    def first_failure(group: List[int], errors: Collection[Tuple[int, BaseException]]) -> Optional[Tuple[int, Union[RunError, CleanupError]]]:
+        """Return the error of the first task of a group that failed.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+            errors (Collection[Tuple[int, BaseException]]): The index of every task that failed first and its error
+
+        Raises:
+            BaseException: A task raised an unexpected error.
+
+        Returns:
+            Optional[Tuple[int, Union[RunError, CleanupError]]]: The index of the task and its error, or None if no task failed.
+        """
+        for idx, error in sorted(errors, key=lambda i: group.index(i[0])):
+            if not isinstance(error, (RunError, CleanupError)):
+                raise error
+            return idx, error
+        return None
+
+    def run_streamed(self, group: List[int]) -> Optional[Tuple[int, Union[RunError, CleanupError]]]:
+        """Run a group of tasks that stream to each other, all at once.
+
+        As soon as a task fails, the others are stopped so that none of them
+        waits forever on a stream.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+
+        Returns:
+            Optional[Tuple[int, Union[RunError, CleanupError]]]: The index and error of the task that failed first, or None if every task succeeded.
+        """
+        with ThreadPoolExecutor(max_workers=len(group)) as executor:
+            runs = {
+                executor.submit(contextvars.copy_context().run, self.run_task, idx): idx
+                for idx in group
+            }
+            done, pending = wait(runs, return_when=FIRST_EXCEPTION)
+            if pending:
+                logger.warning("A streamed task failed, stopping the tasks streaming to or from it.")
+            while pending:
+                self.stop_tasks(group)
+                _, pending = wait(pending, timeout=0.1)
+        return self.first_failure(
+            group, [(runs[i], i.exception()) for i in done if i.exception()])
+
+    async def run_streamed_async(self, group: List[int], timeout: Optional[float] = None) -> Optional[Tuple[int, Union[RunError, CleanupError]]]:
+        """Run a group of tasks that stream to each other, all at once on the event loop.
+
+        As soon as a task fails, the others are cancelled and stopped so that
+        none of them waits forever on a stream.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+            timeout (float, optional): The maximum number of seconds a task may run. Defaults to None.
+
+        Returns:
+            Optional[Tuple[int, Union[RunError, CleanupError]]]: The index and error of the task that failed first, or None if every task succeeded.
+        """
+        runs = {
+            asyncio.create_task(self.run_task_async(idx, timeout)): idx
+            for idx in group
+        }
+        cancelled = False
+        try:
+            done, pending = await asyncio.wait(runs, return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            # The group is being stopped (e.g. a task it does not stream with failed)
+            cancelled, done, pending = True, set(), set(runs)
+        if pending:
+            if not cancelled:
+                logger.warning("A streamed task failed, stopping the tasks streaming to or from it.")
+            for run in pending:
+                run.cancel()
+        while pending:
+            await asyncio.to_thread(self.stop_tasks, group)
+            _, pending = await asyncio.wait(pending, timeout=0.1)
+        errors = [(runs[i], i.exception()) for i in done if i.exception()]
+        # Retrieve the errors of the stopped tasks too, so they are not reported as unhandled
+        for run in runs:
+            if not run.cancelled():
+                run.exception()
+        if cancelled:
+            raise asyncio.CancelledError()
+        return self.first_failure(group, errors)
+
+    def run_group(self, group: List[int]) -> bool:
+        """Run a group of tasks that start together (a single task unless they stream to each other).
+
+        Args:
+            group (List[int]): The indexes of the tasks
+
+        Returns:
+            bool: `True` if a task failed, otherwise `False`
+        """
+        for idx in group:
+            self.start_task(idx)
+        idx = group[0]
+        try:
+            for idx in group:
+                self.write_back(idx)
+            idx = group[0]
+            if len(group) == 1:
+                self.run_task(idx)
+            else:
+                with self.streams.open(group):
+                    if failure := self.run_streamed(group):
+                        idx, error = failure
+                        raise error
+        except (RunError, CleanupError) as e:
+            self.fail_task(idx, e)
+            return True
+        for idx in group:
+            self.complete_task(idx)
+        return False
+
+    async def run_group_async(self, group: List[int], timeout: Optional[float] = None) -> bool:
+        """Run a group of tasks that start together (a single task unless they stream to each other) on the event loop.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+            timeout (float, optional): The maximum number of seconds a task may run. Defaults to None.
+
+        Returns:
+            bool: `True` if a task failed, otherwise `False`
+        """
+        for idx in group:
+            self.start_task(idx)
+        idx = group[0]
+        try:
+            for idx in group:
+                await asyncio.to_thread(self.write_back, idx)
+            idx = group[0]
+            if len(group) == 1:
+                await self.run_task_async(idx, timeout)
+            else:
+                with self.streams.open(group):
+                    if failure := await self.run_streamed_async(group, timeout):
+                        idx, error = failure
+                        raise error
+        except (RunError, CleanupError) as e:
+            self.fail_task(idx, e)
+            return True
+        for idx in group:
+            self.complete_task(idx)
+        return False
+
+    def run_graph(self) -> bool:
+        """Run the tasks of the job as soon as the tasks they depend on finished.
+
+        Up to `MAX_CONCURRENT_TASKS` groups of tasks (by default one per CPU of
+        the job slot) run at once.  Once a task fails, no other task is started
+        and the running ones are stopped.
+
+        Returns:
+            bool: `True` if a task failed, otherwise `False`
+        """
+        groups = self.graph.groups
+        if not self.graph.concurrent:
+            return any(self.run_group(group) for group in groups)
+
+        limit = Config.MAX_CONCURRENT_TASKS or cpus.threads(self.heartbeat.index)
+        done, started, running, failed = set(), set(), dict(), False
+        with ThreadPoolExecutor(max_workers=limit) as executor:
+            while True:
+                if not failed:
+                    for group in self.graph.ready(done, started)[:limit - len(running)]:
+                        started.add(group)
+                        running[executor.submit(
+                            contextvars.copy_context().run, self.run_group, groups[group])] = group
+                if not running:
+                    return failed
+                finished, _ = wait(
+                    running, timeout=1 if failed else None, return_when=FIRST_COMPLETED)
+                for run in finished:
+                    group = running.pop(run)
+                    if run.result():
+                        failed = True
+                    else:
+                        done.add(group)
+                if failed:
+                    for group in running.values():
+                        self.stop_tasks(groups[group])
+
+    async def run_graph_async(self, timeout: Optional[float] = None) -> bool:
+        """Run the tasks of the job on the event loop as soon as the tasks they depend on finished.
+
+        Up to `MAX_CONCURRENT_TASKS` groups of tasks (by default one per CPU of
+        the job slot) run at once.  Once a task fails, no other task is started
+        and the running ones are cancelled.
+
+        Args:
+            timeout (float, optional): The maximum number of seconds a task may run. Defaults to None.
+
+        Returns:
+            bool: `True` if a task failed, otherwise `False`
+        """
+        groups = self.graph.groups
+        if not self.graph.concurrent:
+            for group in groups:
+                if await self.run_group_async(group, timeout):
+                    return True
+            return False
+
+        limit = Config.MAX_CONCURRENT_TASKS or cpus.threads(self.heartbeat.index)
+        done, started, running, stopped, failed = set(), set(), dict(), set(), False
+        while True:
+            if not failed:
+                for group in self.graph.ready(done, started)[:limit - len(running)]:
+                    started.add(group)
+                    running[asyncio.create_task(self.run_group_async(groups[group], timeout))] = group
+            if not running:
+                return failed
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for run in finished:
+                group = running.pop(run)
+                if run.cancelled():
+                    continue
+                if run.result():
+                    failed = True
+                else:
+                    done.add(group)
+            if failed:
+                for run, group in running.items():
+                    if run not in stopped:
+                        stopped.add(run)
+                        await asyncio.to_thread(self.stop_tasks, groups[group])
+                        run.cancel()
+
+    def observe_task(self, idx: int, result: str) -> None:
+        """Record the runtime of a task in the metrics.
+
+        Args:
+            idx (int): The index of the task in the job
+            result (str): `completed` or `failed`
+        """
+        module_duration.observe(
+            self.modules[idx].get_duration().total_seconds(),
+            module=self.data.tasks[idx].module, result=result)
+
+    def finish(self, failed: bool) -> None:
+        """Report the job results to the API server and set the job slot back to idle.
+
+        Args:
+            failed (bool): Whether the job failed or not.
+        """
+        if self.modules:
+            tasks = [
+                Box(module=task.module) | module.results
+                for task, module in zip(self.data.tasks, self.modules) if module.results
+            ]
+            if tasks:
+                self.results.tasks = tasks
+            if cached := [i.results.encode_cache for i in self.modules if "encode_cache" in i.results]:
+                self.results.encode_cache = {"hits": cached.count("hit"), "misses": cached.count("miss")}
+            self.results.completed = not failed
+            if failed:
+                job_log_level = "WARNING"
+            else:
+                job_log_level = "SUCCESS"
+                self.results.pop("module", None)
+
+        if self.staged:
+            self.results.staging = self.staged.summary()
+            self.staged.release()
+
+        self.results.end_time = str(datetime.now(tz=Config.API_TIMEZONE))
+        self.results.runtime = str(
+            datetime.now(tz=Config.API_TIMEZONE) - self.start_time)
+        result = "failed" if failed else "completed"
+        jobs_finished.inc(result=result)
+        job_duration.observe(
+            (datetime.now(tz=Config.API_TIMEZONE) - self.start_time).total_seconds(), result=result)
+        encode_fps.discard(slot=self.heartbeat.index)
+        encode_speed.discard(slot=self.heartbeat.index)
+        if self.modules:
+            logger.log(job_log_level,
+                       f"Job runtime: {datetime.now(tz=Config.API_TIMEZONE) - self.start_time}")
+        if Config.JOB_SPANS:
+            self.results.spans = self.trace.as_list()
+
+        # Move job information into the appropriate collection
+        try:
+            with span("complete"):
+                complete_job(data=self.data, job_info=self.results, failed=failed)
+        except NetworkError as e:
+            logger.warning(e.message)
+
+        self.heartbeat.set_idle()
+        self.trace.root.finish()
+        tracer.discard(self.data.job_id)
+        tracer.export(self.trace)
+
+
+def run_job(data: Union[dict, Box], heartbeat: HeartbeatSlot, modules: Optional[List[object]] = None, prefetcher: Optional[Prefetcher] = None, staged: Optional[StagedJob] = None) -> bool:
+    """Validate and run every task in a job, then report the results to the API server.
+
+    Args:
+        data (Union[dict, Box]): The job data pulled off of the queue.
+        heartbeat (HeartbeatSlot): The job slot the job is running in.
+        modules (List[BaseModule], optional): Prefetched modules that were already validated. Defaults to None.
+        prefetcher (Prefetcher, optional): Prefetches the next job once the tasks of this one finished. Defaults to None.
+        staged (StagedJob, optional): Prefetched job files that were already staged. Defaults to None.
+
+    Returns:
+        bool: `True` if the job failed, otherwise `False`
+    """
+    job = Job(data, heartbeat)
+    job.start()
+    if not job.load(modules, staged):
+        job.finish(failed=True)
+        return True
+
+    failed = job.run_graph()
+    if prefetcher:
+        prefetcher.start()
+
+    if not failed:
+        try:
+            job.write_back()
+        except RunError as e:
+            job.fail_task(len(job.modules) - 1, e)
+            failed = True
+
+    job.finish(failed=failed)
+    return failed
+
+
+async def run_job_async(data: Union[dict, Box], heartbeat: HeartbeatSlot, timeout: Optional[float] = None, modules: Optional[List[object]] = None, prefetcher: Optional[Prefetcher] = None, staged: Optional[StagedJob] = None) -> bool:
+    """Validate and run every task in a job on the event loop, then report the results to the API server.
+
+    Args:
+        data (Union[dict, Box]): The job data pulled off of the queue.
+        heartbeat (HeartbeatSlot): The job slot the job is running in.
+        timeout (float, optional): The maximum number of seconds a task may run. Defaults to None.
+        modules (List[BaseModule], optional): Prefetched modules that were already validated. Defaults to None.
+        prefetcher (Prefetcher, optional): Prefetches the next job once the tasks of this one finished. Defaults to None.
+        staged (StagedJob, optional): Prefetched job files that were already staged. Defaults to None.
+
+    Returns:
+        bool: `True` if the job failed, otherwise `False`
+    """
+    job = Job(data, heartbeat)
+    job.start()
+    if not await asyncio.to_thread(job.load, modules, staged):
+        await asyncio.to_thread(job.finish, True)
+        return True
+
+    failed = await job.run_graph_async(timeout)
+    if prefetcher:
+        prefetcher.start()
+
+    if not failed:
+        try:
+            await asyncio.to_thread(job.write_back)
+        except RunError as e:
+            job.fail_task(len(job.modules) - 1, e)
+            failed = True
+
+    await asyncio.to_thread(job.finish, failed)
+    return failed
@@ -0,0 +1,291 @@
+import math
+import os
+import resource
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from loguru import logger
+
+# Histogram buckets (seconds) for API requests
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Histogram buckets (seconds) for jobs and task modules
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metric:
+    """A Prometheus metric (counter, gauge, or histogram) with optional labels.
+
+    Attributes:
+        name (str): The metric name (e.g. `sisyphus_jobs_claimed_total`)
+        kind (str): `counter`, `gauge`, or `histogram`
+        help (str): The description of the metric
+        labels (Sequence[str]): The names of the labels every sample must have
+        buckets (Sequence[float]): The upper bounds of the histogram buckets (histograms only)
+    """
+    name: str
+    kind: str
+    help: str
+    labels: Sequence[str]
+    buckets: Sequence[float]
+
+    def __init__(self, name: str, kind: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric '{self.name}' needs labels {self.labels}, got {tuple(labels)}")
+        return tuple((i, str(labels[i])) for i in self.labels)
+
+    def inc(self, value: float = 1, **labels) -> None:
+        """Add to a counter or gauge.
+
+        Args:
+            value (float, optional): The amount to add. Defaults to 1.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value: float, **labels) -> None:
+        """Set a gauge (or a counter read from elsewhere, e.g. the kernel).
+
+        Args:
+            value (float): The value
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, value: float, **labels) -> None:
+        """Record a value in a histogram.
+
+        Args:
+            value (float): The value
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            self._values[key] = (
+                [c + (value <= b) for c, b in zip(counts, self.buckets)], total + value, count + 1)
+
+    def discard(self, **labels) -> None:
+        """Remove every sample matching the given labels (e.g. a job slot that went idle).
+        """
+        match = {(k, str(v)) for k, v in labels.items()}
+        with self._lock:
+            for key in [k for k in self._values if match <= set(k)]:
+                del self._values[key]
+
+    def render(self) -> List[str]:
+        """Format the metric in the Prometheus text exposition format.
+
+        Returns:
+            List[str]: The lines of the metric.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labels and self.kind != "histogram":
+            values = {(): 0}
+        for key, value in sorted(values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_labels(key)} {_number(value)}")
+                continue
+            counts, total, count = value
+            for bound, cumulative in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+def _labels(key: Labels) -> str:
+    if not key:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + "}"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """The worker's metrics and the HTTP endpoint serving them to Prometheus.
+
+    Attributes:
+        metrics (Dict[str, Metric]): The metrics keyed by name
+        collectors (List[Callable[[], None]]): Functions updating metrics right before every scrape
+    """
+    metrics: Dict[str, Metric]
+    collectors: List[Callable[[], None]]
+
+    def __init__(self):
+        self.metrics = dict()
+        self.collectors = list()
+        self._server = None
+
+    def add(self, name: str, kind: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()) -> Metric:
+        """Register a metric.
+
+        Args:
+            name (str): The metric name
+            kind (str): `counter`, `gauge`, or `histogram`
+            help (str): The description of the metric
+            labels (Sequence[str], optional): The label names. Defaults to none.
+            buckets (Sequence[float], optional): The histogram bucket upper bounds. Defaults to none.
+
+        Returns:
+            Metric: The metric.
+        """
+        self.metrics[name] = Metric(name, kind, help, labels, buckets)
+        return self.metrics[name]
+
+    def add_collector(self, func: Callable[[], None]) -> None:
+        """Run a function right before every scrape, e.g. to read values from `/proc`.
+
+        Args:
+            func (Callable[[], None]): The function
+        """
+        self.collectors.append(func)
+
+    def render(self) -> str:
+        """Collect and format every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"Could not collect metrics: {e}")
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+    def serve(self, address: str, port: int) -> None:
+        """Serve the metrics on `http://<address>:<port>/metrics` from a background thread.
+
+        Args:
+            address (str): The address to listen on
+            port (int): The port to listen on
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+
+def endpoint(rest_path: str) -> str:
+    """Reduce an API path to a low-cardinality endpoint label (e.g. `/workers/<uuid>` to `/workers`).
+
+    Args:
+        rest_path (str): The path (e.g. `/jobs/1234/completed`)
+
+    Returns:
+        str: The endpoint (e.g. `/jobs/completed`).
+    """
+    parts = rest_path.split("?")[0].strip("/").split("/")
+    if len(parts) > 1 and parts[0] in ("queue", "jobs"):
+        return f"/{parts[0]}/{parts[-1]}"
+    return f"/{parts[0]}"
+
+
+def _child_processes() -> List[int]:
+    children = list()
+    for task in Path("/proc/self/task").iterdir():
+        try:
+            children.extend(int(i) for i in (task / "children").read_text().split())
+        except OSError:
+            continue
+    return children
+
+
+def collect_children() -> None:
+    """Update the CPU time and memory of the worker's child processes (encoders).
+
+    CPU time includes both the children that already exited and those still
+    running; memory is the resident set of the running children.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu, rss, running = usage.ru_utime + usage.ru_stime, 0, 0
+    ticks, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+    for pid in _child_processes():
+        try:
+            fields = Path(f"/proc/{pid}/stat").read_text().rpartition(")")[2].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page
+        running += 1
+    child_cpu_seconds.set(cpu)
+    child_rss_bytes.set(rss)
+    child_processes.set(running)
+
+
+metrics = MetricsRegistry()
+jobs_claimed = metrics.add(
+    "sisyphus_jobs_claimed_total", "counter", "Jobs pulled off of the queue.")
+jobs_finished = metrics.add(
+    "sisyphus_jobs_finished_total", "counter", "Jobs finished, by result (completed or failed).", ["result"])
+job_duration = metrics.add(
+    "sisyphus_job_duration_seconds", "histogram", "Job runtime, by result.", ["result"], DURATION_BUCKETS)
+module_duration = metrics.add(
+    "sisyphus_module_duration_seconds", "histogram", "Task module runtime, by module and result.",
+    ["module", "result"], DURATION_BUCKETS)
+encode_fps = metrics.add(
+    "sisyphus_encode_fps", "gauge", "Current encoding speed in frames per second, by job slot and module.",
+    ["slot", "module"])
+encode_speed = metrics.add(
+    "sisyphus_encode_speed", "gauge", "Current encoding speed as a multiple of real time, by job slot and module.",
+    ["slot", "module"])
+api_request_duration = metrics.add(
+    "sisyphus_api_request_duration_seconds", "histogram", "API server request latency, by method and endpoint.",
+    ["method", "endpoint"], LATENCY_BUCKETS)
+api_request_failures = metrics.add(
+    "sisyphus_api_request_failures_total", "counter",
+    "API server requests that failed without a response, by method, endpoint, and exception.",
+    ["method", "endpoint", "reason"])
+api_errors = metrics.add(
+    "sisyphus_api_errors_total", "counter", "Queue polling errors, by error code (e.g. ERR_QUEUE_STATUS).", ["error"])
+cleanup_bytes = metrics.add(
+    "sisyphus_cleanup_bytes_total", "counter", "Bytes moved or copied by the cleanup module, by operation.",
+    ["operation"])
+child_cpu_seconds = metrics.add(
+    "sisyphus_child_cpu_seconds_total", "counter", "CPU time used by child processes (encoders).")
+child_rss_bytes = metrics.add(
+    "sisyphus_child_rss_bytes", "gauge", "Resident memory of the running child processes (encoders).")
+child_processes = metrics.add(
+    "sisyphus_child_processes", "gauge", "Running child processes (encoders).")
+metrics.add_collector(collect_children)
@@ -0,0 +1,194 @@
+import contextvars
+import copy
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import quote
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.exceptions import NetworkError, ValidationError
+from app.spans import span
+from app.tasks import connect_to_api
+
+
+class OptionSetEntry:
+    """A cached server-side option set.
+
+    Attributes:
+        options (Box): The options from the option set
+        etag (str, optional): The `ETag` the API server returned with the option set, otherwise None.
+        fetched_at (float): When the option set was last fetched or revalidated (epoch seconds)
+    """
+    options: Box
+    etag: Optional[str]
+    fetched_at: float
+
+    def __init__(self, options: Box, etag: Optional[str], fetched_at: float):
+        self.options = options
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+    def as_dict(self) -> dict:
+        return {"options": self.options, "etag": self.etag, "fetched_at": self.fetched_at}
+
+
+class OptionSetCache:
+    """A cache for server-side module option sets (e.g. `/data/ffmpeg/<name>`).
+
+    Entries are served from memory for `ttl` seconds.  After that they are
+    revalidated with `If-None-Match` when the server provided an `ETag`.  If
+    the API server cannot be reached, a stale entry is used instead of failing
+    validation.  Entries are optionally persisted to `cache_dir` so they survive
+    worker restarts.
+
+    Attributes:
+        ttl (float): The number of seconds an entry is used without revalidation
+        cache_dir (Path, optional): The directory to persist entries in, otherwise None.
+        entries (Dict[str, OptionSetEntry]): The cached option sets keyed by API path
+        counters (Dict[str, int]): The `hits`, `misses`, `revalidated`, and `stale` counters
+    """
+    ttl: float
+    cache_dir: Optional[Path]
+    entries: Dict[str, OptionSetEntry]
+    counters: Dict[str, int]
+
+    def __init__(self, ttl: float = 300, cache_dir: Optional[str] = None):
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.entries = dict()
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _path(self, rest_path: str) -> Path:
+        return self.cache_dir / f"{quote(rest_path, safe='')}.json"
+
+    def _load(self, rest_path: str) -> Optional[OptionSetEntry]:
+        with self._lock:
+            if entry := self.entries.get(rest_path):
+                return entry
+        if not self.cache_dir:
+            return None
+        try:
+            with self._path(rest_path).open("r") as f:
+                data = json.load(f)
+            entry = OptionSetEntry(
+                Box(data["options"]), data["etag"], data["fetched_at"])
+        except (OSError, ValueError, KeyError):
+            return None
+        with self._lock:
+            self.entries[rest_path] = entry
+        return entry
+
+    def _store(self, rest_path: str, entry: OptionSetEntry) -> None:
+        with self._lock:
+            self.entries[rest_path] = entry
+        if not self.cache_dir:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(rest_path)
+            temp_path = path.with_suffix(".tmp")
+            with temp_path.open("w") as f:
+                json.dump(entry.as_dict(), f)
+            temp_path.replace(path)
+        except OSError as e:
+            logger.warning(f"Could not persist option set '{rest_path}': {e}")
+
+    def get(self, module: str, name: str) -> Box:
+        """Return the options of a server-side option set.
+
+        Args:
+            module (str): The module the option set belongs to (e.g. `ffmpeg`)
+            name (str): The name of the option set
+
+        Raises:
+            ValidationError: The option set does not exist or could not be retrieved.
+
+        Returns:
+            Box: The options from the option set.
+        """
+        with span("option_set", module=module, option_set=name) as current:
+            options, result = self._get(module, name)
+            current.set(cache=result)
+            return options
+
+    def _get(self, module: str, name: str) -> Tuple[Box, str]:
+        rest_path = f"/data/{module}/{name}"
+        entry = self._load(rest_path)
+        if entry and time.time() - entry.fetched_at < self.ttl:
+            self._count("hits")
+            return copy.deepcopy(entry.options), "hit"
+
+        logger.info(f"Retrieving option set: {name}")
+        headers = {"If-None-Match": entry.etag} if entry and entry.etag else {}
+        try:
+            r = connect_to_api(
+                "GET", rest_path,
+                f"Could not retrieve server-side option set '{name}'",
+                headers=headers)
+        except NetworkError as e:
+            if entry:
+                logger.warning(f"{e.message}, using cached copy.")
+                self._count("stale")
+                return copy.deepcopy(entry.options), "stale"
+            raise ValidationError(e.message)
+
+        if r.status_code == 304 and entry:
+            self._count("revalidated")
+            self._store(rest_path, OptionSetEntry(
+                entry.options, entry.etag, time.time()))
+            return copy.deepcopy(entry.options), "revalidated"
+        if r.status_code == 404:
+            raise ValidationError(
+                f"Could not find server-side option set '{name}'")
+
+        self._count("misses")
+        options = Box(json.loads(r.content)).options
+        self._store(rest_path, OptionSetEntry(
+            options, r.headers.get("ETag"), time.time()))
+        return copy.deepcopy(options), "miss"
+
+    def resolve(self, module: str, names: Iterable[str]) -> Dict[str, Box]:
+        """Return the options of several option sets at once, fetching any uncached ones in parallel.
+
+        Args:
+            module (str): The module the option sets belong to (e.g. `ffmpeg`)
+            names (Iterable[str]): The names of the option sets
+
+        Raises:
+            ValidationError: An option set does not exist or could not be retrieved.
+
+        Returns:
+            Dict[str, Box]: The options keyed by option set name.
+        """
+        names = list(dict.fromkeys(names))
+        if len(names) < 2:
+            return {i: self.get(module, i) for i in names}
+        # Fetch in copies of the caller's context so the fetches are recorded in the job's spans
+        contexts = [contextvars.copy_context() for _ in names]
+        with ThreadPoolExecutor(max_workers=min(len(names), 4)) as executor:
+            results = executor.map(lambda c, i: c.run(self.get, module, i), contexts, names)
+            return dict(zip(names, results))
+
+    def stats(self) -> Dict[str, int]:
+        """Return the cache counters.
+
+        Returns:
+            Dict[str, int]: The `hits`, `misses`, `revalidated`, and `stale` counters, and the number of `entries`.
+        """
+        with self._lock:
+            return self.counters | {"entries": len(self.entries)}
+
+
+option_sets = OptionSetCache(
+    ttl=Config.OPTION_SET_CACHE_TTL, cache_dir=Config.OPTION_SET_CACHE_DIR)
@@ -0,0 +1,178 @@
+import html
+import json
+import random
+import threading
+import time
+from typing import Optional
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.exceptions import NetworkError
+from app.metrics import api_errors, jobs_claimed
+from app.spans import tracer
+from app.tasks import connect_to_api
+
+
+class QueuePoller:
+    """Polls the API server for the next job this worker is allowed to run.
+
+    The delay between polls adapts to the state of the queue: the queue is
+    polled again immediately after a job is claimed or finishes, and backs off
+    exponentially (with jitter) while the queue is empty.  The queue and worker
+    "disabled" flags are cached for `Config.QUEUE_STATUS_CACHE_TTL` seconds while
+    they are enabled, so a busy worker only calls `/queue/poll`.
+
+    Attributes:
+        last_error (str, optional): The last error encountered, used to avoid repeating log messages.
+        delay (float): The number of seconds to wait before polling again.
+        empty_polls (int): The number of consecutive polls that found no job to run.
+        status_checked_at (float, optional): When the queue and worker were last seen enabled (monotonic clock).
+    """
+    last_error: Optional[str]
+    delay: float
+    empty_polls: int
+    status_checked_at: Optional[float]
+
+    def __init__(self):
+        self.last_error = None
+        self.delay = 0
+        self.empty_polls = 0
+        self.status_checked_at = None
+        self._wake = threading.Event()
+
+    def set_error(self, error: str, message: str, network: bool = False) -> None:
+        """Record an error, logging it only when it differs from the previous one.
+
+        Args:
+            error (str): The error code (e.g. `ERR_QUEUE_STATUS`)
+            message (str): The message to log
+            network (bool, optional): Whether the error is a network error and should back off. Defaults to False.
+        """
+        api_errors.inc(error=error)
+        if self.last_error != error:
+            if network:
+                logger.warning(message)
+            else:
+                logger.info(message)
+        self.last_error = error
+        self.status_checked_at = None
+        self.delay = Config.QUEUE_POLL_INTERVAL
+        if network:
+            self.delay += Config.NETWORK_RETRY_INTERVAL
+        self.delay = self.jitter(self.delay)
+
+    def set_empty(self) -> None:
+        """Back off exponentially while there are no jobs on the queue.
+        """
+        if self.last_error != "ERR_QUEUE_EMPTY":
+            logger.info("There are currently no jobs on the queue")
+        self.last_error = "ERR_QUEUE_EMPTY"
+        delay = Config.QUEUE_POLL_MIN_INTERVAL * 2 ** self.empty_polls
+        self.delay = self.jitter(min(Config.QUEUE_POLL_MAX_INTERVAL, delay))
+        self.empty_polls += 1
+
+    @staticmethod
+    def jitter(delay: float) -> float:
+        """Randomize a delay between half and all of its value so workers do not poll in lockstep.
+
+        Args:
+            delay (float): The delay in seconds
+
+        Returns:
+            float: The randomized delay in seconds.
+        """
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def notify_job_finished(self) -> None:
+        """Poll again immediately, e.g. after a job finishes and frees up a job slot.
+        """
+        self.delay = 0
+        self.empty_polls = 0
+        self._wake.set()
+
+    def sleep(self) -> None:
+        """Wait until the next poll is due or `notify_job_finished` is called.
+        """
+        self._wake.wait(self.delay)
+        self._wake.clear()
+
+    def check_status(self) -> bool:
+        """Check that neither the queue nor this worker is disabled.
+
+        Returns:
+            bool: `True` if the worker may pull jobs off of the queue, otherwise `False`
+        """
+        if self.status_checked_at is not None:
+            if time.monotonic() - self.status_checked_at < Config.QUEUE_STATUS_CACHE_TTL:
+                return True
+
+        # Check to see if the entire queue is disabled
+        try:
+            r = connect_to_api(
+                "GET", "/queue", "Error polling API queue for status!")
+        except NetworkError as e:
+            self.set_error("ERR_QUEUE_STATUS", e.message, network=True)
+            return False
+
+        data = Box(json.loads(r.content))
+        if data.attributes.disabled:
+            self.set_error("ERR_QUEUE_DISABLED",
+                           "The main server queue is disabled")
+            return False
+
+        # Check to see if we're 'allowed' to process the queue
+        try:
+            r = connect_to_api("GET", "/workers/" + Config.HOST_UUID,
+                               "Error polling worker for queue permissions!")
+        except NetworkError as e:
+            self.set_error("ERR_WORKER_STATUS", e.message, network=True)
+            return False
+
+        if r.status_code != 200:
+            logger.warning("Could not pull worker status from server!")
+            self.status_checked_at = None
+            self.delay = self.jitter(Config.QUEUE_POLL_INTERVAL)
+            return False
+
+        data = Box(json.loads(r.content))
+        if data.attributes.disabled:
+            self.set_error("ERR_WORKER_DISABLED",
+                           "The worker is disabled from the API server")
+            return False
+
+        self.status_checked_at = time.monotonic()
+        return True
+
+    def poll(self) -> Optional[Box]:
+        """Check the queue and worker status, then pull a job off of the queue.
+
+        Returns:
+            Optional[Box]: The job data, or None if there is no job to run.
+        """
+        start = time.time_ns()
+        if not self.check_status():
+            return None
+
+        # Pull a task off the queue
+        try:
+            r = connect_to_api("GET", "/queue/poll",
+                               "Error polling queue for jobs!")
+        except NetworkError as e:
+            self.set_error("ERR_POLL_STATUS", e.message, network=True)
+            return None
+
+        if r.status_code == 404:
+            self.set_empty()
+            return None
+
+        # Reset errors since we made it through the connection gauntlet
+        self.last_error = None
+        self.delay = 0
+        self.empty_polls = 0
+
+        jobs_claimed.inc()
+        data = Box(json.loads(html.unescape(r.text)))
+        tracer.start(data.job_id, start).record("claim", start)
+        return data
@@ -0,0 +1,168 @@
+import threading
+from typing import List, Optional
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.heartbeat import HeartbeatSlot
+from app.poller import QueuePoller
+from app.spans import span, tracer
+from app.staging import StagedJob, scratch, stage_job
+from app.tasks import validate_modules
+
+
+class PrefetchedJob:
+    """A job claimed ahead of time along with its pre-validated modules.
+
+    Attributes:
+        data (Box): The job data pulled off of the queue
+        modules (List[BaseModule], optional): The validated task modules, or None if validation failed.
+        staged (StagedJob, optional): The job files staged to scratch space, or None if staging is disabled or failed.
+    """
+    data: Box
+    modules: Optional[List[object]]
+    staged: Optional[StagedJob]
+
+    def __init__(self, data: Box, modules: Optional[List[object]] = None, staged: Optional[StagedJob] = None):
+        self.data = data
+        self.modules = modules
+        self.staged = staged
+
+
+class Prefetcher:
+    """Claims and validates the next job for a job slot while the current job finishes.
+
+    The queue has no way to give a claimed job back, so the next job is only
+    claimed once the slot is free: every task of the running job has
+    finished.  It is then staged and its modules are constructed and validated
+    in the background while the running job writes back its outputs and
+    reports its results, so the slot can start it right away.  A job that
+    fails validation here is loaded again when it starts, like any other job.
+
+    Attributes:
+        index (int): The index of the job slot to prefetch for
+        poller (QueuePoller): The poller used to claim the next job
+        claimed (Box, optional): The job data of the claimed job (even while it is prepared), otherwise None.
+        prefetched (PrefetchedJob, optional): The claimed job once it is prepared, otherwise None.
+    """
+    index: int
+    poller: QueuePoller
+    claimed: Optional[Box]
+    prefetched: Optional[PrefetchedJob]
+
+    def __init__(self, index: int):
+        self.index = index
+        self.poller = QueuePoller()
+        self.claimed = None
+        self.prefetched = None
+        self._lock = threading.Lock()
+        self._released = False
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start claiming and preparing the next job in the background, once the running job's tasks finished.
+        """
+        self._done.clear()
+        self._released = False
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _prefetch(self) -> None:
+        logger.info(f"Prefetching next job for slot {self.index}")
+        while not self._done.is_set():
+            if data := self.poller.poll():
+                with self._lock:
+                    released = self._released
+                    if not released:
+                        self.claimed = data
+                if released:
+                    # Claimed while the worker was shutting down
+                    self.abandon(data)
+                    return
+                prefetched = self.prepare(data)
+                with self._lock:
+                    if self.claimed is data:
+                        self.prefetched = prefetched
+                        return
+                # Released while it was prepared
+                if prefetched.staged:
+                    prefetched.staged.release()
+                return
+            self._done.wait(max(self.poller.delay, 1))
+
+    def prepare(self, data: Box) -> PrefetchedJob:
+        """Stage the files of a prefetched job (if enabled), then construct and validate its modules.
+
+        Modules report status on a detached heartbeat slot so the running job's
+        status is left untouched; they are rebound when the job starts.
+
+        Args:
+            data (Box): The job data pulled off of the queue.
+
+        Returns:
+            PrefetchedJob: The prefetched job.
+        """
+        logger.info(f"Prefetched job: {data.job_id}")
+        tracer.get(data.job_id).activate()
+        with span("prefetch"):
+            staged = None
+            if scratch.enabled:
+                try:
+                    with span("stage"):
+                        staged = stage_job(data)
+                except Exception as e:
+                    logger.info(
+                        f"Could not stage job {data.job_id} ahead of time: {getattr(e, 'message', e)}")
+            try:
+                modules = validate_modules(
+                    staged.data if staged else data, heartbeat=HeartbeatSlot(self.index))
+            except Exception as e:
+                logger.info(
+                    f"Could not pre-validate job {data.job_id}, loading it again at start: {getattr(e, 'message', e)}")
+                modules = None
+        return PrefetchedJob(data, modules, staged)
+
+    def take(self) -> Optional[PrefetchedJob]:
+        """Stop prefetching and return the prefetched job, waiting for any claim or validation in flight.
+
+        Returns:
+            Optional[PrefetchedJob]: The prefetched job, or None if no job was claimed.
+        """
+        self._done.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            prefetched, self.prefetched, self.claimed = self.prefetched, None, None
+        return prefetched
+
+    def release(self) -> None:
+        """Stop prefetching and drop the prefetched job (if any), e.g. when the worker shuts down.
+
+        A claimed job is dropped even if it is still being staged or
+        validated; its staged files are released once that finishes.
+        """
+        self._done.set()
+        if self._thread:
+            self._thread.join(timeout=Config.API_DEFAULT_TIMEOUT)
+        with self._lock:
+            self._released = True
+            prefetched, self.prefetched = self.prefetched, None
+            data, self.claimed = self.claimed, None
+        if not data:
+            return
+        if prefetched and prefetched.staged:
+            prefetched.staged.release()
+        self.abandon(data)
+
+    @staticmethod
+    def abandon(data: Box) -> None:
+        """Drop a claimed job that was never started, like a job claimed right before the worker stops.
+
+        Args:
+            data (Box): The job data pulled off of the queue.
+        """
+        tracer.discard(data.job_id)
+        logger.warning(f"Worker stopped before starting prefetched job: {data.job_id}")
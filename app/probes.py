@@ -0,0 +1,195 @@
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Union
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.spans import span
+
+PathLike = Union[str, Path]
+
+
+class ProbeCache:
+    """A cache for media probe results (e.g. `ffprobe` or `mkvmerge -J` output).
+
+    Results are keyed by the kind of probe and the path, size, modification time
+    and inode of every file probed, so a file that changes is probed again.
+    Entries are kept in memory with LRU eviction and, optionally, persisted to a
+    local sqlite database so they survive worker restarts.  Only JSON-compatible
+    results are persisted.
+
+    Attributes:
+        size (int): The maximum number of entries kept in memory and on disk
+        path (Path, optional): The sqlite database to persist entries in, otherwise None.
+        entries (OrderedDict[str, Any]): The cached probe results keyed by fingerprint, least recently used first
+        counters (Dict[str, int]): The `hits`, `misses`, and `bypassed` counters
+    """
+    size: int
+    path: Optional[Path]
+    entries: "OrderedDict[str, Any]"
+    counters: Dict[str, int]
+
+    def __init__(self, size: int = 256, path: Optional[str] = None):
+        self.size = size
+        self.path = Path(path) if path else None
+        self.entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "bypassed": 0}
+        self._lock = threading.Lock()
+        self._db = None
+
+    @staticmethod
+    def fingerprint(kind: str, paths: Iterable[PathLike]) -> Optional[str]:
+        """Return the cache key for a probe of the given files.
+
+        Args:
+            kind (str): The kind of probe (e.g. `ffprobe`)
+            paths (Iterable[PathLike]): The files probed
+
+        Returns:
+            Optional[str]: The cache key, or None if a file cannot be read.
+        """
+        files = list()
+        for path in paths:
+            try:
+                path = Path(path).resolve()
+                stat = path.stat()
+            except OSError:
+                return None
+            files.append([str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino])
+        return hashlib.sha1(json.dumps([kind, files]).encode()).hexdigest()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if not self.path:
+            return None
+        if self._db is None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS probes (key TEXT PRIMARY KEY, value TEXT, used_at REAL)")
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Could not open probe cache '{self.path}': {e}")
+                self.path = None
+                return None
+        return self._db
+
+    def _load(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if not (db := self._connect()):
+                return None
+            try:
+                row = db.execute(
+                    "SELECT value FROM probes WHERE key = ?", (key,)).fetchone()
+                if row:
+                    db.execute("UPDATE probes SET used_at = ? WHERE key = ?",
+                               (time.time(), key))
+                    db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read probe cache: {e}")
+                return None
+            if not row:
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def _remember(self, key: str, value: Any) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _store(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._remember(key, value)
+            if not (db := self._connect()):
+                return
+            try:
+                db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?)",
+                           (key, json.dumps(value), time.time()))
+                db.execute(
+                    "DELETE FROM probes WHERE key NOT IN (SELECT key FROM probes ORDER BY used_at DESC LIMIT ?)",
+                    (self.size,))
+                db.commit()
+            except TypeError:
+                logger.debug("Probe result is not serializable, keeping it in memory only.")
+            except sqlite3.Error as e:
+                logger.warning(f"Could not persist probe result: {e}")
+
+    def get(self, kind: str, paths: Union[PathLike, Iterable[PathLike]], probe: Callable[[], Any]) -> Any:
+        """Return the result of a probe, running it only if the files changed since it was cached.
+
+        If any of the files cannot be read, the probe is run without caching so
+        that it can report the error itself.
+
+        Args:
+            kind (str): The kind of probe (e.g. `ffprobe`)
+            paths (Union[PathLike, Iterable[PathLike]]): The file, or files, the probe reads
+            probe (Callable[[], Any]): Runs the probe and returns its result
+
+        Returns:
+            Any: The probe result.  Results loaded from disk are returned as `Box` objects when they are mappings.
+        """
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        with span("probe", kind=kind) as current:
+            if not (key := self.fingerprint(kind, paths)):
+                self._count("bypassed")
+                current.set(cache="bypassed")
+                return probe()
+
+            value = self._load(key)
+            if value is not None:
+                self._count("hits")
+                current.set(cache="hit")
+                value = copy.deepcopy(value)
+                return Box(value) if isinstance(value, dict) else value
+
+            self._count("misses")
+            current.set(cache="miss")
+            value = probe()
+            if value is not None:
+                self._store(key, copy.deepcopy(value))
+            return value
+
+    def put(self, kind: str, paths: Union[PathLike, Iterable[PathLike]], value: Any) -> None:
+        """Cache the result of a probe that was run elsewhere (e.g. by a library).
+
+        Args:
+            kind (str): The kind of probe (e.g. `ffprobe`)
+            paths (Union[PathLike, Iterable[PathLike]]): The file, or files, the probe read
+            value (Any): The probe result
+        """
+        if isinstance(paths, (str, Path)):
+            paths = [paths]
+        if value is not None and (key := self.fingerprint(kind, paths)):
+            self._store(key, copy.deepcopy(value))
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> Dict[str, Union[int, float, None]]:
+        """Return the cache counters.
+
+        Returns:
+            Dict[str, Union[int, float, None]]: The `hits`, `misses`, and `bypassed` counters, the number of `entries`, and the `hit_rate`.
+        """
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            hit_rate = round(self.counters["hits"] / lookups, 3) if lookups else None
+            return self.counters | {"entries": len(self.entries), "hit_rate": hit_rate}
+
+
+probes = ProbeCache(size=Config.PROBE_CACHE_SIZE, path=Config.PROBE_CACHE_PATH)
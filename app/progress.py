@@ -0,0 +1,214 @@
+import json
+import re
+from typing import List, Optional
+
+from box import Box
+
+# HandBrakeCLI log lines (e.g. `[12:34:56] work: ...`) that can be interleaved with its JSON output
+HANDBRAKE_LOG_LINE = re.compile(r"^\[\d{2}:\d{2}:\d{2}\] ")
+
+# The start of a HandBrakeCLI JSON block (e.g. `Progress: {`)
+HANDBRAKE_BLOCK_START = re.compile(r"^([A-Za-z][A-Za-z ]*): (\{.*)$")
+
+
+class FfmpegProgress:
+    """An incremental parser for the `key=value` output of ffmpeg's `-progress` option.
+
+    Data is fed in as raw bytes in whatever chunks the pipe returns.  Every
+    time ffmpeg finishes a progress block (terminated by a `progress=` line),
+    the block is converted into typed values and returned.
+
+    Attributes:
+        current (Box): The most recent complete progress block
+        finished (bool): Whether ffmpeg has reported `progress=end`
+    """
+    current: Box
+    finished: bool
+
+    def __init__(self):
+        self._buffer = b""
+        self._block = dict()
+        self.current = Box()
+        self.finished = False
+
+    def feed(self, chunk: bytes) -> List[Box]:
+        """Parse a chunk of progress output.
+
+        Args:
+            chunk (bytes): The raw data read from the progress pipe.
+
+        Returns:
+            List[Box]: Every progress block completed by this chunk, oldest first.
+        """
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        blocks = list()
+        for line in lines:
+            key, sep, value = line.partition(b"=")
+            if not sep:
+                continue
+            key, value = key.strip().decode(), value.strip().decode()
+            if key != "progress":
+                self._block[key] = value
+                continue
+            self.current = self._convert(self._block)
+            self.finished = value == "end"
+            self._block = dict()
+            blocks.append(self.current)
+        return blocks
+
+    @staticmethod
+    def _convert(block: dict) -> Box:
+        """Convert a raw progress block into typed values.
+
+        Args:
+            block (dict): The raw `key=value` pairs from ffmpeg.
+
+        Returns:
+            Box: The frame, fps, speed (multiplier), bitrate (kbit/s), and output time.
+        """
+        out_time_us = _to_number(block.get("out_time_us"), int)
+        return Box({
+            "frame": _to_number(block.get("frame"), int),
+            "fps": _to_number(block.get("fps"), float),
+            "speed": _to_number(block.get("speed", "").rstrip("x"), float),
+            "bitrate": _to_number(block.get("bitrate", "").removesuffix("kbits/s"), float),
+            "out_time": block.get("out_time"),
+            "out_time_us": out_time_us,
+        })
+
+
+class HandbrakeProgress:
+    """An incremental parser for the JSON progress blocks HandBrakeCLI writes with `--json`.
+
+    HandBrakeCLI writes multi-line blocks such as `Progress: { ... }` between
+    ordinary log lines.  Data is fed in as raw bytes in whatever chunks the pipe
+    returns; every complete `Progress` block is converted into typed values and
+    returned.  Other blocks (`Version`, `JSON Title Set`) and log lines are
+    skipped.
+
+    Attributes:
+        current (Box): The most recent progress event
+        finished (bool): Whether HandBrakeCLI has reported the `WORKDONE` state
+    """
+    current: Box
+    finished: bool
+
+    def __init__(self):
+        self._buffer = b""
+        self._name = None
+        self._lines = list()
+        self._depth = 0
+        self.current = Box()
+        self.finished = False
+
+    def feed(self, chunk: bytes) -> List[Box]:
+        """Parse a chunk of HandBrakeCLI output.
+
+        Args:
+            chunk (bytes): The raw data read from HandBrakeCLI's output.
+
+        Returns:
+            List[Box]: Every progress event completed by this chunk, oldest first.
+        """
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        events = list()
+        for line in lines:
+            line = line.decode(errors="replace").rstrip("\r")
+            if self._name is None:
+                if not (match := HANDBRAKE_BLOCK_START.match(line)):
+                    continue
+                self._name, line = match.groups()
+            elif HANDBRAKE_LOG_LINE.match(line):
+                continue
+
+            self._lines.append(line)
+            self._depth += _brace_depth(line)
+            if self._depth > 0:
+                continue
+
+            name, text = self._name, "\n".join(self._lines)
+            self._name, self._lines, self._depth = None, list(), 0
+            if name != "Progress":
+                continue
+            try:
+                block = json.loads(text)
+            except ValueError:
+                continue
+            self.current = self._convert(block)
+            self.finished = self.current.state == "WORKDONE"
+            events.append(self.current)
+        return events
+
+    @staticmethod
+    def _convert(block: dict) -> Box:
+        """Convert a `Progress` block into typed values.
+
+        Args:
+            block (dict): The decoded `Progress` block.
+
+        Returns:
+            Box: The state, pass number and count, pass progress (0-1), overall progress (0-100), current and average fps, and ETA in seconds.
+        """
+        state = block.get("State")
+        working = block.get("Working") or dict()
+        pass_number = _to_number(working.get("Pass"), int) or 1
+        pass_count = max(_to_number(working.get("PassCount"), int) or 1, pass_number)
+        progress = _to_number(working.get("Progress"), float)
+        overall = None
+        if state == "WORKDONE":
+            overall = 100.0
+        elif progress is not None:
+            overall = min((pass_number - 1 + progress) / pass_count * 100, 100.0)
+        return Box({
+            "state": state,
+            "pass": pass_number,
+            "pass_count": pass_count,
+            "pass_id": _to_number(working.get("PassID"), int),
+            "progress": progress,
+            "overall": overall,
+            "fps": _to_number(working.get("Rate"), float),
+            "avg_fps": _to_number(working.get("RateAvg"), float),
+            "eta": _to_number(working.get("ETASeconds"), int),
+        })
+
+
+def _brace_depth(line: str) -> int:
+    """Return the change in JSON object/array nesting over a line, ignoring brackets inside strings.
+
+    Args:
+        line (str): The line of JSON
+
+    Returns:
+        int: The number of brackets opened minus the number closed.
+    """
+    depth, in_string, escaped = 0, False, False
+    for character in line:
+        if escaped:
+            escaped = False
+        elif character == "\\":
+            escaped = in_string
+        elif character == '"':
+            in_string = not in_string
+        elif not in_string and character in "{[":
+            depth += 1
+        elif not in_string and character in "}]":
+            depth -= 1
+    return depth
+
+
+def _to_number(value: Optional[str], kind: type) -> Optional[float]:
+    """Convert a progress value to a number, ignoring `N/A` and garbage values.
+
+    Args:
+        value (str, optional): The raw value
+        kind (type): Either `int` or `float`
+
+    Returns:
+        Optional[float]: The converted value, or None if it could not be converted.
+    """
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,103 @@
+import importlib
+import threading
+from importlib.metadata import entry_points
+from typing import Dict, Mapping
+
+from loguru import logger
+
+from app.config import Config
+from app.exceptions import InitializationError
+
+
+class ModuleRegistry:
+    """Resolves task module names to their classes once, instead of on every task.
+
+    Modules come from the `[tool.client.modules.enabled]` table in the
+    `pyproject` file and, if enabled, from installed packages that register
+    classes under the `sisyphus.modules` entry point group.  Modules from the
+    `pyproject` file take precedence over plugins with the same name.
+
+    Attributes:
+        enabled (Mapping[str, str]): The `module.path.Class` of every enabled module keyed by module name
+        group (str): The entry point group plugin modules are registered under
+        plugins (bool): Whether to load plugin modules from the entry point group
+        loaded (bool): Whether the modules have been loaded
+        modules (Dict[str, type]): The loaded module classes keyed by module name
+        errors (Dict[str, str]): The error message of every module that failed to load keyed by module name
+    """
+    enabled: Mapping[str, str]
+    group: str
+    plugins: bool
+    loaded: bool
+    modules: Dict[str, type]
+    errors: Dict[str, str]
+
+    def __init__(self, enabled: Mapping[str, str], group: str = "sisyphus.modules", plugins: bool = True):
+        self.enabled = enabled
+        self.group = group
+        self.plugins = plugins
+        self.modules = dict()
+        self.errors = dict()
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Import every enabled module and plugin module.  Failures are recorded instead of raised.
+        """
+        with self._lock:
+            if self.loaded:
+                return
+            if self.plugins:
+                for entry_point in entry_points(group=self.group):
+                    self._load(entry_point.name, entry_point.value)
+            for name, path in self.enabled.items():
+                self._load(name, path)
+            self.loaded = True
+
+    def _load(self, name: str, path: str) -> None:
+        module_path, _, module_name = path.replace(':', '.').rpartition('.')
+        try:
+            module = getattr(importlib.import_module(module_path), module_name)
+        except ImportError as e:
+            self.errors[name] = f"Could not load client module: {module_path}:{module_name}, {e}"
+        except AttributeError:
+            self.errors[name] = f"Could not load client module: {module_path}:{module_name}, module has no attribute '{module_name}'"
+        else:
+            self.modules[name] = module
+            self.errors.pop(name, None)
+            logger.debug(f"Loaded module: {name} -> {module_path}:{module_name}")
+            return
+        logger.warning(self.errors[name])
+
+    def get(self, name: str) -> type:
+        """Return the class of a module.
+
+        Args:
+            name (str): The module name used in job tasks (e.g. `ffmpeg`)
+
+        Raises:
+            InitializationError: When the module is not enabled or could not be loaded.
+
+        Returns:
+            type: The module class.
+        """
+        self.load()
+        if name in self.modules:
+            return self.modules[name]
+        if name in self.errors:
+            raise InitializationError(self.errors[name])
+        raise InitializationError(
+            f"Module not enabled in `pyproject` file: {name}")
+
+    def warmup(self) -> None:
+        """Run the `warmup` hook of every loaded module (e.g. loading schemas, probing binaries).
+        """
+        self.load()
+        for name, module in self.modules.items():
+            try:
+                module.warmup()
+            except Exception as e:
+                logger.warning(f"Could not warm up module '{name}': {e}")
+
+
+registry = ModuleRegistry(Config.MODULES, plugins=Config.MODULE_PLUGINS)
@@ -0,0 +1,127 @@
+import asyncio
+import signal
+import sys
+
+from loguru import logger
+
+from app.config import Config
+from app.executor import SlotExecutor
+from app.heartbeat import Heartbeat, HeartbeatSlot
+from app.jobs import run_job_async
+from app.poller import QueuePoller
+from app.prefetch import Prefetcher
+from app.registry import registry
+
+
+def load_modules() -> None:
+    """Load every task module (and optionally warm them up) before the worker reports idle.
+    """
+    registry.load()
+    logger.info(f"Loaded modules: {', '.join(registry.modules)}")
+    if Config.MODULE_WARMUP:
+        registry.warmup()
+
+
+def run_worker(heartbeat: Heartbeat) -> None:
+    """Poll the queue and run jobs using one thread per job slot.
+
+    Args:
+        heartbeat (Heartbeat): The heartbeat used to report status for every job slot.
+    """
+    heartbeat.start()
+    logger.debug(f"Heartbeat started, sending info to {Config.API_URL}")
+
+    load_modules()
+    poller = QueuePoller()
+    executor = SlotExecutor(
+        heartbeat, on_finished=poller.notify_job_finished)
+    heartbeat.set_idle()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            executor.wait()
+            poller.sleep()
+            if data := poller.poll():
+                executor.submit(executor.acquire(), data)
+    finally:
+        executor.shutdown()
+
+
+async def run_worker_async(heartbeat: Heartbeat) -> None:
+    """Poll the queue, send heartbeats, and run jobs on a single event loop.
+
+    Args:
+        heartbeat (Heartbeat): The heartbeat used to report status for every job slot.
+    """
+    heartbeat_task = asyncio.create_task(heartbeat.run_async())
+    logger.debug(f"Heartbeat started, sending info to {Config.API_URL}")
+
+    await asyncio.to_thread(load_modules)
+    poller = QueuePoller()
+    free = asyncio.Queue()
+    for slot in heartbeat.slots:
+        free.put_nowait(slot)
+    heartbeat.set_idle()
+    timeout = Config.TASK_TIMEOUT if Config.TASK_TIMEOUT > 0 else None
+    jobs = set()
+    wake = asyncio.Event()
+    prefetchers = {
+        i.index: Prefetcher(i.index) for i in heartbeat.slots if Config.PREFETCH_JOBS
+    }
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+
+    async def run_slot(slot: HeartbeatSlot, data) -> None:
+        prefetcher = prefetchers.get(slot.index)
+        try:
+            modules, staged = None, None
+            while data:
+                await run_job_async(data, slot, timeout=timeout, modules=modules,
+                                    prefetcher=prefetcher, staged=staged)
+                if not prefetcher or not (prefetched := await asyncio.to_thread(prefetcher.take)):
+                    break
+                data, modules, staged = prefetched.data, prefetched.modules, prefetched.staged
+        except Exception as e:
+            logger.exception(f"Unhandled error in job slot {slot.index}: {e}")
+            slot.set_idle()
+        finally:
+            free.put_nowait(slot)
+            poller.notify_job_finished()
+            wake.set()
+
+    try:
+        while True:
+            slot = await free.get()
+            try:
+                await asyncio.wait_for(wake.wait(), poller.delay)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            if not (data := await asyncio.to_thread(poller.poll)):
+                free.put_nowait(slot)
+                continue
+            job = asyncio.create_task(run_slot(slot, data))
+            jobs.add(job)
+            job.add_done_callback(jobs.discard)
+    finally:
+        for job in jobs:
+            job.cancel()
+        heartbeat_task.cancel()
+        for prefetcher in prefetchers.values():
+            await asyncio.to_thread(prefetcher.release)
+
+
+def run(heartbeat: Heartbeat) -> None:
+    """Run the worker using the runtime selected by `Config.RUNTIME`.
+
+    Args:
+        heartbeat (Heartbeat): The heartbeat used to report status for every job slot.
+    """
+    if Config.RUNTIME == "asyncio":
+        try:
+            asyncio.run(run_worker_async(heartbeat))
+        except asyncio.CancelledError:
+            logger.info("Worker stopped.")
+    else:
+        run_worker(heartbeat)
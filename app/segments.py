@@ -0,0 +1,321 @@
+import json
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from box import Box
+
+from app.probes import probes
+
+# Options that make an ffmpeg command unsafe to split into independently encoded segments
+UNSPLITTABLE_OPTIONS = {"-pass", "-passlogfile", "-filter_complex", "-lavfi", "-ss", "-to", "-t", "-sseof"}
+
+Segment = Tuple[float, Optional[float]]
+
+
+def probe_keyframes(source: str) -> Box:
+    """Find the keyframes of the first video stream of a file.
+
+    Results are cached in the probe cache.
+
+    Args:
+        source (str): The video file
+
+    Raises:
+        OSError: `ffprobe` could not be run.
+        subprocess.CalledProcessError: `ffprobe` could not read the file.
+
+    Returns:
+        Box: The `duration` of the file and the `keyframes` (timestamps in seconds).
+    """
+    def probe() -> dict:
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+             "-show_entries", "frame=pts_time:format=duration", "-of", "json", source],
+            capture_output=True, check=True).stdout
+        data = json.loads(output)
+        keyframes = sorted(
+            float(i["pts_time"]) for i in data.get("frames", []) if i.get("pts_time") not in (None, "N/A"))
+        return {"duration": float(data["format"]["duration"]), "keyframes": keyframes}
+
+    return Box(probes.get("ffprobe.keyframes", source, probe))
+
+
+def plan_segments(duration: float, keyframes: List[float], count: int, minimum: float) -> List[Segment]:
+    """Split a video into roughly equal segments that start on keyframes.
+
+    Args:
+        duration (float): The duration of the video in seconds
+        keyframes (List[float]): The keyframe timestamps in seconds
+        count (int): The number of segments wanted
+        minimum (float): The minimum duration of a segment in seconds
+
+    Returns:
+        List[Segment]: The `(start, end)` of every segment; the last segment has no end.
+    """
+    count = max(1, min(count, int(duration // max(minimum, 1))))
+    starts = [0.0]
+    for i in range(1, count):
+        target = duration * i / count
+        nearest = min(keyframes, key=lambda k: abs(k - target), default=None)
+        if nearest is not None and nearest - starts[-1] >= minimum and duration - nearest >= minimum:
+            starts.append(nearest)
+    return [
+        (start, starts[i + 1] if i + 1 < len(starts) else None) for i, start in enumerate(starts)
+    ]
+
+
+def unsplittable(command: List[str]) -> Optional[str]:
+    """Check whether an ffmpeg command can be split into segments.
+
+    Args:
+        command (List[str]): The ffmpeg command
+
+    Returns:
+        Optional[str]: The option preventing it, or None if the command can be split.
+    """
+    return next((i for i in command if i in UNSPLITTABLE_OPTIONS), None)
+
+
+def probe_stream_types(source: str) -> List[str]:
+    """Find the type (`video`, `audio`, ...) of every stream of a file, in order.
+
+    Results are cached in the probe cache.
+
+    Args:
+        source (str): The media file
+
+    Raises:
+        OSError: `ffprobe` could not be run.
+        subprocess.CalledProcessError: `ffprobe` could not read the file.
+
+    Returns:
+        List[str]: The `codec_type` of every stream.
+    """
+    def probe() -> list:
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type", "-of", "json", source],
+            capture_output=True, check=True).stdout
+        return [i.get("codec_type", "") for i in json.loads(output).get("streams", [])]
+
+    return probes.get("ffprobe.stream_types", source, probe)
+
+
+def video_first(command: List[str]) -> bool:
+    """Check whether the output of an ffmpeg command has its video streams before every other stream.
+
+    The segmented encode muxes the joined video before the other streams, so
+    it only produces the same stream order as the original command if the
+    original's `-map` options (or ffmpeg's default stream selection) put the
+    video first.
+
+    Args:
+        command (List[str]): The ffmpeg command
+
+    Raises:
+        OSError: `ffprobe` could not be run.
+        subprocess.CalledProcessError: `ffprobe` could not read an input.
+
+    Returns:
+        bool: `True` if the video streams come first, `False` if not (or the order cannot be told from the maps).
+    """
+    inputs = [command[i + 1] for i, token in enumerate(command[:-1]) if token == "-i"]
+    maps = [command[i + 1].rstrip("?") for i, token in enumerate(command[:-1]) if token == "-map"]
+    types = list()
+    for specifier in maps:
+        if specifier.startswith("-"):
+            # Negative maps only remove streams
+            continue
+        source, _, stream = specifier.partition(":")
+        if not source.isdigit() or int(source) >= len(inputs):
+            return False
+        if not stream:
+            types += probe_stream_types(inputs[int(source)])
+        elif stream.isdigit():
+            streams = probe_stream_types(inputs[int(source)])
+            if int(stream) >= len(streams):
+                return False
+            types.append(streams[int(stream)])
+        elif stream[0] in "vV":
+            types.append("video")
+        elif stream[0] in "asdt":
+            types.append("other")
+        else:
+            return False
+    # Without maps, ffmpeg's default stream selection puts the video first
+    kinds = ["video" if i == "video" else "other" for i in types]
+    return kinds == sorted(kinds, key=lambda i: i != "video")
+
+
+class SegmentManifest:
+    """The segments of a checkpointed encode that were already encoded, kept next to the segment files.
+
+    The manifest is rewritten (atomically) every time a segment finishes, so
+    after a crash, or after the worker restarts and the job is claimed again,
+    only the missing segments have to be encoded.  It is only used while the
+    command and sources match the ones it was written for.
+
+    Attributes:
+        path (Path): The manifest file
+        key (str): Identifies the command and sources the segments belong to
+        plan (List[Segment]): The segments of the encode
+        completed (Dict[str, dict]): The `size` and `frames` of every finished segment file keyed by file name
+    """
+    path: Path
+    key: str
+    plan: List[Segment]
+    completed: Dict[str, dict]
+
+    def __init__(self, path: Path, key: str, plan: List[Segment], completed: Optional[Dict[str, dict]] = None):
+        self.path = path
+        self.key = key
+        self.plan = plan
+        self.completed = completed or dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path, key: str) -> Optional["SegmentManifest"]:
+        """Load the manifest of an interrupted encode.
+
+        Args:
+            path (Path): The manifest file
+            key (str): Identifies the command and sources of the encode
+
+        Returns:
+            Optional[SegmentManifest]: The manifest, or None if there is none (or it belongs to a different encode).
+        """
+        try:
+            data = json.loads(path.read_text())
+            if data["key"] != key:
+                return None
+            plan = [(start, end) for start, end in data["plan"]]
+            return cls(path, key, plan, data["completed"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def is_complete(self, segment: Path) -> bool:
+        """Check whether a segment file was finished and is still intact.
+
+        Args:
+            segment (Path): The segment file
+
+        Returns:
+            bool: `True` if the segment does not have to be encoded again, otherwise `False`
+        """
+        with self._lock:
+            entry = self.completed.get(segment.name)
+        try:
+            return entry is not None and segment.stat().st_size == entry["size"]
+        except OSError:
+            return False
+
+    def frames(self, segment: Path) -> int:
+        """Return the number of frames encoded in a finished segment.
+
+        Args:
+            segment (Path): The segment file
+
+        Returns:
+            int: The number of frames, 0 if the segment is not finished.
+        """
+        with self._lock:
+            return self.completed.get(segment.name, {}).get("frames") or 0
+
+    def record(self, segment: Path, frames: int) -> None:
+        """Record a finished segment file and save the manifest.
+
+        Args:
+            segment (Path): The segment file
+            frames (int): The number of frames encoded in the segment
+        """
+        with self._lock:
+            self.completed[segment.name] = {"size": segment.stat().st_size, "frames": frames}
+            data = {"key": self.key, "plan": self.plan, "completed": self.completed}
+            temp_path = self.path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(data))
+            temp_path.replace(self.path)
+
+
+def _with_output(command: List[str], options: List[str], output: Path) -> List[str]:
+    arguments = [i for i in command[1:-1] if i not in ("-y", "-n")]
+    return [command[0], "-y"] + arguments + options + [str(output)]
+
+
+def segment_command(command: List[str], segment: Segment, output: Path, threads: Optional[int] = None) -> List[str]:
+    """Build the command encoding the video of one segment.
+
+    Every input is seeked to the segment so that they stay in sync, and audio,
+    subtitle, and data streams are dropped (they are handled once for the
+    whole file).
+
+    Args:
+        command (List[str]): The ffmpeg command for the whole file, ending with the output file
+        segment (Segment): The start and end of the segment in seconds
+        output (Path): The segment file to write
+        threads (int, optional): The number of encoder threads to use. Defaults to None (the encoder's choice).
+
+    Returns:
+        List[str]: The command.
+    """
+    start, end = segment
+    seek = ["-ss", f"{start:.6f}"] + (["-to", f"{end:.6f}"] if end is not None else [])
+    result = list()
+    for token in command:
+        if token == "-i":
+            result.extend(seek)
+        result.append(token)
+    options = ["-an", "-sn", "-dn", "-map_chapters", "-1"]
+    if threads:
+        options += ["-threads", str(threads)]
+    return _with_output(result, options, output)
+
+
+def auxiliary_command(command: List[str], output: Path) -> List[str]:
+    """Build the command processing everything but the video (audio, subtitles, chapters) once.
+
+    Args:
+        command (List[str]): The ffmpeg command for the whole file, ending with the output file
+        output (Path): The file to write
+
+    Returns:
+        List[str]: The command.
+    """
+    return _with_output(command, ["-vn"], output)
+
+
+def concat_command(binary: str, segments: Path, output: Path) -> List[str]:
+    """Build the command joining the encoded segments without re-encoding.
+
+    Args:
+        binary (str): The ffmpeg binary
+        segments (Path): The concat demuxer list of segment files
+        output (Path): The file to write
+
+    Returns:
+        List[str]: The command.
+    """
+    return [binary, "-v", "error", "-y", "-f", "concat", "-safe", "0",
+            "-i", str(segments), "-map", "0", "-c", "copy", str(output)]
+
+
+def mux_command(binary: str, video: Path, auxiliary: Optional[Path], output: str, overwrite: bool) -> List[str]:
+    """Build the command muxing the joined video with the audio, subtitles, and chapters.
+
+    Args:
+        binary (str): The ffmpeg binary
+        video (Path): The joined video file
+        auxiliary (Path, optional): The file with the other streams, or None if the output has only video.
+        output (str): The output file of the original command
+        overwrite (bool): Whether the original command overwrites the output file (`-y`)
+
+    Returns:
+        List[str]: The command.
+    """
+    command = [binary, "-v", "error"] + (["-y"] if overwrite else []) + ["-i", str(video)]
+    if auxiliary:
+        command += ["-i", str(auxiliary), "-map", "0", "-map", "1",
+                    "-map_metadata", "1", "-map_chapters", "1"]
+    else:
+        command += ["-map", "0"]
+    return command + ["-c", "copy", output]
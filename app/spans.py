@@ -0,0 +1,334 @@
+import json
+import os
+import secrets
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from loguru import logger
+
+from app.config import Config
+
+
+class Span:
+    """A timed phase of a job (e.g. `validate`, `run`, `process`).
+
+    Attributes:
+        name (str): The name of the phase
+        span_id (str): The random ID of the span (16 hex digits)
+        parent_id (str, optional): The ID of the enclosing span, otherwise None.
+        start (int): When the phase started (epoch nanoseconds)
+        end (int, optional): When the phase ended (epoch nanoseconds), or None while it is running.
+        attributes (Dict[str, Any]): Details of the phase (e.g. the module name, the exit code)
+    """
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: int
+    end: Optional[int]
+    attributes: Dict[str, Any]
+
+    def __init__(self, name: str, /, parent: Optional["Span"] = None, start: Optional[int] = None, **attributes):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start = start if start is not None else time.time_ns()
+        self.end = None
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+
+    def set(self, **attributes) -> None:
+        """Add details to the span.  Attributes set to None are skipped.
+        """
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def finish(self, end: Optional[int] = None) -> None:
+        if self.end is None:
+            self.end = end if end is not None else time.time_ns()
+
+    @property
+    def duration(self) -> float:
+        """The duration of the span in seconds (so far, if it is still running).
+
+        Returns:
+            float: The duration.
+        """
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def as_dict(self, origin: int) -> dict:
+        """Return the span for the job results.
+
+        Args:
+            origin (int): The start of the job (epoch nanoseconds)
+
+        Returns:
+            dict: The `name`, `start` (seconds since the start of the job), `duration` (seconds), and `attributes`.
+        """
+        data = {
+            "name": self.name,
+            "start": round((self.start - origin) / 1e9, 6),
+            "duration": round(self.duration, 6),
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        return data
+
+    def to_otlp(self, trace_id: str) -> dict:
+        """Return the span in the OTLP/JSON format.
+
+        Args:
+            trace_id (str): The ID of the trace (32 hex digits)
+
+        Returns:
+            dict: The span.
+        """
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if "error" in self.attributes:
+            span["status"] = {"code": 2, "message": str(self.attributes["error"])}
+        return span
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()]
+
+
+class JobTrace:
+    """The timing spans of one job, from claiming it to reporting its completion.
+
+    Attributes:
+        job_id (str): The ID of the job
+        trace_id (str): The random ID of the trace (32 hex digits)
+        root (Span): The span covering the whole job
+        spans (List[Span]): The finished spans, in the order they finished
+    """
+    job_id: str
+    trace_id: str
+    root: Span
+    spans: List[Span]
+
+    def __init__(self, job_id: str, start: Optional[int] = None):
+        self.job_id = job_id
+        self.trace_id = secrets.token_hex(16)
+        self.root = Span("job", start=start, job_id=job_id)
+        self.spans = list()
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def record(self, name: str, /, start: int, end: Optional[int] = None, **attributes) -> Span:
+        """Add a span for a phase that was timed elsewhere (e.g. before the trace existed).
+
+        Args:
+            name (str): The name of the phase
+            start (int): When the phase started (epoch nanoseconds)
+            end (int, optional): When the phase ended (epoch nanoseconds). Defaults to now.
+
+        Returns:
+            Span: The span.
+        """
+        span = Span(name, parent=self.root, start=start, **attributes)
+        span.finish(end)
+        self.add(span)
+        return span
+
+    def activate(self) -> None:
+        """Record the spans of the current thread (or asyncio task) in this trace.
+        """
+        _trace.set(self)
+        _span.set(self.root)
+
+    def as_list(self) -> List[dict]:
+        """Return the finished spans for the job results, in the order they started.
+
+        Returns:
+            List[dict]: The spans.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda i: i.start)
+        return [i.as_dict(self.root.start) for i in spans]
+
+    def to_otlp(self) -> dict:
+        """Return the trace as an OTLP/JSON `TracesData` message.
+
+        Returns:
+            dict: The trace.
+        """
+        with self._lock:
+            spans = [self.root] + list(self.spans)
+        resource = {
+            "service.name": "sisyphus-client",
+            "service.version": Config.VERSION,
+            "host.name": Config.HOSTNAME,
+            "service.instance.id": Config.HOST_UUID,
+        }
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes(resource)},
+            "scopeSpans": [{
+                "scope": {"name": "sisyphus-client", "version": Config.VERSION},
+                "spans": [i.to_otlp(self.trace_id) for i in spans],
+            }],
+        }]}
+
+
+_trace: ContextVar[Optional[JobTrace]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+@contextmanager
+def span(name: str, /, **attributes) -> Iterator[Span]:
+    """Time a phase of the current job.
+
+    The span is recorded in the trace of the current thread (or asyncio task),
+    nested in the enclosing span.  Without an active trace the span is timed
+    but not recorded.  If the phase raises, the exception type is recorded as
+    the `error` attribute.
+
+    Args:
+        name (str): The name of the phase
+
+    Yields:
+        Span: The span, to add details to.
+    """
+    trace = _trace.get()
+    current = Span(name, parent=_span.get(), **attributes)
+    if trace is None:
+        yield current
+        return
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _span.reset(token)
+        current.finish()
+        trace.add(current)
+
+
+def wait_process(process: subprocess.Popen, current: Optional[Span] = None) -> int:
+    """Wait for a process to exit, recording its CPU time and peak memory on a span.
+
+    Args:
+        process (subprocess.Popen): The process
+        current (Span, optional): The span to record the usage on. Defaults to None (only wait).
+
+    Returns:
+        int: The exit/return code of the process.
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if current:
+        current.set(
+            exit_code=process.returncode,
+            cpu_user=round(usage.ru_utime, 3),
+            cpu_system=round(usage.ru_stime, 3),
+            max_rss_kb=usage.ru_maxrss,
+        )
+    return process.returncode
+
+
+class Tracer:
+    """Keeps the trace of every job from the moment it is claimed until its completion is reported.
+
+    Traces are looked up by job ID so that the poller, the prefetcher, and the
+    job slot can all add spans to the same job without passing the trace along.
+
+    Attributes:
+        export_path (Path, optional): The file finished traces are appended to as OTLP/JSON lines, otherwise None.
+        traces (Dict[str, JobTrace]): The traces of the claimed jobs keyed by job ID
+    """
+    export_path: Optional[Path]
+    traces: Dict[str, JobTrace]
+
+    def __init__(self, export_path: Optional[str] = None):
+        self.export_path = Path(export_path) if export_path else None
+        self.traces = dict()
+        self._lock = threading.Lock()
+
+    def start(self, job_id: str, start: Optional[int] = None) -> JobTrace:
+        """Start a new trace for a job.
+
+        Args:
+            job_id (str): The ID of the job
+            start (int, optional): When the job was claimed (epoch nanoseconds). Defaults to now.
+
+        Returns:
+            JobTrace: The trace.
+        """
+        trace = JobTrace(job_id, start)
+        with self._lock:
+            self.traces[job_id] = trace
+        return trace
+
+    def get(self, job_id: str) -> JobTrace:
+        """Return the trace of a job, starting one if there is none.
+
+        Args:
+            job_id (str): The ID of the job
+
+        Returns:
+            JobTrace: The trace.
+        """
+        with self._lock:
+            trace = self.traces.get(job_id)
+        return trace or self.start(job_id)
+
+    def discard(self, job_id: str) -> Optional[JobTrace]:
+        """Stop keeping the trace of a job (e.g. finished or returned to the queue).
+
+        Args:
+            job_id (str): The ID of the job
+
+        Returns:
+            Optional[JobTrace]: The trace, or None if there was none.
+        """
+        with self._lock:
+            return self.traces.pop(job_id, None)
+
+    def export(self, trace: JobTrace) -> None:
+        """Append a finished trace to the export file, if one is configured.
+
+        Args:
+            trace (JobTrace): The trace
+        """
+        if not self.export_path:
+            return
+        line = json.dumps(trace.to_otlp()) + "\n"
+        try:
+            self.export_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock, self.export_path.open("a") as f:
+                f.write(line)
+        except OSError as e:
+            logger.warning(f"Could not export trace to '{self.export_path}': {e}")
+
+
+tracer = Tracer(Config.TRACE_EXPORT_PATH)
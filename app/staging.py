@@ -0,0 +1,388 @@
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from box import Box
+from loguru import logger
+
+from app.config import Config
+from app.exceptions import StagingError, ValidationError
+from app.fileops import copy_file
+from app.probes import ProbeCache
+from app.streams import JobStreams
+
+
+class ScratchEntry:
+    """A source file copied to the scratch space.
+
+    Attributes:
+        remote (Path): The original path of the file
+        local (Path): The path of the copy in the scratch space
+        size (int): The size of the file
+        users (int): The number of jobs currently using the copy
+        last_used (float): When a job last started using the copy (epoch seconds)
+    """
+    remote: Path
+    local: Path
+    size: int
+    users: int
+    last_used: float
+
+    def __init__(self, remote: Path, local: Path, size: int):
+        self.remote = remote
+        self.local = local
+        self.size = size
+        self.users = 1
+        self.last_used = time.time()
+
+
+class ScratchManager:
+    """Keeps copies of job source files on local scratch space.
+
+    Copies are keyed by the path, size, modification time and inode of the
+    original, so a source that is used by several jobs (e.g. a shared audio
+    track) is only copied once while it is unchanged.  When the scratch space
+    is full, the least recently used copies no job is using are evicted.
+
+    Attributes:
+        root (Path, optional): The scratch directory, or None if staging is disabled.
+        capacity (int): The maximum number of bytes of source copies to keep
+        entries (OrderedDict[str, ScratchEntry]): The source copies keyed by fingerprint, least recently used first
+        counters (Dict[str, int]): The `hits`, `misses`, `evictions`, `bytes_staged`, and `bytes_written` counters
+    """
+    root: Optional[Path]
+    capacity: int
+    entries: "OrderedDict[str, ScratchEntry]"
+    counters: Dict[str, int]
+
+    def __init__(self, root: Optional[str] = None, capacity: int = 50 * 1024 ** 3):
+        self.root = Path(root) if root else None
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.counters = {
+            "hits": 0, "misses": 0, "evictions": 0, "bytes_staged": 0, "bytes_written": 0,
+        }
+        self._condition = threading.Condition()
+        self._loading = dict()
+        self._prepared = False
+
+    @property
+    def enabled(self) -> bool:
+        """Whether staging is enabled.
+
+        Returns:
+            bool: `True` if a scratch directory is configured, otherwise `False`
+        """
+        return self.root is not None
+
+    def _prepare(self) -> None:
+        if self._prepared:
+            return
+        for directory in ("cache", "jobs"):
+            shutil.rmtree(self.root / directory, ignore_errors=True)
+            (self.root / directory).mkdir(parents=True, exist_ok=True)
+        self._prepared = True
+
+    def _used(self) -> int:
+        return sum(i.size for i in self.entries.values()) + sum(self._loading.values())
+
+    def _make_room(self, size: int) -> bool:
+        while self._used() + size > self.capacity:
+            victim = next(
+                (k for k, v in self.entries.items() if v.users == 0), None)
+            if victim is None:
+                return False
+            self._evict(victim)
+        return shutil.disk_usage(self.root).free > size
+
+    def _evict(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        shutil.rmtree(entry.local.parent, ignore_errors=True)
+        self.counters["evictions"] += 1
+        logger.debug(f"Evicted from scratch space: {str(entry.remote)}")
+
+    def acquire(self, remote: Path) -> Optional[Path]:
+        """Return a local copy of a source file, copying it to the scratch space if needed.
+
+        Every call must be matched by a call to `release`.
+
+        Args:
+            remote (Path): The source file
+
+        Raises:
+            StagingError: The file could not be copied to the scratch space.
+
+        Returns:
+            Optional[Path]: The path of the local copy, or None if there is not enough scratch space for it.
+        """
+        if not (key := ProbeCache.fingerprint("scratch", [remote])):
+            raise StagingError(f"Could not read source file '{str(remote)}'")
+        size = remote.stat().st_size
+        with self._condition:
+            self._prepare()
+            self._condition.wait_for(lambda: key not in self._loading)
+            if entry := self.entries.get(key):
+                entry.users += 1
+                entry.last_used = time.time()
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry.local
+            if not self._make_room(size):
+                logger.info(f"Not enough scratch space for '{str(remote)}', using it in place.")
+                return None
+            self._loading[key] = size
+
+        local = self.root / "cache" / key / remote.name
+        try:
+            local.parent.mkdir(parents=True, exist_ok=True)
+            result = copy_file(remote, local)
+        except OSError as e:
+            shutil.rmtree(local.parent, ignore_errors=True)
+            raise StagingError(f"Could not stage '{str(remote)}': {e}")
+        finally:
+            with self._condition:
+                self._loading.pop(key)
+                self._condition.notify_all()
+
+        with self._condition:
+            self.entries[key] = ScratchEntry(remote, local, size)
+            self.counters["misses"] += 1
+            self.counters["bytes_staged"] += size
+        logger.debug(f"Staged '{str(remote)}' -> '{str(local)}' ({result})")
+        return local
+
+    def release(self, local: Path, invalidate: bool = False) -> None:
+        """Stop using a local copy of a source file.
+
+        Args:
+            local (Path): The path of the local copy returned by `acquire`
+            invalidate (bool, optional): Whether to discard the copy (e.g. because a task modified it). Defaults to False.
+        """
+        with self._condition:
+            for key, entry in self.entries.items():
+                if entry.local == local:
+                    entry.users = max(0, entry.users - 1)
+                    if invalidate and entry.users == 0:
+                        self._evict(key)
+                    return
+
+    def job_dir(self, job_id: str) -> Path:
+        """Return the scratch directory for the outputs of a job.
+
+        Args:
+            job_id (str): The ID of the job
+
+        Returns:
+            Path: The directory.
+        """
+        with self._condition:
+            self._prepare()
+        return self.root / "jobs" / job_id
+
+    def count(self, counter: str, value: int = 1) -> None:
+        with self._condition:
+            self.counters[counter] += value
+
+    def stats(self) -> Dict[str, int]:
+        """Return the scratch space counters.
+
+        Returns:
+            Dict[str, int]: The counters, the number of `entries`, and the number of bytes `used`.
+        """
+        with self._condition:
+            return self.counters | {"entries": len(self.entries), "used": self._used()}
+
+
+class StagedJob:
+    """A job whose source files were copied to scratch space and whose outputs are written there.
+
+    Attributes:
+        data (Box): The job data with the staged paths rewritten to the scratch space
+        inputs (Dict[Path, Path]): The local copies of the source files keyed by their original path
+        outputs (Dict[Path, Path]): The local paths of the output files keyed by their original path
+        tasks (Set[int]): The indexes of the tasks that use the staged paths
+        directory (Path): The scratch directory for the outputs of the job
+        streams (Set[Path]): The paths of the job's streams, which are never staged
+    """
+    data: Box
+    inputs: Dict[Path, Path]
+    outputs: Dict[Path, Path]
+    tasks: Set[int]
+    directory: Path
+    streams: Set[Path]
+
+    def __init__(self, data: Box, scratch: ScratchManager):
+        self.data = data
+        self.inputs = dict()
+        self.outputs = dict()
+        self.tasks = set()
+        self.directory = scratch.job_dir(str(data.job_id))
+        try:
+            self.streams = JobStreams(data).paths
+        except ValidationError:
+            # The job fails validation anyway
+            self.streams = set()
+        self._scratch = scratch
+        self._staged = dict()
+        self._written = dict()
+
+    def covers(self, idx: int) -> bool:
+        """Check whether a task uses the staged paths.
+
+        Args:
+            idx (int): The index of the task in the job
+
+        Returns:
+            bool: `True` if the task reads or writes the scratch space, otherwise `False`
+        """
+        return idx in self.tasks
+
+    def stage(self, value: str) -> str:
+        """Map a path in the task data to the scratch space.
+
+        Existing files are copied to the scratch space; paths that do not exist
+        yet are treated as outputs.  Other values are returned unchanged.
+
+        Args:
+            value (str): A value from the task data
+
+        Raises:
+            StagingError: A source file could not be copied to the scratch space.
+
+        Returns:
+            str: The path to use instead.
+        """
+        path = Path(value)
+        roots = [Path(i) for i in Config.STAGING_ROOTS]
+        if not path.is_absolute() or not (root := next((i for i in roots if path.is_relative_to(i)), None)):
+            return value
+        if path in self.streams:
+            return value
+        if path in self.inputs:
+            return str(self.inputs[path])
+        if path in self.outputs:
+            return str(self.outputs[path])
+        if path.is_file():
+            if not (local := self._scratch.acquire(path)):
+                return value
+            self.inputs[path] = local
+            self._staged[local] = self._signature(local)
+            return str(local)
+        if path.exists():
+            return value
+        local = self.directory / path.relative_to(root)
+        local.parent.mkdir(parents=True, exist_ok=True)
+        self.outputs[path] = local
+        return str(local)
+
+    def _rewrite(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {k: self._rewrite(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._rewrite(i) for i in value]
+        if isinstance(value, str):
+            return self.stage(value)
+        return value
+
+    @staticmethod
+    def _signature(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _files(self) -> List[Tuple[Path, Path]]:
+        files = list()
+        for remote, local in self.outputs.items():
+            if local.is_dir():
+                files.extend(
+                    (remote / i.relative_to(local), i) for i in sorted(local.rglob("*")) if i.is_file())
+            elif local.is_file():
+                files.append((remote, local))
+        for remote, local in self.inputs.items():
+            if self._signature(local) != self._staged[local]:
+                files.append((remote, local))
+        return files
+
+    def write_back(self) -> int:
+        """Copy the outputs (and any modified source files) back to their original paths.
+
+        Files already written back are skipped unless they changed since.
+
+        Raises:
+            StagingError: A file could not be written back.
+
+        Returns:
+            int: The number of bytes written back.
+        """
+        written = 0
+        for remote, local in self._files():
+            signature = self._signature(local)
+            if self._written.get(local) == signature:
+                continue
+            try:
+                remote.parent.mkdir(parents=True, exist_ok=True)
+                result = copy_file(local, remote)
+            except OSError as e:
+                raise StagingError(f"Could not write back '{str(remote)}': {e}")
+            logger.debug(f"Wrote back '{str(local)}' -> '{str(remote)}' ({result})")
+            self._written[local] = signature
+            written += result.size
+        self._scratch.count("bytes_written", written)
+        return written
+
+    def release(self) -> None:
+        """Stop using the staged source files and remove the job's outputs from the scratch space.
+        """
+        for local in self.inputs.values():
+            self._scratch.release(
+                local, invalidate=self._signature(local) != self._staged[local])
+        self.inputs = dict()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def summary(self) -> dict:
+        """Return the staged files for the job results.
+
+        Returns:
+            dict: The number of staged `inputs` and `outputs`.
+        """
+        return {"inputs": len(self.inputs), "outputs": len(self.outputs)}
+
+
+def stage_job(data: Box) -> StagedJob:
+    """Copy the source files of a job to the scratch space and rewrite its task data to use them.
+
+    Only tasks of the modules in `Config.STAGING_MODULES` are staged, and only
+    paths under `Config.STAGING_ROOTS` (e.g. a network mount).  Streams are
+    left in place.
+
+    Args:
+        data (Box): The job data pulled off of the queue.
+
+    Raises:
+        StagingError: A source file could not be copied to the scratch space.
+
+    Returns:
+        StagedJob: The staged job.
+    """
+    staged = StagedJob(Box(data.to_dict()), scratch)
+    try:
+        for idx, task in enumerate(staged.data.tasks):
+            if task.module not in Config.STAGING_MODULES:
+                continue
+            task.data = staged._rewrite(task.data.to_dict())
+            staged.tasks.add(idx)
+    except BaseException:
+        staged.release()
+        raise
+    if staged.inputs:
+        logger.info(f"Staged {len(staged.inputs)} source file(s) to scratch space.")
+    return staged
+
+
+scratch = ScratchManager(
+    Config.STAGING_DIR, capacity=int(Config.STAGING_CAPACITY * 1024 ** 3))
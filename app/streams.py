@@ -0,0 +1,172 @@
+import os
+import stat
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Set, Union
+
+from box import Box
+from loguru import logger
+
+from app.exceptions import RunError, ValidationError
+
+
+def mentioned_paths(value: Any) -> Set[Path]:
+    """Return every string in the task data as a path.
+
+    Args:
+        value (Any): The task data
+
+    Returns:
+        Set[Path]: The paths.
+    """
+    if isinstance(value, dict):
+        return set().union(*(mentioned_paths(i) for i in value.values()))
+    if isinstance(value, list):
+        return set().union(*(mentioned_paths(i) for i in value))
+    if isinstance(value, str) and value:
+        return {Path(value)}
+    return set()
+
+
+class JobStreams:
+    """The task outputs of a job that are streamed to later tasks through named pipes (FIFOs).
+
+    A task declares outputs as streams with a `streams` list next to its
+    `module` and `data`.  Every later task whose data mentions a stream reads
+    it, so the task writing the stream, the tasks reading it, and any tasks in
+    between form a group that is started together.  The named pipes only exist
+    while their group runs.
+
+    Attributes:
+        producers (Dict[Path, int]): The index of the task writing each stream keyed by its path
+        consumers (Dict[Path, List[int]]): The indexes of the tasks reading each stream keyed by its path
+        groups (List[List[int]]): The indexes of the tasks of the job, grouped by the tasks that run together
+    """
+    producers: Dict[Path, int]
+    consumers: Dict[Path, List[int]]
+    groups: List[List[int]]
+
+    def __init__(self, data: Union[dict, Box]):
+        """Find the streams of a job and group its tasks.
+
+        Args:
+            data (Union[dict, Box]): The job data
+
+        Raises:
+            ValidationError: A stream is declared twice or is not read by a later task.
+        """
+        data = Box(data)
+        self.producers = dict()
+        self.consumers = dict()
+        for idx, task in enumerate(data.tasks):
+            for stream in task.get("streams", []):
+                stream = Path(stream)
+                if stream in self.producers:
+                    raise ValidationError(
+                        f"Stream '{str(stream)}' is written by tasks {self.producers[stream] + 1} and {idx + 1}.")
+                self.producers[stream] = idx
+                self.consumers[stream] = list()
+        for idx, task in enumerate(data.tasks):
+            for stream in mentioned_paths(task.data.to_dict()) & set(self.producers):
+                if idx > self.producers[stream]:
+                    self.consumers[stream].append(idx)
+        for stream, consumers in self.consumers.items():
+            if not consumers:
+                raise ValidationError(f"Stream '{str(stream)}' is not read by any later task.")
+
+        self.groups = list()
+        end = -1
+        for idx in range(len(data.tasks)):
+            if idx > end:
+                self.groups.append(list())
+            self.groups[-1].append(idx)
+            end = max([end, idx] + [self.consumers[i][-1] for i, j in self.producers.items() if j == idx])
+
+    @property
+    def paths(self) -> Set[Path]:
+        """The paths of every stream of the job.
+
+        Returns:
+            Set[Path]: The paths.
+        """
+        return set(self.producers)
+
+    def streams(self, group: List[int]) -> List[Path]:
+        """Return the streams written by a group of tasks.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+
+        Returns:
+            List[Path]: The paths of the streams.
+        """
+        return [i for i, j in self.producers.items() if j in group]
+
+    @contextmanager
+    def open(self, group: List[int]) -> Iterator[List[Path]]:
+        """Create the named pipes of a group of tasks, removing them once the group finished.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+
+        Raises:
+            RunError: A named pipe could not be created.
+
+        Yields:
+            List[Path]: The paths of the named pipes.
+        """
+        streams = self.streams(group)
+        try:
+            for stream in streams:
+                if os.path.lexists(stream) and not stream.is_fifo():
+                    raise RunError(f"Stream '{str(stream)}' already exists and is not a named pipe.")
+                stream.unlink(missing_ok=True)
+                stream.parent.mkdir(parents=True, exist_ok=True)
+                os.mkfifo(stream)
+        except OSError as e:
+            self.remove(streams)
+            raise RunError(f"Could not create stream: {e}")
+        except RunError:
+            self.remove(streams)
+            raise
+        logger.info(f"Streaming {len(streams)} task output(s) through named pipes.")
+        try:
+            yield streams
+        finally:
+            self.remove(streams)
+
+    @staticmethod
+    def remove(streams: List[Path]) -> None:
+        """Remove named pipes, leaving anything else at their paths alone.
+
+        Args:
+            streams (List[Path]): The paths of the named pipes
+        """
+        for stream in streams:
+            try:
+                if stat.S_ISFIFO(stream.lstat().st_mode):
+                    stream.unlink()
+            except OSError:
+                pass
+
+    def abort(self, group: List[int]) -> None:
+        """Unblock every task of a group that is waiting on one of its named pipes.
+
+        Each pipe is briefly opened at both ends and closed again: a task still
+        opening a pipe is released, a task reading it gets the end of the
+        stream, and a task writing it gets a broken pipe once no task reads it.
+
+        Args:
+            group (List[int]): The indexes of the tasks
+        """
+        for stream in self.streams(group):
+            try:
+                reader = os.open(stream, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            try:
+                os.close(os.open(stream, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            finally:
+                os.close(reader)
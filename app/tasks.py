@@ -1,14 +1,18 @@
-import importlib
-import importlib.util
-from typing import List, Union
+from typing import List, Optional, Union
 
 import requests
 import box
 from box import Box
 from loguru import logger
 
+from app.api import api
 from app.config import Config
 from app.exceptions import InitializationError, NetworkError
+from app.graph import TaskGraph
+from app.heartbeat import HeartbeatSlot
+from app.registry import registry
+from app.spans import span
+from app.streams import JobStreams
 
 
 def connect_to_api(method: str, rest_path: str, fail_message: str, **kwargs) -> requests.Response:
@@ -25,57 +29,45 @@ def connect_to_api(method: str, rest_path: str, fail_message: str, **kwargs) ->
     Returns:
         requests.Response: The resulting response from the request.
     """
-    url = Config.API_URL + rest_path
     try:
-        logger.debug(f"Attempting '{method}' request on: '{url}'")
-        r = requests.request(method, url, timeout=3, **kwargs)
+        logger.debug(
+            f"Attempting '{method}' request on: '{api.base_url + rest_path}'")
+        r = api.request(method, rest_path, **kwargs)
     except Exception:
         raise NetworkError(fail_message)
     return r
 
 
-def validate_modules(data: Union[dict, Box]) -> List[object]:
+def validate_modules(data: Union[dict, Box], heartbeat: Optional[HeartbeatSlot] = None) -> List[object]:
     """Preprocess all modules, validate per-module data, and return a list of initialized modules to be run.
 
     Args:
         data (Union[dict, Box]): The job information from the API server.
+        heartbeat (HeartbeatSlot, optional): The job slot the modules report status on. Defaults to None.
 
     Raises:
         InitializationError: When the module cannot be loaded.
-        ValidationError: When the data passed to the task module is invalid/malformed.
+        ValidationError: When the data passed to the task module (or the job's streams or dependencies) is invalid/malformed.
 
     Returns:
         List[object]: A list of task modules.
     """
     data = Box(data)
+    streams = JobStreams(data)
+    TaskGraph(data, streams)
     tasks = list()
     task_names = ' >> '.join([i.module for i in data.tasks])
     logger.info(f"Initializing the following modules: {task_names}")
     for task in data.tasks:
         logger.info(f"Initializing task module: {task.module}")
-        try:
-            module_path = '.'.join(Config.MODULES[task.module].split('.')[0:-1])
-            module_name = Config.MODULES[task.module].split('.')[-1]
-        except BoxKeyError as e:
-            raise InitializationError(
-                "Module not enabled in `pyproject` file: {task.module}"
-            )
-
-        if not importlib.util.find_spec(module_path):
-            raise InitializationError(
-                f"Could not load client module: {module_path}:{module_name}")
-        logger.debug(f"Found module: {task.module} -> {module_path}")
-
-        try:
-            module = getattr(importlib.import_module(module_path), module_name)
-        except AttributeError as e:
-            raise InitializationError(
-                f"Could not load client module: {module_path}:{module_name}, module has no attribute '{module_name}'")
-        logger.debug(
-            f"Found module attribute: {task.module} -> {module_path}:{module_name}")
-
-        module = module(task=task.data)
-        module.validate()
+        with span("load", module=task.module):
+            module = registry.get(task.module)
+            logger.debug(f"Found module: {task.module} -> {module.__module__}:{module.__name__}")
+            module = module(task=task.data, heartbeat=heartbeat)
+            module.streams = streams.paths
+
+        with span("validate", module=task.module):
+            module.validate()
         logger.debug(f"Validated module data!")
 
         tasks.append(module)
@@ -0,0 +1,239 @@
+import gzip
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+
+class JobRecord:
+    """Timestamps for one job handed out by the mock API (monotonic clock).
+
+    Attributes:
+        job_id (str): The ID of the job
+        claimed_at (float, optional): When a worker pulled the job off of the queue
+        started_at (float, optional): When a heartbeat first reported the job in progress
+        completed_at (float, optional): When the worker reported the job as completed
+        failed (bool, optional): Whether the worker reported the job as failed
+        released (int): The number of times the job was returned to the queue
+    """
+    job_id: str
+    claimed_at: Optional[float]
+    started_at: Optional[float]
+    completed_at: Optional[float]
+    failed: Optional[bool]
+    released: int
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.claimed_at = None
+        self.started_at = None
+        self.completed_at = None
+        self.failed = None
+        self.released = 0
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients hanging up mid-request are expected, e.g. while the API is "down"
+        pass
+
+
+class MockApi:
+    """An in-memory stand-in for the Sisyphus API server.
+
+    Serves the queue (`/queue`, `/queue/poll`), worker status and heartbeats
+    (`/workers/<id>`), option sets (`/data/<module>/<name>`), and job completion
+    (`/jobs/<id>/completed`).  To simulate an unreliable server, it can drop
+    every connection for `down` seconds out of every `up + down` seconds.
+
+    Attributes:
+        jobs (List[dict]): The jobs waiting on the queue
+        records (Dict[str, JobRecord]): Timestamps for every job keyed by job ID
+        option_sets (Dict[str, dict]): The option sets keyed by `<module>/<name>`
+        flapping (Tuple[float, float], optional): The `(up, down)` seconds of the availability cycle, otherwise None.
+        counters (Dict[str, int]): Request counters (`requests`, `heartbeats`, `heartbeat_bytes`, `polls`, `empty_polls`, `dropped`)
+        done (threading.Event): Set once every job has been completed
+        last_activity (float): When a job was last claimed or completed (monotonic clock)
+    """
+    jobs: List[dict]
+    records: Dict[str, JobRecord]
+    option_sets: Dict[str, dict]
+    flapping: Optional[Tuple[float, float]]
+    counters: Dict[str, int]
+    done: threading.Event
+    last_activity: float
+
+    def __init__(self, jobs: List[dict], option_sets: Optional[Dict[str, dict]] = None, flapping: Optional[Tuple[float, float]] = None):
+        self.jobs = list(jobs)
+        self.records = {i["job_id"]: JobRecord(i["job_id"]) for i in jobs}
+        self.option_sets = option_sets or dict()
+        self.flapping = flapping
+        self.counters = {
+            "requests": 0, "heartbeats": 0, "heartbeat_bytes": 0,
+            "polls": 0, "empty_polls": 0, "dropped": 0,
+        }
+        self.done = threading.Event()
+        self.started_at = time.monotonic()
+        self.last_activity = self.started_at
+        self._lock = threading.Lock()
+        self._server = None
+
+    def available(self) -> bool:
+        """Check whether the server is currently accepting requests.
+
+        Returns:
+            bool: `False` during the "down" part of the availability cycle, otherwise `True`
+        """
+        if not self.flapping:
+            return True
+        up, down = self.flapping
+        return (time.monotonic() - self.started_at) % (up + down) < up
+
+    def start(self, port: int = 0) -> str:
+        """Start serving in a background thread.
+
+        Args:
+            port (int, optional): The port to listen on. Defaults to 0 (any free port).
+
+        Returns:
+            str: The base URL of the server.
+        """
+        api = self
+
+        class Handler(RequestHandler):
+            mock = api
+
+        self._server = MockServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def settled(self, quiet: float) -> bool:
+        """Check whether the queue is empty and no job has been claimed or completed for a while.
+
+        Jobs that are claimed but never completed (e.g. the completion was lost
+        while the API was down) would otherwise keep a run waiting forever.
+
+        Args:
+            quiet (float): The number of seconds without activity
+
+        Returns:
+            bool: `True` if the run is over, otherwise `False`
+        """
+        with self._lock:
+            return not self.jobs and time.monotonic() - self.last_activity > quiet
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+    def count(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += value
+
+    def poll(self) -> Optional[dict]:
+        with self._lock:
+            self.counters["polls"] += 1
+            if not self.jobs:
+                self.counters["empty_polls"] += 1
+                return None
+            job = self.jobs.pop(0)
+            self.records[job["job_id"]].claimed_at = self.last_activity = time.monotonic()
+            return job
+
+    def release(self, job: dict) -> None:
+        with self._lock:
+            self.jobs.insert(0, job)
+            self.records[job["job_id"]].released += 1
+
+    def heartbeat(self, message: dict, size: int) -> None:
+        with self._lock:
+            self.counters["heartbeats"] += 1
+            self.counters["heartbeat_bytes"] += size
+            messages = message.get("slots") or [message]
+            for slot in messages:
+                record = self.records.get(slot.get("job_id"))
+                if record and record.started_at is None and slot.get("status") == "in_progress":
+                    record.started_at = time.monotonic()
+
+    def complete(self, job_id: str, failed: bool) -> None:
+        with self._lock:
+            record = self.records[job_id]
+            record.completed_at = self.last_activity = time.monotonic()
+            record.failed = failed
+            if all(i.completed_at is not None for i in self.records.values()):
+                self.done.set()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed ACKs add ~40 ms to every request
+    disable_nagle_algorithm = True
+    mock: MockApi
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def body(self) -> Tuple[dict, int]:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        try:
+            return json.loads(body), len(body)
+        except ValueError:
+            return dict(), len(body)
+
+    def send(self, code: int, data: Optional[dict] = None) -> None:
+        body = json.dumps(data if data is not None else {}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one_request(self) -> None:
+        if not self.mock.available():
+            self.mock.count("dropped")
+            self.close_connection = True
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        super().handle_one_request()
+
+    def do_GET(self) -> None:
+        self.mock.count("requests")
+        if self.path == "/queue":
+            return self.send(200, {"attributes": {"disabled": False}})
+        if self.path == "/queue/poll":
+            job = self.mock.poll()
+            return self.send(200, job) if job else self.send(404, {"message": "empty"})
+        if self.path.startswith("/workers/"):
+            return self.send(200, {"attributes": {"disabled": False}})
+        if self.path.startswith("/data/"):
+            if options := self.mock.option_sets.get(self.path[6:]):
+                return self.send(200, {"options": options})
+            return self.send(404, {"message": "not found"})
+        self.send(404, {"message": "not found"})
+
+    def do_POST(self) -> None:
+        self.mock.count("requests")
+        data, size = self.body()
+        if self.path == "/queue" and "job_id" in data:
+            self.mock.release(data)
+        elif self.path.startswith("/workers/"):
+            self.mock.heartbeat(data, size)
+        self.send(200)
+
+    def do_PATCH(self) -> None:
+        self.mock.count("requests")
+        data, size = self.body()
+        if self.path.startswith("/jobs/") and self.path.endswith("/completed"):
+            self.mock.complete(self.path.split("/")[2], bool(data.get("failed")))
+        elif self.path.startswith("/workers/"):
+            self.mock.heartbeat(data, size)
+        self.send(200)
@@ -0,0 +1,45 @@
+from pathlib import Path
+from typing import List, Optional
+
+from box import Box
+from loguru import logger
+
+from app.exceptions import ValidationError
+from app.optionsets import option_sets
+from modules.ffmpeg import Ffmpeg
+
+
+class BenchFfmpeg(Ffmpeg):
+    """The Ffmpeg module with the `sisyphus-ffmpeg` command generation replaced by a fixed command.
+
+    Everything between building the command and reporting the results (the
+    process, progress pipe, `stderr` draining, heartbeat updates, and option
+    set lookups) is the real module.
+
+    Task data:
+        source (str): The input file
+        output (str): The output file
+        frames (int): The number of frames in the input
+        option_set (str, optional): An ffmpeg option set to fetch from the API server
+    """
+
+    def validate(self):
+        if "option_set" in self.task:
+            self.task.options = option_sets.resolve(
+                "ffmpeg", [self.task.option_set])[self.task.option_set]
+        if "output" not in self.task:
+            raise ValidationError("Task data is missing `output`.")
+        logger.info("Task data validated successfully.")
+
+    def build_command(self) -> List[str]:
+        options = [str(i) for k, v in self.task.get("options", {}).items() for i in (f"-{k}", v)]
+        return ["ffmpeg", "-y", "-i", self.task.get("source", "bench.mkv")] + options + [self.task.output]
+
+    def output_file(self) -> Path:
+        return Path(self.task.output)
+
+    def cache_key(self) -> Optional[str]:
+        return None
+
+    def get_video_information(self) -> Box:
+        return Box(frames=self.task.get("frames"))
@@ -0,0 +1,36 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from app.exceptions import ValidationError
+from modules.handbrake import Handbrake
+
+
+class BenchHandbrake(Handbrake):
+    """The Handbrake module with the `sisyphus-handbrake` command generation replaced by a fixed command.
+
+    Everything between building the command and reporting the results (the
+    process, JSON progress parsing, and heartbeat updates) is the real module.
+
+    Task data:
+        source (str): The input file
+        output (str): The output file
+        frames (int): The number of frames in the input
+    """
+
+    def validate(self):
+        if "output" not in self.task:
+            raise ValidationError("Task data is missing `output`.")
+        logger.info("Task data validated successfully.")
+
+    def prepare_encode(self) -> Tuple[List[str], Optional[int]]:
+        self._progress_sent = 0.0
+        command = ["HandBrakeCLI", "--json", "-i", self.task.get("source", "bench.mkv"), "-o", self.task.output]
+        return command, self.task.get("frames")
+
+    def output_file(self) -> Path:
+        return Path(self.task.output)
+
+    def cache_key(self) -> Optional[str]:
+        return None
@@ -0,0 +1,282 @@
+"""Benchmark the client against a mock API server and stub encoders, without a network or real encodes.
+
+Every scenario fills the mock queue, starts the client (`bench.worker`) with the
+stub encoders from `bench/bin` first on its `PATH`, waits until every job is
+completed, and reports throughput, latency percentiles, heartbeat traffic, and
+the client's own CPU time (the stub encoders are separate processes).
+
+Usage (from the repository root):
+    python -m bench.run                                 # every scenario
+    python -m bench.run short-jobs --jobs 500 --slots 4
+    python -m bench.run --env RUNTIME=asyncio --env HEARTBEAT_DELTAS=true
+    python -m bench.run --save baseline.json
+    python -m bench.run --baseline baseline.json        # exit code 1 on regressions
+"""
+import argparse
+import bisect
+import importlib.util
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from bench.mock_api import MockApi
+from bench.scenarios import SCENARIOS, Scenario
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Metrics compared against a baseline: (path, whether higher is better)
+COMPARED = [
+    ("throughput", True),
+    ("start_latency.p90", False),
+    ("duration.p90", False),
+    ("dispatch_gap.p90", False),
+    ("client_cpu_per_job", False),
+    ("heartbeats_per_job", False),
+    ("lost", False),
+]
+
+# Seconds without a job being claimed or completed, once the queue is empty, before a run is over
+SETTLE_TIME = 10
+
+# Differences below this many seconds (or CPU seconds) are noise, whatever the ratio
+ABSOLUTE_SLACK = 0.005
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Summarize a list of durations.
+
+    Args:
+        values (List[float]): The durations in seconds
+
+    Returns:
+        Dict[str, Optional[float]]: The nearest-rank `p50`, `p90`, `p99`, and `max` in seconds (None if there are no values).
+    """
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+
+    def rank(p: float) -> float:
+        return round(values[min(len(values) - 1, max(0, int(-(-p * len(values) // 100)) - 1))], 4)
+
+    return {"p50": rank(50), "p90": rank(90), "p99": rank(99), "max": round(values[-1], 4)}
+
+
+def client_usage(pid: int) -> Dict[str, float]:
+    """Read the CPU time and peak memory of a running process from `/proc`.
+
+    Args:
+        pid (int): The process ID
+
+    Returns:
+        Dict[str, float]: The `cpu` seconds (user and system) and peak `rss_mb`, empty if `/proc` is unavailable.
+    """
+    try:
+        fields = Path(f"/proc/{pid}/stat").read_text().rpartition(")")[2].split()
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return dict()
+    ticks = os.sysconf("SC_CLK_TCK")
+    rss = next((int(i.split()[1]) for i in status.splitlines() if i.startswith("VmHWM:")), 0)
+    return {"cpu": (int(fields[11]) + int(fields[12])) / ticks, "rss_mb": round(rss / 1024, 1)}
+
+
+def summarize(scenario: Scenario, mock: MockApi, usage: Dict[str, float], timed_out: bool) -> dict:
+    """Compute the metrics of a finished scenario run.
+
+    Args:
+        scenario (Scenario): The scenario
+        mock (MockApi): The mock API server the client worked against
+        usage (Dict[str, float]): The client's resource usage from `client_usage`
+        timed_out (bool): Whether the run hit its timeout
+
+    Returns:
+        dict: The metrics.
+    """
+    records = list(mock.records.values())
+    completed = [i for i in records if i.completed_at is not None]
+    claims = sorted(i.claimed_at for i in records if i.claimed_at is not None)
+    elapsed = max((i.completed_at for i in completed), default=0) - (claims[0] if claims else 0)
+    gaps = list()
+    for record in completed:
+        if (idx := bisect.bisect_left(claims, record.completed_at)) < len(claims):
+            gaps.append(claims[idx] - record.completed_at)
+    count = max(1, len(completed))
+    return {
+        "scenario": scenario.name,
+        "jobs": len(records),
+        "completed": len(completed),
+        "failed": sum(1 for i in completed if i.failed),
+        "lost": sum(1 for i in records if i.claimed_at is not None and i.completed_at is None),
+        "released": sum(i.released for i in records),
+        "timed_out": timed_out,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(completed) / elapsed, 2) if elapsed > 0 else None,
+        "start_latency": percentiles(
+            [i.started_at - i.claimed_at for i in records if i.started_at and i.claimed_at]),
+        "duration": percentiles([i.completed_at - i.claimed_at for i in completed if i.claimed_at]),
+        "dispatch_gap": percentiles(gaps),
+        "requests": mock.counters["requests"],
+        "polls": mock.counters["polls"],
+        "dropped": mock.counters["dropped"],
+        "heartbeats": mock.counters["heartbeats"],
+        "heartbeats_per_job": round(mock.counters["heartbeats"] / count, 2),
+        "heartbeat_bytes": mock.counters["heartbeat_bytes"],
+        "client_cpu": round(usage.get("cpu", 0), 3),
+        "client_cpu_per_job": round(usage.get("cpu", 0) / count, 5),
+        "client_rss_mb": usage.get("rss_mb"),
+    }
+
+
+def run_scenario(scenario: Scenario, count: int, env: Dict[str, str], timeout: float, keep: bool) -> dict:
+    """Run one scenario against a fresh mock API server and client process.
+
+    Args:
+        scenario (Scenario): The scenario
+        count (int): The number of jobs
+        env (Dict[str, str]): Extra environment variables for the client, on top of the scenario's
+        timeout (float): The maximum number of seconds to wait for every job to be completed
+        keep (bool): Whether to keep the scratch directory (job files and the client log)
+
+    Returns:
+        dict: The metrics from `summarize`.
+    """
+    directory = Path(tempfile.mkdtemp(prefix=f"sisyphus-bench-{scenario.name}-"))
+    mock = MockApi(scenario.jobs(count, directory), scenario.option_sets, scenario.flapping)
+    url = mock.start()
+    client_env = os.environ | {
+        "API_URL": url,
+        "HOST_UUID": "00000000-0000-0000-0000-00000000bench",
+        "HOSTNAME_OVERRIDE": "bench",
+        "PATH": f"{ROOT / 'bench' / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+        "HEARTBEAT_INTERVAL": "1",
+        "QUEUE_POLL_INTERVAL": "1",
+        "QUEUE_POLL_MIN_INTERVAL": "0.05",
+        "QUEUE_POLL_MAX_INTERVAL": "1",
+        "NETWORK_RETRY_INTERVAL": "1",
+        "MODULE_PLUGINS": "false",
+        "LOGURU_LEVEL": "INFO",
+    } | scenario.env | env
+
+    log = directory / "client.log"
+    with log.open("w") as output:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "bench.worker"], cwd=ROOT, env=client_env,
+            stdout=output, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while not mock.done.wait(0.2):
+        if process.poll() is not None or time.monotonic() > deadline or mock.settled(SETTLE_TIME):
+            break
+    usage = client_usage(process.pid)
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    mock.stop()
+
+    result = summarize(scenario, mock, usage, timed_out=time.monotonic() > deadline)
+    if keep or not mock.done.is_set():
+        print(f"  client log: {log}", file=sys.stderr)
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def show(result: dict) -> None:
+    def ms(values: dict) -> str:
+        return " ".join(
+            f"{k}={'-' if v is None else f'{v * 1000:.1f}ms'}" for k, v in values.items())
+
+    status = "TIMED OUT" if result["timed_out"] else "ok"
+    print(f"{result['scenario']}: {result['completed']}/{result['jobs']} jobs "
+          f"({result['failed']} failed, {result['lost']} lost, {result['released']} released) "
+          f"in {result['seconds']}s [{status}]")
+    print(f"  throughput........: {result['throughput']} jobs/s")
+    print(f"  start latency.....: {ms(result['start_latency'])}")
+    print(f"  job duration......: {ms(result['duration'])}")
+    print(f"  dispatch gap......: {ms(result['dispatch_gap'])}")
+    print(f"  heartbeats........: {result['heartbeats']} ({result['heartbeats_per_job']}/job, "
+          f"{result['heartbeat_bytes']} bytes)")
+    print(f"  requests..........: {result['requests']} ({result['polls']} polls, {result['dropped']} dropped)")
+    print(f"  client CPU........: {result['client_cpu']}s ({result['client_cpu_per_job'] * 1000:.2f}ms/job), "
+          f"peak RSS {result['client_rss_mb']} MB")
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Find the metrics that got worse than the baseline by more than the tolerance.
+
+    Args:
+        results (Dict[str, dict]): The metrics of this run keyed by scenario
+        baseline (Dict[str, dict]): The metrics of the baseline run keyed by scenario
+        tolerance (float): The allowed relative change (e.g. 0.2 for 20%)
+
+    Returns:
+        List[str]: A description of every regression.
+    """
+    regressions = list()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for path, higher_is_better in COMPARED:
+            current, previous = result, baseline[name]
+            for key in path.split("."):
+                current, previous = current.get(key), previous.get(key)
+            if current is None or previous is None:
+                continue
+            change = (previous - current) if higher_is_better else (current - previous)
+            if change > abs(previous) * tolerance and (higher_is_better or change > ABSOLUTE_SLACK):
+                regressions.append(f"{name}: {path} {previous} -> {current}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the client against a mock API server and stub encoders.")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all): {', '.join(SCENARIOS)}")
+    parser.add_argument("--jobs", type=int, help="Number of jobs per scenario (default: the scenario's)")
+    parser.add_argument("--slots", type=int, default=1, help="Job slots on the client (MAX_CONCURRENT_JOBS)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra client setting, e.g. RUNTIME=asyncio (repeatable)")
+    parser.add_argument("--timeout", type=float, default=600, help="Maximum seconds per scenario")
+    parser.add_argument("--save", type=Path, help="Write the results to a JSON file")
+    parser.add_argument("--baseline", type=Path, help="Compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (default 0.2)")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directories and client logs")
+    args = parser.parse_args()
+
+    if unknown := [i for i in args.scenarios if i not in SCENARIOS]:
+        parser.error(f"Unknown scenario(s): {', '.join(unknown)}")
+    env = {"MAX_CONCURRENT_JOBS": str(args.slots)}
+    env |= dict(i.split("=", 1) for i in args.env)
+
+    results = dict()
+    for name in args.scenarios or SCENARIOS:
+        scenario = SCENARIOS[name]
+        if missing := [i for i in scenario.requires if importlib.util.find_spec(i) is None]:
+            print(f"{name}: skipped, missing package(s): {', '.join(missing)}")
+            continue
+        print(f"Running '{name}': {scenario.description}", file=sys.stderr)
+        results[name] = run_scenario(scenario, args.jobs or scenario.count, env, args.timeout, args.keep)
+        show(results[name])
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        if regressions := compare(results, json.loads(args.baseline.read_text()), args.tolerance):
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Scenario:
+    """A benchmark workload: the jobs put on the mock queue and the settings the client runs with.
+
+    Attributes:
+        name (str): The name used on the command line
+        description (str): What the scenario exercises
+        count (int): The default number of jobs
+        job (Callable[[int, Path], List[dict]]): Builds the task list of the n-th job, given a scratch directory for its files
+        env (Dict[str, str]): Extra environment variables for the client and the stub encoders
+        flapping (Tuple[float, float], optional): The `(up, down)` seconds of the mock API's availability cycle, otherwise None.
+        option_sets (Dict[str, dict]): The option sets served by the mock API keyed by `<module>/<name>`
+        requires (List[str]): Python packages the scenario's modules need (e.g. `ffmpeg` from `sisyphus-ffmpeg`)
+    """
+    name: str
+    description: str
+    count: int
+    job: Callable[[int, Path], List[dict]]
+    env: Dict[str, str]
+    flapping: Optional[Tuple[float, float]]
+    option_sets: Dict[str, dict]
+    requires: List[str]
+
+    def __init__(self, name: str, description: str, count: int, job: Callable[[int, Path], List[dict]],
+                 env: Optional[Dict[str, str]] = None, flapping: Optional[Tuple[float, float]] = None,
+                 option_sets: Optional[Dict[str, dict]] = None, requires: Optional[List[str]] = None):
+        self.name = name
+        self.description = description
+        self.count = count
+        self.job = job
+        self.env = env or dict()
+        self.flapping = flapping
+        self.option_sets = option_sets or dict()
+        self.requires = requires or list()
+
+    def jobs(self, count: int, directory: Path) -> List[dict]:
+        """Build the jobs for the mock queue.
+
+        Args:
+            count (int): The number of jobs
+            directory (Path): A scratch directory for the files the jobs use
+
+        Returns:
+            List[dict]: The jobs, in queue order.
+        """
+        return [
+            {"job_id": f"{self.name}-{i:05d}", "job_title": f"{self.name} #{i}", "tasks": self.job(i, directory)}
+            for i in range(count)
+        ]
+
+
+def delete_task(idx: int, directory: Path) -> List[dict]:
+    path = directory / "files" / f"{idx:05d}.txt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("bench")
+    return [{"module": "cleanup", "data": {"delete": [str(path)]}}]
+
+
+def encode_task(module: str, frames: int, option_sets: int = 0) -> Callable[[int, Path], List[dict]]:
+    def task(idx: int, directory: Path) -> List[dict]:
+        source = directory / "source.mkv"
+        source.touch()
+        data = {"source": str(source), "output": str(directory / "out" / f"{idx:05d}.mkv"), "frames": frames}
+        (directory / "out").mkdir(exist_ok=True)
+        if option_sets:
+            data["option_set"] = f"preset-{idx % option_sets}"
+        return [{"module": module, "data": data}]
+    return task
+
+
+def chatty(frames: int) -> Dict[str, str]:
+    return {"BENCH_FRAMES": str(frames), "BENCH_FPS": "2000", "BENCH_UPDATES": "200", "BENCH_LOG_LINES": "20"}
+
+
+SCENARIOS = {
+    i.name: i for i in [
+        Scenario(
+            "short-jobs", "Thousands of jobs that delete one small file each (queue and job overhead).",
+            2000, delete_task),
+        Scenario(
+            "flapping-api", "Short jobs while the API server drops every connection for 1 s out of every 3 s.",
+            300, delete_task, env={"NETWORK_RETRY_INTERVAL": "1"}, flapping=(2.0, 1.0)),
+        Scenario(
+            "chatty-ffmpeg", "Two-second ffmpeg encodes writing 200 progress blocks and 4000 log lines a second.",
+            20, encode_task("bench_ffmpeg", 4000), env=chatty(4000), requires=["ffmpeg"]),
+        Scenario(
+            "chatty-handbrake", "Two-second HandBrakeCLI encodes writing 200 JSON progress blocks and 4000 log lines a second.",
+            20, encode_task("bench_handbrake", 4000), env=chatty(4000), requires=["handbrake", "ffprobe"]),
+        Scenario(
+            "option-sets", "Very short ffmpeg encodes using one of four option sets from the API server.",
+            200, encode_task("bench_ffmpeg", 100, option_sets=4),
+            env={"BENCH_FRAMES": "100", "BENCH_FPS": "5000", "BENCH_UPDATES": "100"},
+            option_sets={f"ffmpeg/preset-{i}": {"c:v": "libx264", "crf": 18 + i} for i in range(4)},
+            requires=["ffmpeg"]),
+    ]
+}
@@ -0,0 +1,16 @@
+"""Run the client with the benchmark modules enabled.
+
+Started by `bench.run` from the repository root with the scenario's
+environment (API URL, stub encoders on the `PATH`, client settings).
+"""
+import runpy
+
+from app.registry import registry
+
+BENCH_MODULES = {
+    "bench_ffmpeg": "bench.modules.ffmpeg.BenchFfmpeg",
+    "bench_handbrake": "bench.modules.handbrake.BenchHandbrake",
+}
+
+registry.enabled = {**registry.enabled, **BENCH_MODULES}
+runpy.run_path("client.py", run_name="__main__")
@@ -1,40 +1,87 @@
+import asyncio
+import subprocess
+import threading
 from datetime import datetime
-from typing import Union, Optional
+from pathlib import Path
+from typing import List, Optional, Set, Union
 
 from box import Box
 from loguru import logger
 
 from app.exceptions import (CleanupError, InitializationError, RunError,
                             ValidationError)
-from app.heartbeat import Heartbeat, heartbeat
+from app.heartbeat import HeartbeatSlot, heartbeat as default_heartbeat
 from app.config import Config
+from app.encodes import encodes
+from app.fileops import hash_file
+from app.spans import span, wait_process
+from app.streams import mentioned_paths
 
 
 class BaseModule:
     """The base Sisyphus module for tasks.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
+        results (Box): Information about the task run to include in the job results
+        reports_progress (bool): Whether the module reports a `progress` percentage while running
+        streams (Set[Path]): The paths of the job's streams (named pipes between tasks)
+        processes (Set[subprocess.Popen]): The processes started by the task, killed by `stop`
+        stopping (threading.Event): Set once the task is stopped, so it does not start new processes
     """
-    heartbeat: Heartbeat
+    heartbeat: HeartbeatSlot
     task: Box
     start_time: Optional[datetime]
+    results: Box
+    streams: Set[Path]
+    processes: Set[subprocess.Popen]
+    stopping: threading.Event
+    reports_progress: bool = False
 
-    def __init__(self, task: Union[dict, Box]):
+    def __init__(self, task: Union[dict, Box], heartbeat: Optional[HeartbeatSlot] = None):
         """Initializes the instance based on task information.
 
         Args:
             task (Union[dict, Box]): The task data from the main job
+            heartbeat (HeartbeatSlot, optional): The job slot to report status on. Defaults to the first job slot.
 
         Raises:
             InitializationError: An error occured when initializing the module.
         """
-        self.heartbeat = heartbeat
+        self.heartbeat = heartbeat if heartbeat else default_heartbeat.slot(0)
         self.task = Box(task)
         self.start_time = None
-        # pass
+        self.results = Box()
+        self.streams = set()
+        self.processes = set()
+        self.stopping = threading.Event()
+
+    @classmethod
+    def warmup(cls) -> None:
+        """Prepare the module ahead of the first job (e.g. load schemas, probe binaries).
+        """
+        pass
+
+    @staticmethod
+    def probe_version(command: List[str]) -> Optional[str]:
+        """Run a binary's version command and return the first line of its output.
+
+        Args:
+            command (List[str]): The version command (e.g. `["ffmpeg", "-version"]`)
+
+        Returns:
+            Optional[str]: The first line of output, or None if the binary could not be run.
+        """
+        try:
+            r = subprocess.run(command, capture_output=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            logger.warning(f"Could not run '{command[0]}'")
+            return None
+        version = r.stdout.decode(errors="replace").strip().split("\n")[0]
+        logger.info(f"Found binary: {version}")
+        return version
 
     def validate(self) -> None:
         """Validates the task data before execution.
@@ -61,6 +108,110 @@ class BaseModule:
         """
         pass
 
+    async def run_async(self) -> None:
+        """Run the task on the event loop.  By default this runs `run` in a worker thread.
+
+        Raises:
+            RunError: An error occured when running the module.
+        """
+        await asyncio.to_thread(self.run)
+
+    async def cleanup_async(self) -> None:
+        """Perform cleanup tasks on the event loop.  By default this runs `cleanup` in a worker thread.
+
+        Raises:
+            CleanupError: An error occured when cleaning up after module execution.
+        """
+        await asyncio.to_thread(self.cleanup)
+
+    def stop(self) -> None:
+        """Stop the running task (e.g. because a task it streams to or from failed) by killing its processes.
+        """
+        self.stopping.set()
+        for process in list(self.processes):
+            process.kill()
+
+    def run_process(self, command: List[str]) -> int:
+        """Run a command to completion, keeping its process in `processes` so that `stop` can kill it.
+
+        Args:
+            command (List[str]): The command to run
+
+        Returns:
+            int: The exit/return code of the command.
+        """
+        with span("process", command=Path(command[0]).name) as current:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+            self.processes.add(process)
+            if self.stopping.is_set():
+                process.kill()
+            return_code = wait_process(process, current)
+        self.processes.discard(process)
+        return return_code
+
+    def streamed_paths(self) -> Set[Path]:
+        """Return the streams the task reads or writes.
+
+        Returns:
+            Set[Path]: The paths of the streams.
+        """
+        return mentioned_paths(self.task.to_dict()) & self.streams
+
+    def output_file(self) -> Optional[Path]:
+        """Return the file the task produces (e.g. the output of an encode).
+
+        Returns:
+            Optional[Path]: The output file, or None if the module does not produce a single output.
+        """
+        return None
+
+    def cache_key(self) -> Optional[str]:
+        """Return the encode cache key of the task.
+
+        Returns:
+            Optional[str]: The key, or None if the module's output is not cached (or a source cannot be read).
+        """
+        return None
+
+    def restore_output(self) -> bool:
+        """Materialize the task output from the encode cache (if enabled) instead of running the task.
+
+        Returns:
+            bool: `True` if the output was restored and the task does not need to run, otherwise `False`
+        """
+        if not encodes.enabled or self.streamed_paths():
+            return False
+        if not (output := self.output_file()) or not (key := self.cache_key()):
+            return False
+        with span("encode_cache", key=key) as current:
+            result = encodes.restore(key, output)
+            current.set(result="hit" if result else "miss")
+        self.results.encode_cache = "hit" if result else "miss"
+        if result:
+            logger.info(f"Restored output '{output}' from the encode cache ({result.strategy}).")
+        return bool(result)
+
+    def store_output(self) -> None:
+        """Add the task output to the encode cache after a cache miss.
+        """
+        if self.results.get("encode_cache") == "miss":
+            encodes.store(self.cache_key(), self.output_file())
+
+    def checksum_output(self) -> None:
+        """Add the checksum of the task output to the task results, if `CHECKSUM_OUTPUTS` is enabled.
+
+        The output was just written, so it is usually hashed from the page cache.
+        """
+        if not Config.CHECKSUM_OUTPUTS or not Config.CHECKSUM_ALGORITHM or not (output := self.output_file()):
+            return
+        if output in self.streams:
+            return
+        try:
+            with span("checksum"):
+                self.results.checksum = hash_file(output, Config.CHECKSUM_ALGORITHM)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not checksum output '{output}': {e}")
+
     def get_duration(self) -> datetime:
         """Return the amount of time the module has run since it started.
 
@@ -1,14 +1,22 @@
+import glob
 import json
 import os
-import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, Dict, List, Optional, Tuple
 
 import jsonschema
 from box import Box
 from loguru import logger
 
+from app.config import Config
 from app.exceptions import RunError, ValidationError
+from app.fileops import (ChecksumMismatch, Throttle, TransferResult,
+                         checksum_supported, copy_file, hash_file, move_file,
+                         resolve_destination)
+from app.metrics import cleanup_bytes
 from modules.base import BaseModule
 
 
@@ -16,13 +24,15 @@ class Cleanup(BaseModule):
     """A post-job cleanup module used to move, copy, and delete files.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
+        validator (jsonschema.protocols.Validator, optional): The task data validator, shared by every instance once loaded.
     """
+    validator: Optional[jsonschema.protocols.Validator] = None
 
-    def __init__(self, task):
-        super().__init__(task)
+    def __init__(self, task, **kwargs):
+        super().__init__(task, **kwargs)
         logger.info("Module loaded successfully.")
         logger.debug(f"Data: {self.task}")
         self.status = Box({
@@ -34,90 +44,346 @@ class Cleanup(BaseModule):
             os.path.dirname(os.path.abspath(__file__)))
         self.schema = schema_path / Path('schema/cleanup.schema.json')
 
-    def validate(self):
-        with self.schema.open('r') as f:
-            schema = json.load(f)
+    @classmethod
+    def load_validator(cls) -> jsonschema.protocols.Validator:
+        """Load the task data schema once and return the validator built from it.
+
+        Returns:
+            jsonschema.protocols.Validator: The task data validator.
+        """
+        if cls.validator is None:
+            schema_path = Path(os.path.dirname(os.path.abspath(__file__)))
+            with (schema_path / Path('schema/cleanup.schema.json')).open('r') as f:
+                schema = json.load(f)
+            validator = jsonschema.validators.validator_for(schema)
+            validator.check_schema(schema)
+            cls.validator = validator(schema)
+        return cls.validator
 
-        try:
-            jsonschema.validate(self.task, schema)
-        except jsonschema.ValidationError as e:
-            raise ValidationError(e.message)
+    @classmethod
+    def warmup(cls):
+        cls.load_validator()
+
+    def validate(self):
+        if error := jsonschema.exceptions.best_match(self.load_validator().iter_errors(self.task)):
+            raise ValidationError(error.message)
+        if Config.CHECKSUM_ALGORITHM and not checksum_supported(Config.CHECKSUM_ALGORITHM):
+            raise ValidationError(f"Unsupported checksum algorithm: {Config.CHECKSUM_ALGORITHM}")
 
         logger.info("Task data validated successfully.")
 
     def run(self):
         self.set_start_time()
         logger.info("Running cleanup tasks")
+        self.throttle = None
+        if Config.CLEANUP_BANDWIDTH_LIMIT > 0:
+            self.throttle = Throttle(Config.CLEANUP_BANDWIDTH_LIMIT * 1024 * 1024)
         for k, v in self.task.items():
             getattr(self, f"_{k}")(v)
 
+    @staticmethod
+    def expand(pattern: str) -> List[Path]:
+        """Expand a glob pattern into the paths that match it.
+
+        Args:
+            pattern (str): A path or glob pattern
+
+        Returns:
+            List[Path]: The matching paths, or the path itself if it is not a pattern.
+        """
+        if not any(i in pattern for i in "*?["):
+            return [Path(pattern)]
+        return [Path(i) for i in sorted(glob.glob(pattern))]
+
+    @staticmethod
+    def device(path: Path) -> int:
+        """Return the device of a path, or of its closest existing parent.
+
+        Args:
+            path (Path): The path
+
+        Returns:
+            int: The device ID.
+        """
+        for parent in [path, *path.parents]:
+            try:
+                return parent.stat().st_dev
+            except OSError:
+                continue
+        return 0
+
+    def start_progress(self, files: int, size: int) -> None:
+        """Reset the progress reported to the heartbeat for a batch of operations.
+
+        Args:
+            files (int): The number of files in the batch
+            size (int): The number of bytes in the batch
+        """
+        self._progress_lock = threading.Lock()
+        self._progress_sent = 0.0
+        self.status.info = {
+            "files_done": 0,
+            "files_total": files,
+            "bytes_done": 0,
+            "bytes_total": size,
+        }
+        self.status.progress = 0.0 if files else 100.0
+        self.heartbeat.set_data(self.status)
+
+    def extend_progress(self, files: int, size: int) -> None:
+        """Add files to the current batch once they are known (e.g. when the next entry of a transfer is planned).
+
+        Args:
+            files (int): The number of files added to the batch
+            size (int): The number of bytes added to the batch
+        """
+        with self._progress_lock:
+            self.status.info.files_total += files
+            self.status.info.bytes_total += size
+        self.add_progress()
+
+    def add_progress(self, size: int = 0, files: int = 0) -> None:
+        """Add to the progress of the current batch, updating the heartbeat at most once per second.
+
+        Args:
+            size (int, optional): The number of bytes completed. Defaults to 0.
+            files (int, optional): The number of files completed. Defaults to 0.
+        """
+        with self._progress_lock:
+            info = self.status.info
+            info.bytes_done += size
+            info.files_done += files
+            if info.bytes_total:
+                self.status.progress = min(
+                    info.bytes_done / info.bytes_total * 100, 100.0)
+            elif info.files_total:
+                self.status.progress = info.files_done / info.files_total * 100
+            now = time.monotonic()
+            if now - self._progress_sent < 1 and info.files_done < info.files_total:
+                return
+            self._progress_sent = now
+            self.heartbeat.set_data(self.status)
+
+    def parallel(self, func: Callable[..., None], items: List[tuple]) -> None:
+        """Run an operation on every item using a bounded pool of threads, stopping at the first failure.
+
+        Args:
+            func (Callable[..., None]): The operation, called with each item's values as arguments
+            items (List[tuple]): The arguments for every call
+
+        Raises:
+            RunError: An operation failed.
+        """
+        with ThreadPoolExecutor(max_workers=Config.CLEANUP_WORKERS) as executor:
+            futures = [executor.submit(func, *i) for i in items]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
     def _delete(self, list_of_files: List[str]) -> None:
         """Delete files on the filesystem.
 
+        Files (including glob matches) are deleted in parallel, then empty
+        directories are removed, deepest first.
+
         Args:
-            list_of_files (List[str]): List of files to delete.
+            list_of_files (List[str]): List of files, empty directories, or glob patterns to delete.
 
         Raises:
             RunError: Cannot delete a file provided.
         """
-        files = [Path(i) for i in list_of_files]
-        try:
-            for f in files:
-                if f.is_file():
-                    f.unlink(missing_ok=True)
-                    logger.debug(f"Deleted file: {str(f)}")
-                if f.is_dir():
-                    f.rmdir()
-                    logger.debug(f"Removed empty directory: {str(f)}")
-                else:
-                    logger.debug(f"Skipping: {str(f)}")
-        except OSError as e:
-            raise RunError(f"OS error raised when deleting file: {str(f)}")
-
-        except PermissionError as e:
-            raise RunError(e.message)
+        paths = [p for i in list_of_files for p in self.expand(i)]
+        files = [(f,) for f in paths if f.is_file() or f.is_symlink()]
+        directories = [f for f in paths if f.is_dir() and not f.is_symlink()]
+        for f in paths:
+            if not f.exists() and not f.is_symlink():
+                logger.debug(f"Skipping: {str(f)}")
+
+        def delete(f: Path) -> None:
+            try:
+                f.unlink(missing_ok=True)
+            except OSError:
+                raise RunError(f"OS error raised when deleting file: {str(f)}")
+            logger.debug(f"Deleted file: {str(f)}")
+            self.add_progress(files=1)
+
+        self.start_progress(len(files) + len(directories), 0)
+        self.parallel(delete, files)
+        for f in sorted(directories, key=lambda i: len(i.parts), reverse=True):
+            try:
+                f.rmdir()
+            except OSError:
+                raise RunError(f"OS error raised when deleting file: {str(f)}")
+            logger.debug(f"Removed empty directory: {str(f)}")
+            self.add_progress(files=1)
+
+    def plan(self, data: List[Dict[str, str]], operation: str) -> Tuple[List[Tuple[Path, Path, bool]], List[Path]]:
+        """Expand source directories and glob patterns into individual transfers.
+
+        Glob matches are placed inside the destination directory.  Directory
+        sources are copied file by file into the destination (or into a
+        subdirectory of it if it already exists); when moving a directory within
+        the same filesystem, it is renamed as a whole instead.  Nothing is
+        created on disk: the directories a transfer needs are created by
+        `transfer` right before it runs.
+
+        Args:
+            data (List[Dict[str, str]]): A list of source/destination paths.
+            operation (str): The operation (`move` or `copy`)
+
+        Raises:
+            RunError: A glob pattern does not match any file.
+
+        Returns:
+            Tuple[List[Tuple[Path, Path, bool]], List[Path]]: The source/destination pairs (and whether to create the parent directory of the destination), and the source directories to remove after a move.
+        """
+        transfers, directories = list(), list()
+        for i in data:
+            destination = Path(i["destination"])
+            sources = self.expand(i["source"])
+            pattern = sources != [Path(i["source"])]
+            if pattern and not sources:
+                raise RunError(f"No files match the source pattern: {i['source']}")
+            for source in sources:
+                if not source.is_dir():
+                    if pattern:
+                        transfers.append((source, destination / source.name, True))
+                    else:
+                        transfers.append((source, destination, False))
+                    continue
+                target = destination / source.name if pattern else resolve_destination(source, destination)
+                if operation == "move" and source.stat().st_dev == self.device(target.parent):
+                    transfers.append((source, target, pattern))
+                    continue
+                for f in sorted(source.rglob("*")):
+                    if f.is_file():
+                        transfers.append((f, target / f.relative_to(source), True))
+                if operation == "move":
+                    directories.append(source)
+        return transfers, directories
+
+    def transfer(self, operation: str, data: List[Dict[str, str]]) -> None:
+        """Move or copy files, limited per destination device, reporting progress to the heartbeat.
+
+        Entries run one after the other in the order given, so an entry can
+        use the result of an earlier one (e.g. copy a file that was just moved).
+        The files within an entry are transferred in parallel.
+
+        If `CHECKSUM_ALGORITHM` is set, every file is checksummed while it is
+        transferred (and read back to verify it if `CHECKSUM_VERIFY` is set).
+
+        Args:
+            operation (str): The operation (`move` or `copy`)
+            data (List[Dict[str, str]]): A list of source/destination paths.
+
+        Raises:
+            RunError: Cannot transfer a source file to its destination path
+        """
+        if not data:
+            self.start_progress(0, 0)
+        devices = dict()
+
+        func, verb, label = {
+            "move": (move_file, "moving", "Moved"),
+            "copy": (copy_file, "copying", "Copied"),
+        }[operation]
+
+        def run_transfer(src: Path, dest: Path, create: bool) -> None:
+            try:
+                if create:
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                with devices[self.device(dest)]:
+                    result = func(src, dest, callback=self.add_progress, throttle=self.throttle,
+                                  checksum=Config.CHECKSUM_ALGORITHM or None,
+                                  verify=Config.CHECKSUM_VERIFY)
+            except ChecksumMismatch:
+                raise RunError(
+                    f"Checksum mismatch after {verb} file: {str(src)} -> {str(dest)}")
+            except FileNotFoundError as e:
+                raise RunError(
+                    f"File not found during {operation}: {e.filename}")
+            except OSError:
+                raise RunError(
+                    f"OS error raised when {verb} file: {str(src)} -> {str(dest)}")
+            self.add_transfer(operation, result)
+            self.add_progress(files=1)
+            logger.debug(f"{label} file: {str(src)} -> {str(dest)} ({result})")
+
+        for idx, entry in enumerate(data):
+            transfers, directories = self.plan([entry], operation)
+            sizes = [src.stat().st_size if src.is_file() else 0 for src, _, _ in transfers]
+            if idx == 0:
+                self.start_progress(len(transfers), sum(sizes))
+            else:
+                self.extend_progress(len(transfers), sum(sizes))
+            for _, dest, _ in transfers:
+                device = self.device(dest)
+                if device not in devices:
+                    devices[device] = threading.Semaphore(
+                        Config.CLEANUP_DEVICE_PARALLELISM)
+
+            self.parallel(run_transfer, transfers)
+
+            for directory in directories:
+                for root, _, _ in os.walk(directory, topdown=False):
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        logger.debug(f"Could not remove source directory: {root}")
 
     def _move(self, data: List[Dict[str, str]]) -> None:
         """Move files in the filesystem.
 
+        Files are renamed when the destination is on the same filesystem and
+        copied with the fastest available strategy otherwise.
+
         Args:
-            data (List[Dict[str, str]]): A list of source/destination paths.
+            data (List[Dict[str, str]]): A list of source/destination paths, directories, or glob patterns.
 
         Raises:
             RunError: Cannot move the source file to the given destination path
         """
-        try:
-            for i in data:
-                src, dest = Path(i["source"]), Path(i["destination"])
-                shutil.copy2(src, dest)
-                src.unlink()
-                logger.debug(f"Moved file: {str(src)} -> {str(dest)}")
-        except OSError as e:
-            raise RunError(
-                f"OS error raised when moving file: {str(src)} -> {str(dest)}")
-        except FileNotFoundError as e:
-            raise RunError(f"File not found during move: {e.filename}")
-        except PermissionError as e:
-            raise RunError(e.message)
+        self.transfer("move", data)
 
     def _copy(self, data: List[Dict[str, str]]) -> None:
         """Copy files in the filesystem.
 
+        Reflink clones are used where the filesystem supports them, otherwise
+        the fastest available kernel copy.
+
         Args:
-            data (List[Dict[str, str]]): A list of source/destination paths.
+            data (List[Dict[str, str]]): A list of source/destination paths, directories, or glob patterns.
 
         Raises:
             RunError: Cannot copy the source file to the given destination path
         """
-        try:
-            for i in data:
-                src, dest = Path(i["source"]), Path(i["destination"])
-                shutil.copy2(src, dest)
-                logger.debug(f"Copied file: {str(src)} -> {str(dest)}")
-        except OSError as e:
-            raise RunError(
-                f"OS error raised when copying file: {str(src)} -> {str(dest)}")
-        except FileNotFoundError as e:
-            raise RunError(f"File not found during copy: {e.filename}")
-        except PermissionError as e:
-            raise RunError(e.message)
+        self.transfer("copy", data)
+
+    def add_transfer(self, operation: str, result: TransferResult) -> None:
+        """Record a file transfer (and the checksums of the files transferred) in the task results.
+
+        Args:
+            operation (str): The operation (`move` or `copy`)
+            result (TransferResult): The outcome of the transfer
+        """
+        cleanup_bytes.inc(result.size, operation=operation)
+        checksums = dict()
+        if result.checksum:
+            checksums[str(result.destination)] = result.checksum
+        elif Config.CHECKSUM_ALGORITHM and result.destination.is_dir():
+            # A directory renamed as a whole: its files were never read, hash them in place
+            for f in sorted(result.destination.rglob("*")):
+                try:
+                    if f.is_file():
+                        checksums[str(f)] = hash_file(f, Config.CHECKSUM_ALGORITHM)
+                except OSError as e:
+                    logger.warning(f"Could not checksum file: {str(f)}, {e}")
+        with self._progress_lock:
+            self.results.setdefault("transfers", []).append(
+                {"operation": operation} | result.as_dict())
+            if checksums:
+                self.results.setdefault("checksums", {}).update(checksums)
@@ -1,19 +1,37 @@
-import json
-import re
+import asyncio
+import contextvars
+import functools
+import math
+import os
+import selectors
 import shlex
+import shutil
+import signal
 import subprocess
-import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple
 
 import box
-import requests
 from box import Box
 from ffmpeg import Ffmpeg as F
 from jsonschema import exceptions as JsonExceptions
 from loguru import logger
 
 from app.config import Config
+from app.cpus import cpus
+from app.encodes import encodes
 from app.exceptions import RunError, ValidationError
+from app.metrics import encode_fps, encode_speed
+from app.optionsets import option_sets
+from app.probes import probes
+from app.progress import FfmpegProgress
+from app.segments import (SegmentManifest, auxiliary_command, concat_command,
+                          mux_command, plan_segments, probe_keyframes,
+                          segment_command, unsplittable, video_first)
+from app.spans import span, wait_process
 from modules.base import BaseModule
 
 
@@ -21,15 +39,18 @@ class Ffmpeg(BaseModule):
     """The Ffmpeg module used to perform encoding.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
         ffmpeg (Ffmpeg): The `sisyphus-ffmpeg` module for processing `ffmpeg` tasks
+        retries (int): The number of times the encode was restarted after Ffmpeg crashed
     """
     ffmpeg: F
+    retries: int
+    reports_progress = True
 
-    def __init__(self, task):
-        super().__init__(task)
+    def __init__(self, task, **kwargs):
+        super().__init__(task, **kwargs)
         logger.info("Module loaded successfully.")
         logger.debug(f"Data: {self.task}")
         self.status = Box({
@@ -38,10 +59,17 @@ class Ffmpeg(BaseModule):
         })
         self.heartbeat.set_data(self.status)
         self.ffmpeg = F()
+        self.retries = 0
+
+    @classmethod
+    def warmup(cls):
+        cls.probe_version(["ffmpeg", "-version"])
 
     def validate(self):
         for source in self.task.sources:
             source = Path(source)
+            if source in self.streams:
+                continue
             if not source.exists() or not source.is_file():
                 raise ValidationError(
                     f"Source '{str(source.absolute())}' does not exist.")
@@ -59,37 +87,407 @@ class Ffmpeg(BaseModule):
 
         logger.info("Task data validated successfully.")
 
-    def run_encode(self) -> int:
-        """Run the actual encode using Ffmpeg.
+    def build_command(self) -> List[str]:
+        """Build the Ffmpeg command for the task.
 
         Returns:
-            int: The exit/return code of Ffmpeg.
+            List[str]: The command to run.
         """
         command = self.ffmpeg.generate_command()
-        info = self.ffmpeg.get_primary_video_information()
-        logger.debug(f"Video information: {info}")
         logger.debug(f"Command to run: {command}")
         command = shlex.split(command)
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        while True:
-            time.sleep(1)
-            if (return_code := process.poll()) is not None:
-                break
-            for line in process.stdout:
-                if match := re.search(r"frame=(\s*\d+)", line.decode()):
-                    current_frame = int(match.group(1))
-                    self.status.info = {
-                        "current_frame": current_frame,
-                    }
-                    if info.frames:
-                        self.status.info.total_frames = info.frames
-                        self.status.progress = current_frame / info.frames * 100
-                    self.heartbeat.set_data(self.status)
-                    
+        if cpus.enabled and "-filter_threads" not in command:
+            command[1:1] = [
+                "-filter_threads", str(cpus.threads(self.heartbeat.index))]
+        return command
+
+    def get_video_information(self) -> Box:
+        """Return the primary video information of the sources.
+
+        Sources that are streams cannot be probed without consuming them, so
+        there is no information (e.g. the frame count) for them.
+
+        Returns:
+            Box: The primary video information.
+        """
+        if self.streamed_paths() & {Path(i) for i in self.task.sources}:
+            return Box(frames=None)
+        info = probes.get(
+            "ffmpeg.primary_video", self.task.sources,
+            self.ffmpeg.get_primary_video_information)
+        logger.debug(f"Video information: {info}")
+        return info
+
+    def output_file(self) -> Path:
+        return Path(shlex.split(self.ffmpeg.generate_command())[-1])
+
+    def cache_key(self) -> Optional[str]:
+        return encodes.key("ffmpeg", self.task.sources, self.ffmpeg.generate_command(), self.output_file())
+
+    @staticmethod
+    def with_progress(command: List[str], progress_fd: int) -> List[str]:
+        """Add machine-readable progress output to an Ffmpeg command.
+
+        Args:
+            command (List[str]): The command
+            progress_fd (int): The file descriptor ffmpeg writes `-progress` output to.
+
+        Returns:
+            List[str]: The command writing progress to the file descriptor.
+        """
+        return command[:1] + ["-nostats", "-progress", f"pipe:{progress_fd}"] + command[1:]
+
+    def prepare_encode(self, progress_fd: int) -> Tuple[List[str], Box]:
+        """Build the Ffmpeg command, writing machine-readable progress to the given file descriptor.
+
+        Args:
+            progress_fd (int): The file descriptor ffmpeg writes `-progress` output to.
+
+        Returns:
+            Tuple[List[str], Box]: The command to run and the primary video information.
+        """
+        return self.with_progress(self.build_command(), progress_fd), self.get_video_information()
+
+    def execute(self, command: List[str], on_progress: Callable[[Box], None], log_errors: bool = True, stop: Optional[threading.Event] = None) -> Tuple[int, List[bytes]]:
+        """Run an Ffmpeg command, reporting its progress.
+
+        Progress is read from ffmpeg's machine-readable `-progress` output on a
+        dedicated pipe while `stderr` is drained alongside it, so the loop wakes
+        up as soon as either has data or the process exits.
+
+        Args:
+            command (List[str]): The command to run
+            on_progress (Callable[[Box], None]): Called with every parsed progress block from `FfmpegProgress`
+            log_errors (bool, optional): Whether to log the tail of `stderr` if the command fails. Defaults to True.
+            stop (threading.Event, optional): Once set, the command is not started (or is killed if it just started). Defaults to None.
+
+        Returns:
+            Tuple[int, List[bytes]]: The exit/return code of Ffmpeg and the last lines it wrote to `stderr`.
+        """
+        def stopped() -> bool:
+            return self.stopping.is_set() or bool(stop and stop.is_set())
+
+        if stopped():
+            return -signal.SIGKILL, []
+        with span("process", command=Path(command[0]).name) as current:
+            progress_fd, write_fd = os.pipe()
+            try:
+                with cpus.pinned(self.heartbeat.index):
+                    process = subprocess.Popen(
+                        self.with_progress(command, write_fd), stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=(write_fd,))
+            except BaseException:
+                os.close(progress_fd)
+                raise
+            finally:
+                os.close(write_fd)
+
+            self.processes.add(process)
+            if stopped():
+                process.kill()
+            parser = FfmpegProgress()
+            stderr_tail = deque(maxlen=20)
+            stderr_buffer = b""
+            with selectors.DefaultSelector() as selector:
+                selector.register(progress_fd, selectors.EVENT_READ, "progress")
+                selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        chunk = os.read(key.fd, 65536)
+                        if not chunk:
+                            selector.unregister(key.fileobj)
+                            continue
+                        if key.data == "stderr":
+                            *lines, stderr_buffer = (stderr_buffer + chunk).split(b"\n")
+                            stderr_tail.extend(lines)
+                            continue
+                        if blocks := parser.feed(chunk):
+                            on_progress(blocks[-1])
+
+            os.close(progress_fd)
+            process.stderr.close()
+            return_code = wait_process(process, current)
+        self.processes.discard(process)
+        stderr_tail.append(stderr_buffer)
+        if return_code != 0 and log_errors:
+            self.log_stderr(stderr_tail)
+        return return_code, list(stderr_tail)
+
+    def run_encode(self) -> int:
+        """Run the actual encode using Ffmpeg.
+
+        Returns:
+            int: The exit/return code of Ffmpeg.
+        """
+        command, info = self.build_command(), self.get_video_information()
+        return_code, _ = self.execute(
+            command, lambda progress: self.update_progress(progress, info.frames))
+        return return_code
+
+    def run_segmented(self) -> Optional[int]:
+        """Run the encode as segments of the primary video encoded in parallel.
+
+        The primary video is split on keyframes into `FFMPEG_SEGMENT_WORKERS * 2`
+        segments (no shorter than `FFMPEG_SEGMENT_MIN_LENGTH` seconds) that are
+        encoded by a pool of Ffmpeg processes.  The audio, subtitles, and
+        chapters are processed once by another process in the same pool.  The
+        encoded segments are then joined and muxed with the other streams
+        without re-encoding.
+
+        With `FFMPEG_CHECKPOINTS`, segments are at most `FFMPEG_CHECKPOINT_INTERVAL`
+        seconds long and every finished segment is recorded in a manifest next to
+        them.  If the encode fails, the segments are kept so that the next attempt
+        (or the next worker to claim the job) only encodes the missing ones.
+        Without `FFMPEG_SEGMENTS`, the segments are encoded one at a time.
+
+        Returns:
+            Optional[int]: The exit/return code of the first failing Ffmpeg process (or 0), or None if the encode cannot be split.
+        """
+        command = self.build_command()
+        if option := unsplittable(command):
+            logger.info(f"Encoding without segments, the command uses `{option}`.")
+            return None
+        try:
+            if not video_first(command):
+                logger.info("Encoding without segments, the output does not start with its video streams.")
+                return None
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            logger.info(f"Encoding without segments, could not find the order of the streams: {e}")
+            return None
+        output = Path(command[-1])
+        directory = output.parent / f".{output.name}.segments"
+        workers = Config.FFMPEG_SEGMENT_WORKERS if Config.FFMPEG_SEGMENTS else 1
+
+        manifest = None
+        if Config.FFMPEG_CHECKPOINTS:
+            # The command as the task defines it, so that a worker with other CPUs can resume the encode
+            key = probes.fingerprint(f"ffmpeg.segments {self.ffmpeg.generate_command()}", self.task.sources)
+            manifest = SegmentManifest.load(directory / "manifest.json", key)
+        if manifest:
+            plan = manifest.plan
+        else:
+            try:
+                keyframes = probe_keyframes(str(self.task.sources[0]))
+            except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+                logger.info(f"Encoding without segments, could not find keyframes: {e}")
+                return None
+            if keyframes.duration < Config.FFMPEG_SEGMENT_MIN_DURATION:
+                return None
+            count = workers * 2
+            if Config.FFMPEG_CHECKPOINTS:
+                count = max(count, math.ceil(keyframes.duration / Config.FFMPEG_CHECKPOINT_INTERVAL))
+            plan = plan_segments(keyframes.duration, keyframes.keyframes,
+                                 count, Config.FFMPEG_SEGMENT_MIN_LENGTH)
+            if len(plan) < 2:
+                return None
+            if Config.FFMPEG_CHECKPOINTS:
+                shutil.rmtree(directory, ignore_errors=True)
+                manifest = SegmentManifest(directory / "manifest.json", key, plan)
+
+        info = self.get_video_information()
+        directory.mkdir(parents=True, exist_ok=True)
+        threads = max(1, cpus.threads(self.heartbeat.index) // workers)
+        segments = [directory / f"{idx:04d}.mkv" for idx in range(len(plan))]
+        auxiliary = directory / f"auxiliary{output.suffix}"
+        done = {i for i in segments if manifest and manifest.is_complete(i)}
+        if done:
+            logger.info(f"Resuming encode, {len(done)} of {len(plan)} segments already encoded.")
+        logger.info(f"Encoding {len(plan) - len(done)} segments with {workers} processes.")
+
+        frames = [manifest.frames(i) if i in done else 0 for i in segments]
+        fps = [0.0] * len(plan)
+        lock = threading.Lock()
+
+        def on_progress(idx: int, progress: Box) -> None:
+            with lock:
+                frames[idx] = progress.frame or frames[idx]
+                fps[idx] = progress.fps or 0.0
+                total = Box(frame=sum(frames), fps=round(sum(fps), 2),
+                            speed=None, bitrate=None, out_time=None)
+                self.update_progress(total, info.frames)
+
+        stop = threading.Event()
+
+        def encode(command: List[str], path: Path, idx: Optional[int] = None) -> Tuple[int, List[bytes]]:
+            if idx is None:
+                result = self.execute(command, lambda _: None, False, stop)
+            else:
+                result = self.execute(command, functools.partial(on_progress, idx), stop=stop)
+            if result[0] == 0 and manifest:
+                manifest.record(path, frames[idx] if idx is not None else 0)
+            return result
+
+        finished = False
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                auxiliary_run = None
+                if not (manifest and manifest.is_complete(auxiliary)):
+                    auxiliary_run = executor.submit(
+                        contextvars.copy_context().run,
+                        encode, auxiliary_command(command, auxiliary), auxiliary)
+                runs = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        encode, segment_command(command, segment, path, threads), path, idx)
+                    for idx, (segment, path) in enumerate(zip(plan, segments)) if path not in done
+                ]
+                for run in as_completed(runs):
+                    if (return_code := run.result()[0]) != 0:
+                        # Stop the other segments; the pool waits for them to exit
+                        stop.set()
+                        for process in list(self.processes):
+                            process.kill()
+                        return return_code
+                return_code, stderr_tail = auxiliary_run.result() if auxiliary_run else (0, [])
+
+            if return_code != 0:
+                if not any(b"does not contain any stream" in i for i in stderr_tail):
+                    self.log_stderr(stderr_tail)
+                    return return_code
+                auxiliary = None
+
+            concat_list = directory / "segments.txt"
+            concat_list.write_text("".join(
+                "file '{}'\n".format(str(i).replace("'", "'\\''")) for i in segments))
+            video = directory / "video.mkv"
+            for step in (concat_command(command[0], concat_list, video),
+                         mux_command(command[0], video, auxiliary, str(output), "-y" in command)):
+                with span("process", command=Path(step[0]).name) as current, cpus.pinned(self.heartbeat.index):
+                    result = subprocess.run(step, stdin=subprocess.DEVNULL, capture_output=True)
+                    current.set(exit_code=result.returncode)
+                if result.returncode != 0:
+                    self.log_stderr(result.stderr.splitlines()[-20:])
+                    return result.returncode
+            finished = True
+        finally:
+            if finished or not manifest:
+                shutil.rmtree(directory, ignore_errors=True)
+        return 0
+
+    async def run_encode_async(self) -> int:
+        """Run the actual encode using Ffmpeg on the event loop.
+
+        The progress pipe and `stderr` are streamed concurrently.  If the task is
+        cancelled (e.g. on timeout), the ffmpeg process is killed.
+
+        Returns:
+            int: The exit/return code of Ffmpeg.
+        """
+        loop = asyncio.get_running_loop()
+        progress_fd, write_fd = os.pipe()
+        try:
+            command, info = await asyncio.to_thread(self.prepare_encode, write_fd)
+            with cpus.pinned(self.heartbeat.index):
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE, pass_fds=(write_fd,))
+        except BaseException:
+            os.close(progress_fd)
+            raise
+        finally:
+            os.close(write_fd)
+
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(progress_fd, "rb", 0))
+
+        async def read_progress():
+            parser = FfmpegProgress()
+            while chunk := await reader.read(65536):
+                if blocks := parser.feed(chunk):
+                    self.update_progress(blocks[-1], info.frames)
+
+        stderr_tail = deque(maxlen=20)
+
+        async def read_stderr():
+            buffer = b""
+            while chunk := await process.stderr.read(65536):
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                stderr_tail.extend(lines)
+            stderr_tail.append(buffer)
+
+        try:
+            with span("process", command=Path(command[0]).name) as current:
+                await asyncio.gather(read_progress(), read_stderr())
+                return_code = await process.wait()
+                current.set(exit_code=return_code)
+        except asyncio.CancelledError:
+            logger.warning("Encode cancelled, stopping ffmpeg.")
+            process.kill()
+            await process.wait()
+            raise
+        finally:
+            transport.close()
+
+        if return_code != 0:
+            self.log_stderr(stderr_tail)
         return return_code
 
+    def log_stderr(self, lines: Iterable[bytes]) -> None:
+        """Log the tail of ffmpeg's `stderr` output after a failed encode.
+
+        Args:
+            lines (Iterable[bytes]): The last lines written to `stderr`.
+        """
+        for line in lines:
+            if line := line.decode(errors="replace").strip():
+                logger.warning(f"ffmpeg: {line}")
+
+    def update_progress(self, progress: Box, total_frames: Optional[int]) -> None:
+        """Update the heartbeat status with the latest progress from ffmpeg.
+
+        Args:
+            progress (Box): The parsed progress block from `FfmpegProgress`.
+            total_frames (int, optional): The number of frames in the primary video stream.
+        """
+        self.status.info = {
+            "current_frame": progress.frame,
+            "fps": progress.fps,
+            "speed": progress.speed,
+            "bitrate": progress.bitrate,
+            "out_time": progress.out_time,
+        }
+        if total_frames and progress.frame is not None:
+            self.status.info.total_frames = total_frames
+            self.status.progress = progress.frame / total_frames * 100
+        if progress.fps is not None:
+            encode_fps.set(progress.fps, slot=self.heartbeat.index, module="ffmpeg")
+        if progress.speed is not None:
+            encode_speed.set(progress.speed, slot=self.heartbeat.index, module="ffmpeg")
+        self.heartbeat.set_data(self.status)
+
+    def should_retry(self, return_code: int) -> bool:
+        """Check the exit code of an encode.
+
+        Crashes (SIGSEGV) are retried up to `FFMPEG_MAX_RETRIES` times.  With
+        `FFMPEG_CHECKPOINTS`, a retry only encodes the segments that are missing.
+
+        Args:
+            return_code (int): The exit/return code of Ffmpeg.
+
+        Raises:
+            RunError: Ffmpeg failed to complete the encode successfully.
+
+        Returns:
+            bool: `True` if the encode should be restarted, otherwise `False`
+        """
+        # This is here because of some issues with ffmpeg in the past.
+        # Streams cannot be read again, so streamed encodes are not retried.
+        if return_code == -11 and self.retries < Config.FFMPEG_MAX_RETRIES and not self.streamed_paths():
+            self.retries += 1
+            logger.warning(
+                f"Encountered error with encode (SIGSEGV), restarting encode "
+                f"[retry {self.retries} of {Config.FFMPEG_MAX_RETRIES}].")
+            return True
+
+        if return_code != 0:
+            command = self.ffmpeg.generate_command()
+            retries = f" after {self.retries} retries" if self.retries else ""
+            raise RunError(
+                f"The `ffmpeg` command returned exit code {return_code}{retries}, command: {command}")
+
+        return False
+
     def run(self):
         """Run the encode with Ffmpeg.
 
@@ -98,20 +496,53 @@ class Ffmpeg(BaseModule):
         """
         self.set_start_time()
         logger.info(f"Running ffmpeg encoding task")
-        while True:
-            return_code = self.run_encode()
-        
-            # This is here because of some issues with ffmpeg in the past.
-            if return_code == -11:
-                logger.warning("Encountered error with encode (SIGSEGV), restarting encode.")
-                continue
-                
-            if return_code != 0:
-                command = self.ffmpeg.generate_command()
-                raise RunError(
-                    f"The `ffmpeg` command returned exit code {return_code}, command: {command}")
-                
-            return
+        if not self.restore_output():
+            while self.should_retry(self.encode()):
+                pass
+            self.store_output()
+        self.checksum_output()
+
+    def encode(self) -> int:
+        """Run the encode once, in segments if enabled and possible.
+
+        Returns:
+            int: The exit/return code of Ffmpeg.
+        """
+        if (Config.FFMPEG_SEGMENTS or Config.FFMPEG_CHECKPOINTS) and not self.streamed_paths():
+            if (return_code := self.run_segmented()) is not None:
+                return return_code
+        return self.run_encode()
+
+    async def run_async(self):
+        """Run the encode with Ffmpeg on the event loop.
+
+        Raises:
+            RunError: Ffmpeg fails to complete the encode successfully.
+        """
+        self.set_start_time()
+        logger.info(f"Running ffmpeg encoding task")
+        if not await asyncio.to_thread(self.restore_output):
+            while self.should_retry(await self.encode_async()):
+                pass
+            await asyncio.to_thread(self.store_output)
+        await asyncio.to_thread(self.checksum_output)
+
+    async def encode_async(self) -> int:
+        """Run the encode once on the event loop, in segments if enabled and possible.
+
+        Returns:
+            int: The exit/return code of Ffmpeg.
+        """
+        if (Config.FFMPEG_SEGMENTS or Config.FFMPEG_CHECKPOINTS) and not self.streamed_paths():
+            try:
+                return_code = await asyncio.to_thread(self.run_segmented)
+            except asyncio.CancelledError:
+                logger.warning("Encode cancelled, stopping ffmpeg.")
+                self.stop()
+                raise
+            if return_code is not None:
+                return return_code
+        return await self.run_encode_async()
 
     def get_options_from_server(self) -> bool:
         """Retrieves module option set data from the API server.
@@ -122,20 +553,15 @@ class Ffmpeg(BaseModule):
         Returns:
             bool: Returns `True` if the task data has changed, otherwise `False`
         """
-        has_changed = False
-        for output_map in self.task.get("output_maps", []):
-            output_map_keys = output_map.keys()
-            if "option_set" in output_map_keys:
-                has_changed = True
-                logger.info(f"Retrieving option set: {output_map.option_set}")
-                r = requests.get(Config.API_URL +
-                                 "/data/ffmpeg/" + output_map.option_set)
-                if r.status_code == 404:
-                    raise ValidationError(
-                        f"Could not find server-side option set '{output_map.option_set}'")
-                options = Box(json.loads(r.content)).options
-                output_map.options = output_map.get("options", {}) | options
-                output_map.pop("option_set")
+        output_maps = [
+            i for i in self.task.get("output_maps", []) if "option_set" in i.keys()
+        ]
+        has_changed = bool(output_maps)
+        options = option_sets.resolve(
+            "ffmpeg", [i.option_set for i in output_maps])
+        for output_map in output_maps:
+            output_map.options = output_map.get("options", {}) | options[output_map.option_set]
+            output_map.pop("option_set")
 
         if has_changed:
             logger.debug(f"Updated data: {self.task}")
@@ -1,7 +1,8 @@
-import re
+import asyncio
 import subprocess
 import time
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 from box import Box
 from handbrake.parser import Parser
@@ -9,7 +10,13 @@ from jsonschema import exceptions as JsonExceptions
 from loguru import logger
 
 from app.config import Config
+from app.cpus import cpus
+from app.encodes import encodes
 from app.exceptions import RunError, ValidationError
+from app.metrics import encode_fps
+from app.probes import probes
+from app.progress import HandbrakeProgress
+from app.spans import span, wait_process
 from ffprobe import Ffprobe
 from modules.base import BaseModule
 
@@ -18,15 +25,16 @@ class Handbrake(BaseModule):
     """The Hanbrake module used to perform encoding.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
         handbrake (Parser): The `sisyphus-handbrake` module for processing `handbrake` tasks
     """
     handbrake: Parser
+    reports_progress = True
 
-    def __init__(self, task):
-        super().__init__(task)
+    def __init__(self, task, **kwargs):
+        super().__init__(task, **kwargs)
         logger.info("Module loaded successfully.")
         logger.debug(f"Data: {self.task}")
         self.status = Box({
@@ -35,54 +43,157 @@ class Handbrake(BaseModule):
         })
         self.heartbeat.set_data(self.status)
         self.handbrake = Parser()
+        self._progress_sent = 0.0
+
+    @classmethod
+    def warmup(cls):
+        cls.probe_version(["HandBrakeCLI", "--version"])
 
     def validate(self):
         try:
             self.handbrake.load_from_object(self.task)
         except JsonExceptions.ValidationError as e:
             raise ValidationError(f"Could not validate task: {e.message}, {e.json_path}")
+        if streams := self.streamed_paths():
+            raise ValidationError(
+                f"HandBrakeCLI cannot read or write streams: {', '.join(sorted(str(i) for i in streams))}")
         logger.info("Task data validated successfully.")
 
-    def run_encode(self) -> int:
-        """Run the actual encode using Handbrake.
+    def prepare_encode(self) -> Tuple[List[str], Optional[int]]:
+        """Build the HandBrakeCLI command and find the number of frames in the source.
 
         Returns:
-            int: The exit/return code of HandBrakeCLI.
+            Tuple[List[str], Optional[int]]: The command to run and the number of frames in the source video.
         """
-        ffprobe = Ffprobe(self.handbrake.data.source)
-        frames = ffprobe.get_streams("video")[0].frames
+        source = self.handbrake.data.source
+        frames = probes.get(
+            "ffprobe.frames", source,
+            lambda: Ffprobe(source).get_streams("video")[0].frames)
         frames = frames if frames else None
 
         command = self.handbrake.generate_command()
         if "--json" not in command:
                 command.append("--json")
-                
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-
-        working_state = False
-        while True:
-            time.sleep(1)
-            if (return_code := process.poll()) is not None:
-                break
-            for line in process.stdout:
-                if not working_state:
-                    if match := re.search(r'"WORKING"', line.decode()):
-                        working_state = True
-                if (match := re.search(r'"Progress": (\d+\.\d+)', line.decode())) and working_state:
-                    completed_perc = float(match.group(1))
-                    encode_progress = int(completed_perc * frames) if frames else None
-                
-                    self.status.info = {
-                        "current_frame": encode_progress,
-                    }
-                    if frames:
-                        self.status.info.total_frames = frames
-                        self.status.progress = encode_progress / frames * 100
-                    self.heartbeat.set_data(self.status)
-        
-        return process.returncode
+
+        self._progress_sent = 0.0
+        return command, frames
+
+    def output_file(self) -> Optional[Path]:
+        command = [str(i) for i in self.handbrake.generate_command()]
+        output = next(
+            (command[i + 1] for i, flag in enumerate(command[:-1]) if flag in ("-o", "--output")), None)
+        return Path(output) if output else None
+
+    def cache_key(self) -> Optional[str]:
+        command = [str(i) for i in self.handbrake.generate_command()]
+        return encodes.key("handbrake", [self.handbrake.data.source], command, self.output_file())
+
+    def update_progress(self, progress: Box, frames: Optional[int]) -> None:
+        """Update the heartbeat status from a HandBrakeCLI progress event.
+
+        Updates are sent at most once per second, except when a new pass starts
+        or the encode finishes.
+
+        Args:
+            progress (Box): The progress event from `HandbrakeProgress`
+            frames (int, optional): The number of frames in the source video
+        """
+        if progress.state == "WORKDONE":
+            self.status.progress = 100.0
+            self.heartbeat.set_data(self.status)
+            return
+        if progress.state != "WORKING":
+            return
+        now = time.monotonic()
+        if (now - self._progress_sent < 1
+                and progress["pass"] == self.status.get("info", {}).get("pass")):
+            return
+        self._progress_sent = now
+
+        self.status.info = {
+            "pass": progress["pass"],
+            "pass_count": progress.pass_count,
+            "fps": progress.fps,
+            "avg_fps": progress.avg_fps,
+            "eta": progress.eta,
+        }
+        if frames and progress.progress is not None:
+            self.status.info.current_frame = int(progress.progress * frames)
+            self.status.info.total_frames = frames
+        if progress.overall is not None:
+            self.status.progress = progress.overall
+        if progress.fps is not None:
+            encode_fps.set(progress.fps, slot=self.heartbeat.index, module="handbrake")
+        self.heartbeat.set_data(self.status)
+
+    def run_encode(self) -> int:
+        """Run the actual encode using Handbrake.
+
+        Returns:
+            int: The exit/return code of HandBrakeCLI.
+        """
+        command, frames = self.prepare_encode()
+        with span("process", command=Path(command[0]).name) as current:
+            with cpus.pinned(self.heartbeat.index):
+                process = subprocess.Popen(
+                    command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
+            self.processes.add(process)
+            if self.stopping.is_set():
+                process.kill()
+
+            parser = HandbrakeProgress()
+            while chunk := process.stdout.read1(65536):
+                if events := parser.feed(chunk):
+                    self.update_progress(events[-1], frames)
+
+            process.stdout.close()
+            return_code = wait_process(process, current)
+        self.processes.discard(process)
+        return return_code
+
+    async def run_encode_async(self) -> int:
+        """Run the actual encode using Handbrake on the event loop.
+
+        If the task is cancelled (e.g. on timeout), the HandBrakeCLI process is killed.
+
+        Returns:
+            int: The exit/return code of HandBrakeCLI.
+        """
+        command, frames = await asyncio.to_thread(self.prepare_encode)
+        with cpus.pinned(self.heartbeat.index):
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+
+        parser = HandbrakeProgress()
+        try:
+            with span("process", command=Path(command[0]).name) as current:
+                while chunk := await process.stdout.read(65536):
+                    if events := parser.feed(chunk):
+                        self.update_progress(events[-1], frames)
+                return_code = await process.wait()
+                current.set(exit_code=return_code)
+                return return_code
+        except asyncio.CancelledError:
+            logger.warning("Encode cancelled, stopping HandBrakeCLI.")
+            process.kill()
+            await process.wait()
+            raise
+
+    def check_return_code(self, return_code: int) -> None:
+        """Check the exit code of an encode.
+
+        Args:
+            return_code (int): The exit/return code of HandBrakeCLI.
+
+        Raises:
+            RunError: HandBrakeCLI failed to complete the encode successfully.
+        """
+        if return_code != 0:
+            command = self.handbrake.generate_command(as_string=True)
+            raise RunError(
+                f"The `HandBrakeCLI` command returned exit code {return_code}, command: {' '.join(command)}")
 
     def run(self):
         """Run the encode with HandBrakeCLI.
@@ -92,10 +203,20 @@ class Handbrake(BaseModule):
         """
         self.set_start_time()
         logger.info(f"Running handbrake encoding task")
-        while True:
-            return_code = self.run_encode()
-            if return_code != 0:
-                command = self.handbrake.generate_command(as_string=True)
-                raise RunError(
-                    f"The `HandBrakeCLI` command returned exit code {return_code}, command: {' '.join(command)}")
-            return
+        if not self.restore_output():
+            self.check_return_code(self.run_encode())
+            self.store_output()
+        self.checksum_output()
+
+    async def run_async(self):
+        """Run the encode with HandBrakeCLI on the event loop.
+
+        Raises:
+            RunError: HandBrakeCLI fails to complete the encode successfully.
+        """
+        self.set_start_time()
+        logger.info(f"Running handbrake encoding task")
+        if not await asyncio.to_thread(self.restore_output):
+            self.check_return_code(await self.run_encode_async())
+            await asyncio.to_thread(self.store_output)
+        await asyncio.to_thread(self.checksum_output)
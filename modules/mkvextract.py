@@ -1,5 +1,5 @@
 from box import Box
-from jsonschema.exceptions import JsonExceptions
+from jsonschema import exceptions as JsonExceptions
 from loguru import logger
 from mkvextract import MkvExtract as M
 
@@ -11,15 +11,15 @@ class Mkvextract(BaseModule):
     """The Mkvextract module used to extract tracks and other information from a Matroska file.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
         mkvextract (MkvExtract): The `sisyphus-ffmpeg` module for processing `ffmpeg` tasks
     """
     mkvextract: M
 
-    def __init__(self, task):
-        super().__init__(task)
+    def __init__(self, task, **kwargs):
+        super().__init__(task, **kwargs)
         logger.info("Module loaded successfully.")
         logger.debug(f"Data: {self.task}")
         self.status = Box({
@@ -29,6 +29,10 @@ class Mkvextract(BaseModule):
         self.heartbeat.set_data(self.status)
         self.mkvextract = M()
 
+    @classmethod
+    def warmup(cls):
+        cls.probe_version(["mkvextract", "--version"])
+
     def validate(self):
         try:
             self.mkvextract.load_from_object(self.task)
@@ -41,7 +45,8 @@ class Mkvextract(BaseModule):
     def run(self):
         self.set_start_time()
         logger.info("Running 'mkvextract' task")
-        return_code = self.mkvextract.extract()
+        # Run the command rather than `extract()` so that `stop` can kill the process
+        return_code = self.run_process(self.mkvextract.generate_command(as_string=True))
         if return_code != 0:
             raise RunError(
                 f"The 'mkvextract' command exited with error code: {return_code}")
@@ -1,9 +1,20 @@
+import contextvars
+import json
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import List
+
 from box import Box
 from jsonschema import exceptions as JsonExceptions
 from loguru import logger
 from mkvmerge import MkvMerge as M
 
+from app.config import Config
 from app.exceptions import RunError, ValidationError
+from app.probes import probes
 from modules.base import BaseModule
 
 
@@ -11,15 +22,15 @@ class Mkvmerge(BaseModule):
     """The Mkvmerge module used to merge tracks and other information into a Matroska file.
 
     Attributes:
-        heartbeat (Heartbeat): The heartbeat object for sending status back to the API server
+        heartbeat (HeartbeatSlot): The job slot heartbeat for sending status back to the API server
         task (Box): The data that contains the task information to run from the job
         start_time (datetime): The time the module was initialized (task start time)
         mkvmerge (MkvMerge): The `sisyphus-ffmpeg` module for processing `ffmpeg` tasks
     """
     mkvmerge: M
 
-    def __init__(self, task):
-        super().__init__(task)
+    def __init__(self, task, **kwargs):
+        super().__init__(task, **kwargs)
         logger.info("Module loaded successfully.")
         logger.debug(f"Data: {self.task}")
         self.status = Box({
@@ -29,30 +40,101 @@ class Mkvmerge(BaseModule):
         self.heartbeat.set_data(self.status)
         self.mkvmerge = M()
 
+    @classmethod
+    def warmup(cls):
+        cls.probe_version(["mkvmerge", "--version"])
+
     def validate(self):
         try:
             self.mkvmerge.load_from_object(self.task)
         except JsonExceptions.ValidationError as e:
             raise ValidationError(e.message)
+        if streams := self.streamed_paths():
+            raise ValidationError(
+                f"mkvmerge cannot read or write streams: {', '.join(sorted(str(i) for i in streams))}")
 
+        # Loading the task identified every source, keep the results for the run and later jobs
+        for source in self.mkvmerge.sources:
+            if source.info and not source.info.get("errors"):
+                probes.put("mkvmerge.identify", source.source_file, source.info.to_dict())
         logger.info("Task data validated successfully.")
 
+    @staticmethod
+    def identify(path: Path) -> dict:
+        """Identify a source file with `mkvmerge -J`.
+
+        Args:
+            path (Path): The source file
+
+        Raises:
+            RunError: The source file could not be identified.
+
+        Returns:
+            dict: The identification of the source file.
+        """
+        result = subprocess.run(["mkvmerge", "-J", str(path)], capture_output=True)
+        try:
+            info = json.loads(result.stdout)
+        except json.JSONDecodeError:
+            raise RunError(
+                f"Error loading source file '{str(path)}': {result.stderr.decode(errors='replace').strip()}")
+        if info.get("errors"):
+            raise RunError(f"Error loading source file '{str(path)}': {info['errors'][0]}")
+        return info
+
+    def reload_source_information(self) -> None:
+        """Identify the source files again in parallel, reusing the cached identification of unchanged files.
+
+        Each source is looked up in the probe cache on its own, so only the
+        sources that changed since they were identified (e.g. by `validate` or
+        an earlier job) are identified again.
+
+        Raises:
+            RunError: A source file could not be identified.
+        """
+        sources = self.mkvmerge.sources
+        workers = max(1, min(Config.MKVMERGE_IDENTIFY_WORKERS, len(sources)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            runs = [
+                executor.submit(
+                    contextvars.copy_context().run, probes.get, "mkvmerge.identify",
+                    source.source_file, partial(self.identify, source.source_file))
+                for source in sources
+            ]
+            for source, run in zip(sources, runs):
+                source.info = Box(run.result())
+        logger.info("Reloaded source information.")
+
+    @staticmethod
+    def delete_option_files(command: List[str]) -> None:
+        """Delete the option files (`@file` arguments) a generated mkvmerge command keeps in the temporary directory.
+
+        Option files anywhere else came from the task and are left alone.
+
+        Args:
+            command (List[str]): The mkvmerge command
+        """
+        temp = Path(tempfile.gettempdir()).resolve()
+        for argument in command[1:]:
+            if argument.startswith("@") and Path(argument[1:]).resolve().parent == temp:
+                Path(argument[1:]).unlink(missing_ok=True)
+
     def run(self):
         self.set_start_time()
-        self.mkvmerge.reload_source_information()
-        logger.info("Rescanned source information.")
-        
         for source in self.mkvmerge.sources:
             if not source.source_file.exists():
                 raise RunError(f"The source file '{str(source.source_file)}' does not exist!")
-            if source.info.errors:
-                raise RunError(f"Error loading source file '{str(source.source_file)}': {source.info.errors[0]}")
-            
+        self.reload_source_information()
+
         command = self.mkvmerge.generate_command(as_string=True)
         logger.debug("Command to run: {command}")
         logger.info("Running mkvmerge muxing task")
         
-        return_code = self.mkvmerge.mux(delete_temp=True)
+        # Run the command rather than `mux()` so that `stop` can kill the process
+        try:
+            return_code = self.run_process(command)
+        finally:
+            self.delete_option_files(command)
         if return_code != 0:
             raise RunError(
                 f"The `mkvmerge` command returned exit code {return_code}, command: {command}")
@@ -0,0 +1,139 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+from app import fileops
+from app.fileops import (ChecksumMismatch, checksum_supported, copy_file, hash_file,
+                         move_file)
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    path = tmp_path / "source.bin"
+    path.write_bytes(os.urandom(256 * 1024 + 7))
+    os.utime(path, (1_600_000_000, 1_600_000_000))
+    return path
+
+
+def copy_with(func, source: Path, destination: Path, size: int):
+    with source.open("rb") as src, destination.open("wb") as dest:
+        return func(src.fileno(), dest.fileno(), size, 64 * 1024, None)
+
+
+def test_copy_file_copies_data_and_metadata(source: Path, tmp_path: Path):
+    copied = list()
+    result = copy_file(source, tmp_path / "copy.bin", callback=copied.append)
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert (tmp_path / "copy.bin").stat().st_mtime == source.stat().st_mtime
+    assert result.size == sum(copied) == source.stat().st_size
+    assert result.strategy in [name for name, _ in fileops.STRATEGIES]
+
+
+def test_copy_file_into_directory(source: Path, tmp_path: Path):
+    (tmp_path / "out").mkdir()
+    result = copy_file(source, tmp_path / "out")
+    assert result.destination == tmp_path / "out" / source.name
+    assert result.destination.read_bytes() == source.read_bytes()
+
+
+def test_copy_file_replaces_destination(source: Path, tmp_path: Path):
+    (tmp_path / "copy.bin").write_bytes(b"old")
+    copy_file(source, tmp_path / "copy.bin")
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["copy.bin", "source.bin"]
+
+
+@pytest.mark.parametrize("destination", ["source.bin", "link.bin", "."])
+def test_copy_file_refuses_same_file(source: Path, tmp_path: Path, destination: str):
+    os.link(source, tmp_path / "link.bin")
+    data = source.read_bytes()
+    with pytest.raises(OSError):
+        copy_file(source, tmp_path / destination)
+    assert source.read_bytes() == data
+
+
+def test_failed_copy_keeps_destination(source: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    def fail(src_fd, dest_fd, size, chunk_size, callback):
+        os.write(dest_fd, b"partial")
+        raise OSError("disk full")
+
+    (tmp_path / "copy.bin").write_bytes(b"old")
+    monkeypatch.setattr(fileops, "STRATEGIES", [("failing", fail)])
+    with pytest.raises(OSError):
+        copy_file(source, tmp_path / "copy.bin")
+    assert (tmp_path / "copy.bin").read_bytes() == b"old"
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["copy.bin", "source.bin"]
+
+
+@pytest.mark.parametrize("strategy", ["copy_file_range", "sendfile", "buffered"])
+def test_strategies_copy_whole_file(source: Path, tmp_path: Path, strategy: str):
+    func = dict(fileops.STRATEGIES)[strategy]
+    assert copy_with(func, source, tmp_path / "copy.bin", source.stat().st_size)
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+
+
+def test_copy_falls_back_to_next_strategy(source: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(fileops, "STRATEGIES", [
+        ("unsupported", lambda *args: False), ("buffered", fileops._buffered)])
+    result = copy_file(source, tmp_path / "copy.bin")
+    assert result.strategy == "buffered"
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+
+
+@pytest.mark.parametrize("strategy", ["copy_file_range", "sendfile"])
+def test_short_source_fails(source: Path, tmp_path: Path, strategy: str):
+    func = dict(fileops.STRATEGIES)[strategy]
+    with pytest.raises(OSError):
+        copy_with(func, source, tmp_path / "copy.bin", source.stat().st_size * 2)
+
+
+@pytest.mark.parametrize("strategy", ["copy_file_range", "sendfile"])
+def test_empty_source_tries_next_strategy(tmp_path: Path, strategy: str):
+    func = dict(fileops.STRATEGIES)[strategy]
+    (tmp_path / "empty.bin").touch()
+    assert not copy_with(func, tmp_path / "empty.bin", tmp_path / "copy.bin", 1024)
+
+
+def test_move_file_renames(source: Path, tmp_path: Path):
+    data = source.read_bytes()
+    result = move_file(source, tmp_path / "moved.bin")
+    assert result.strategy == "rename"
+    assert not source.exists()
+    assert (tmp_path / "moved.bin").read_bytes() == data
+
+
+def test_copy_file_checksum(source: Path, tmp_path: Path):
+    result = copy_file(source, tmp_path / "copy.bin", checksum="sha256", verify=True)
+    assert result.checksum == hash_file(source, "sha256")
+    assert result.checksum == "sha256:" + hashlib.sha256(source.read_bytes()).hexdigest()
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+
+
+def test_copy_file_checksum_empty_file(tmp_path: Path):
+    (tmp_path / "empty.bin").touch()
+    result = copy_file(tmp_path / "empty.bin", tmp_path / "copy.bin", checksum="md5")
+    assert result.checksum == "md5:" + hashlib.md5(b"").hexdigest()
+    assert (tmp_path / "copy.bin").read_bytes() == b""
+
+
+def test_checksum_mismatch_keeps_destination(source: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    (tmp_path / "copy.bin").write_bytes(b"old")
+    monkeypatch.setattr(fileops, "hash_file", lambda path, algorithm, uncached=False: f"{algorithm}:bad")
+    with pytest.raises(ChecksumMismatch):
+        copy_file(source, tmp_path / "copy.bin", checksum="sha256", verify=True)
+    assert (tmp_path / "copy.bin").read_bytes() == b"old"
+    assert sorted(i.name for i in tmp_path.iterdir()) == ["copy.bin", "source.bin"]
+
+
+def test_move_file_checksum(source: Path, tmp_path: Path):
+    expected = hash_file(source, "sha256")
+    result = move_file(source, tmp_path / "moved.bin", checksum="sha256")
+    assert result.checksum == expected
+
+
+def test_checksum_supported():
+    assert checksum_supported("sha256")
+    assert not checksum_supported("shake_128")
+    assert not checksum_supported("nope")
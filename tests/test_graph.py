@@ -0,0 +1,65 @@
+import pytest
+
+from app.exceptions import ValidationError
+from app.graph import TaskGraph
+from app.streams import JobStreams
+
+
+def task(depends_on=None, streams=None, **data) -> dict:
+    result = {"module": "test", "data": data}
+    if depends_on is not None:
+        result["depends_on"] = depends_on
+    if streams is not None:
+        result["streams"] = streams
+    return result
+
+
+def graph(*tasks) -> TaskGraph:
+    data = {"tasks": list(tasks)}
+    return TaskGraph(data, JobStreams(data))
+
+
+def test_tasks_run_in_order_by_default():
+    g = graph(task(), task(), task())
+    assert g.groups == [[0], [1], [2]]
+    assert g.dependencies == [set(), {0}, {1}]
+    assert not g.concurrent
+    assert g.ready(set(), set()) == [0]
+    assert g.ready({0}, {0}) == [1]
+
+
+def test_independent_tasks_start_together():
+    g = graph(task(), task(depends_on=[]), task(depends_on=[0, 1]))
+    assert g.dependencies == [set(), set(), {0, 1}]
+    assert g.concurrent
+    assert g.ready(set(), set()) == [0, 1]
+    assert g.ready({0}, {0, 1}) == []
+    assert g.ready({0, 1}, {0, 1}) == [2]
+
+
+def test_streamed_tasks_form_one_group():
+    g = graph(
+        task(streams=["/tmp/pipe"], output="/tmp/pipe"),
+        task(depends_on=[], other="x"),
+        task(source="/tmp/pipe"),
+        task(depends_on=[1]),
+    )
+    assert g.groups == [[0, 1, 2], [3]]
+    assert g.dependencies == [set(), {0}]
+    assert g.concurrent
+
+
+@pytest.mark.parametrize("depends_on", [[1], [2], [-1], ["0"], [True], 0])
+def test_invalid_dependencies(depends_on):
+    with pytest.raises(ValidationError):
+        graph(task(), task(depends_on=depends_on))
+
+
+def test_stream_must_be_read():
+    with pytest.raises(ValidationError):
+        graph(task(streams=["/tmp/pipe"]), task(source="/tmp/other"))
+
+
+def test_stream_written_twice():
+    with pytest.raises(ValidationError):
+        graph(task(streams=["/tmp/pipe"]), task(streams=["/tmp/pipe"]), task(source="/tmp/pipe"))
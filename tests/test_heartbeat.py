@@ -0,0 +1,111 @@
+import pytest
+
+from app import heartbeat as heartbeat_module
+from app.heartbeat import Heartbeat
+
+
+@pytest.fixture
+def requests(monkeypatch: pytest.MonkeyPatch) -> list:
+    sent = list()
+    monkeypatch.setattr(heartbeat_module.api, "request",
+                        lambda method, path, json=None: sent.append((method, json)))
+    return sent
+
+
+def in_progress(heartbeat: Heartbeat, progress: float) -> None:
+    heartbeat.slot(0).set_data({"status": "in_progress", "task": "ffmpeg", "progress": progress})
+
+
+def test_first_message_is_sent_in_full(requests: list):
+    heartbeat = Heartbeat(interval=5)
+    assert heartbeat.next_update() == ("full", 0)
+    assert heartbeat.send_message("full")
+    method, payload = requests[-1]
+    assert method == "POST"
+    assert payload["status"] == "idle"
+    assert {"hostname", "version", "online_at"} <= set(payload)
+
+
+def test_unchanged_status_waits_for_keepalive(requests: list):
+    heartbeat = Heartbeat(interval=5, keepalive=60)
+    heartbeat.send_message("full")
+    kind, wait = heartbeat.next_update()
+    assert kind is None
+    assert 59 < wait <= 60
+
+
+def test_keepalive_defaults_to_interval():
+    assert Heartbeat(interval=5).keepalive == 5
+    assert Heartbeat(interval=5, keepalive=30).keepalive == 30
+
+
+def test_transition_is_sent_right_away(requests: list):
+    heartbeat = Heartbeat(interval=5)
+    heartbeat.send_message("full")
+    in_progress(heartbeat, 0.0)
+    assert heartbeat.next_update() == ("full", 0)
+
+
+def test_progress_is_rate_limited(requests: list):
+    heartbeat = Heartbeat(interval=5)
+    in_progress(heartbeat, 0.0)
+    heartbeat.send_message("full")
+    in_progress(heartbeat, 10.0)
+    kind, wait = heartbeat.next_update()
+    assert kind is None
+    assert 4 < wait <= 5
+
+
+def test_progress_update_sends_only_changed_fields(requests: list):
+    heartbeat = Heartbeat(interval=0, deltas=True)
+    in_progress(heartbeat, 0.0)
+    heartbeat.send_message("full")
+    in_progress(heartbeat, 42.5)
+    assert heartbeat.next_update() == ("update", 0)
+    heartbeat.send_message("update")
+    assert requests[-1] == ("PATCH", {"progress": 42.5})
+
+
+def test_progress_update_without_deltas_is_full(requests: list):
+    heartbeat = Heartbeat(interval=0)
+    in_progress(heartbeat, 0.0)
+    heartbeat.send_message("full")
+    in_progress(heartbeat, 42.5)
+    heartbeat.send_message("update")
+    method, payload = requests[-1]
+    assert method == "POST"
+    assert payload["progress"] == 42.5 and payload["status"] == "in_progress"
+
+
+def test_failed_send_is_retried_in_full(monkeypatch: pytest.MonkeyPatch):
+    def fail(*args, **kwargs):
+        raise ConnectionError()
+
+    monkeypatch.setattr(heartbeat_module.api, "request", fail)
+    heartbeat = Heartbeat(interval=5, deltas=True)
+    assert not heartbeat.send_message("full")
+    assert heartbeat.next_update() == ("full", 0)
+
+
+def test_concurrent_tasks_are_merged(requests: list):
+    heartbeat = Heartbeat(interval=5)
+    slot = heartbeat.slot(0)
+    slot.set_in_progress({"job_id": "job"})
+    slot.task(1).set_data({"status": "in_progress", "task": "ffmpeg", "progress": 20.0})
+    slot.task(2).set_data({"status": "in_progress", "task": "cleanup", "progress": 60.0})
+    assert slot.message["task"] == "ffmpeg"
+    assert slot.message["progress"] == 40.0
+    assert [i["index"] for i in slot.message["tasks"]] == [1, 2]
+
+    slot.task(1).clear()
+    assert slot.message["task"] == "cleanup"
+    assert slot.message["progress"] == 60.0
+
+
+def test_multiple_slots_mirror_first_busy_slot(requests: list):
+    heartbeat = Heartbeat(interval=5, slots=2)
+    heartbeat.slot(1).set_data({"status": "in_progress", "task": "ffmpeg"})
+    message = heartbeat.message
+    assert message.status == "in_progress"
+    assert [i.status for i in message.slots] == ["idle", "in_progress"]
+    assert [i.slot for i in message.slots] == [0, 1]
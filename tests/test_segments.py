@@ -0,0 +1,118 @@
+from pathlib import Path
+
+import pytest
+
+from app import segments
+from app.segments import (auxiliary_command, concat_command, mux_command, plan_segments,
+                          segment_command, unsplittable, video_first)
+
+COMMAND = ["ffmpeg", "-y", "-i", "in.mkv", "-map", "0", "-c:v", "libx264", "-c:a", "copy", "out.mkv"]
+
+
+def test_plan_segments_starts_on_keyframes():
+    plan = plan_segments(100.0, [0.0, 24.0, 49.0, 76.0], 4, 10)
+    assert plan == [(0.0, 24.0), (24.0, 49.0), (49.0, 76.0), (76.0, None)]
+
+
+def test_plan_segments_respects_minimum_length():
+    plan = plan_segments(100.0, [0.0, 5.0, 50.0, 97.0], 4, 10)
+    assert plan == [(0.0, 50.0), (50.0, None)]
+    assert all((end or 100.0) - start >= 10 for start, end in plan)
+
+
+def test_plan_segments_short_video_is_one_segment():
+    assert plan_segments(15.0, [0.0, 5.0, 10.0], 8, 10) == [(0.0, None)]
+    assert plan_segments(100.0, [], 4, 10) == [(0.0, None)]
+
+
+@pytest.mark.parametrize("option", ["-pass", "-filter_complex", "-ss", "-t"])
+def test_unsplittable(option: str):
+    assert unsplittable(COMMAND[:-1] + [option, "1", "out.mkv"]) == option
+    assert unsplittable(COMMAND) is None
+
+
+def test_segment_command_seeks_every_input():
+    command = segment_command(COMMAND[:2] + ["-i", "sub.srt"] + COMMAND[2:], (10.0, 20.0), Path("seg.mkv"), 4)
+    assert command[:2] == ["ffmpeg", "-y"]
+    assert command[-1] == "seg.mkv"
+    assert command.count("-ss") == 2 and command.count("-to") == 2
+    for idx in [i for i, token in enumerate(command) if token == "-i"]:
+        assert command[idx - 4:idx] == ["-ss", "10.000000", "-to", "20.000000"]
+    assert command[-8:-1] == ["-an", "-sn", "-dn", "-map_chapters", "-1", "-threads", "4"]
+
+
+def test_segment_command_last_segment_has_no_end():
+    command = segment_command(COMMAND, (20.0, None), Path("seg.mkv"))
+    assert "-to" not in command
+    assert "-threads" not in command
+
+
+def test_auxiliary_command_drops_video():
+    command = auxiliary_command(COMMAND, Path("aux.mkv"))
+    assert command == ["ffmpeg", "-y"] + COMMAND[2:-1] + ["-vn", "aux.mkv"]
+
+
+def test_concat_and_mux_commands():
+    concat = concat_command("ffmpeg", Path("list.txt"), Path("video.mkv"))
+    assert concat[concat.index("-f") + 1] == "concat"
+    assert concat[-1] == "video.mkv"
+    mux = mux_command("ffmpeg", Path("video.mkv"), Path("aux.mkv"), "out.mkv", True)
+    assert "-y" in mux
+    assert mux[mux.index("-map"):mux.index("-map") + 4] == ["-map", "0", "-map", "1"]
+    assert mux[-1] == "out.mkv"
+    mux = mux_command("ffmpeg", Path("video.mkv"), None, "out.mkv", False)
+    assert "-y" not in mux and "1" not in mux
+
+
+@pytest.mark.parametrize("maps, expected", [
+    ([], True),
+    (["-map", "0"], True),
+    (["-map", "0:v", "-map", "0:a?"], True),
+    (["-map", "0", "-map", "-0:s"], True),
+    (["-map", "0:a", "-map", "0:v"], False),
+    (["-map", "0:1", "-map", "0:0"], False),
+    (["-map", "[out]"], False),
+    (["-map", "1:v"], False),
+])
+def test_video_first(monkeypatch: pytest.MonkeyPatch, maps: list, expected: bool):
+    monkeypatch.setattr(segments, "probe_stream_types", lambda source: ["video", "audio", "subtitle"])
+    assert video_first(["ffmpeg", "-i", "in.mkv"] + maps + ["out.mkv"]) is expected
+
+
+def test_video_first_probes_input_order(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(segments, "probe_stream_types", lambda source: ["audio", "video"])
+    assert not video_first(["ffmpeg", "-i", "in.mkv", "-map", "0", "out.mkv"])
+
+
+def test_manifest_round_trip(tmp_path: Path):
+    segment = tmp_path / "0000.mkv"
+    segment.write_bytes(b"data")
+    manifest = segments.SegmentManifest(tmp_path / "manifest.json", "key", [(0.0, 10.0), (10.0, None)])
+    manifest.record(segment, 240)
+
+    loaded = segments.SegmentManifest.load(tmp_path / "manifest.json", "key")
+    assert loaded.plan == [(0.0, 10.0), (10.0, None)]
+    assert loaded.is_complete(segment)
+    assert loaded.frames(segment) == 240
+    assert not loaded.is_complete(tmp_path / "0001.mkv")
+    assert loaded.frames(tmp_path / "0001.mkv") == 0
+
+
+def test_manifest_rejects_other_encode(tmp_path: Path):
+    (tmp_path / "0000.mkv").write_bytes(b"data")
+    segments.SegmentManifest(tmp_path / "manifest.json", "key", [(0.0, None)]).record(tmp_path / "0000.mkv", 0)
+    assert segments.SegmentManifest.load(tmp_path / "manifest.json", "other") is None
+    assert segments.SegmentManifest.load(tmp_path / "missing.json", "key") is None
+    (tmp_path / "broken.json").write_text("{")
+    assert segments.SegmentManifest.load(tmp_path / "broken.json", "key") is None
+
+
+def test_manifest_detects_changed_segment(tmp_path: Path):
+    segment = tmp_path / "0000.mkv"
+    segment.write_bytes(b"data")
+    manifest = segments.SegmentManifest(tmp_path / "manifest.json", "key", [(0.0, None)])
+    manifest.record(segment, 1)
+    segment.write_bytes(b"truncated data")
+    assert not manifest.is_complete(segment)
+    segment.unlink()
+    assert not manifest.is_complete(segment)